@@ -0,0 +1,85 @@
+import numpy as np
+
+from tileset import TilesetProperties
+
+# (dx, dy, bit) of the 8 neighbours of a cell
+NEIGHBOURS = (
+    (-1, -1, 1), (0, -1, 2), (1, -1, 4),
+    (-1, 0, 8), (1, 0, 16),
+    (-1, 1, 32), (0, 1, 64), (1, 1, 128),
+)
+NW, N, NE, W, E, SW, S, SE = (bit for _, _, bit in NEIGHBOURS)
+
+# Edge/corner pieces of the Biome/Foreground sheets (10x5 tiles)
+BIOME_FOREGROUND_TEMPLATE = {
+    "center": 16,
+    "top": 6,
+    "bottom": 26,
+    "left": 15,
+    "right": 17,
+    "top_left": 5,
+    "top_right": 7,
+    "bottom_left": 25,
+    "bottom_right": 27,
+    "inner_top_left": 22,
+    "inner_top_right": 20,
+    "inner_bottom_left": 2,
+    "inner_bottom_right": 0,
+}
+
+TEMPLATES = {
+    (10, 5): BIOME_FOREGROUND_TEMPLATE,
+}
+
+
+def dilate(mask: np.ndarray) -> np.ndarray:
+    padded = np.pad(mask, 1)
+    height, width = mask.shape
+    dilated = mask.copy()
+    for dx, dy, _ in NEIGHBOURS:
+        dilated |= padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+    return dilated
+
+
+def piece_for_mask(mask: int) -> str:
+    missing = {side for side, bit in (("top", N), ("bottom", S), ("left", W), ("right", E)) if not mask & bit}
+    if not missing:
+        for piece, bit in (("inner_top_left", NW), ("inner_top_right", NE),
+                           ("inner_bottom_left", SW), ("inner_bottom_right", SE)):
+            if not mask & bit:
+                return piece
+        return "center"
+    if len(missing) == 1:
+        return missing.pop()
+    if len(missing) == 2 and missing != {"top", "bottom"} and missing != {"left", "right"}:
+        vertical = "top" if "top" in missing else "bottom"
+        horizontal = "left" if "left" in missing else "right"
+        return f"{vertical}_{horizontal}"
+    return "center"
+
+
+class AutotileRules:
+    def __init__(self, template: dict):
+        self.template = template
+        self.lut = np.array(
+            [template.get(piece_for_mask(mask), template["center"]) for mask in range(256)],
+            dtype=np.int32
+        )
+
+    @classmethod
+    def for_tileset(cls, tileset: TilesetProperties):
+        template = TEMPLATES.get((tileset.tile_by_line, tileset.tile_by_column))
+        if template is None:
+            return None
+        return cls(template)
+
+    def masks(self, terrain: np.ndarray, outside_is_terrain: bool = True) -> np.ndarray:
+        padded = np.pad(terrain, 1, constant_values=outside_is_terrain)
+        height, width = terrain.shape
+        masks = np.zeros(terrain.shape, dtype=np.uint8)
+        for dx, dy, bit in NEIGHBOURS:
+            masks |= padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width].astype(np.uint8) * np.uint8(bit)
+        return masks
+
+    def resolve(self, terrain: np.ndarray, outside_is_terrain: bool = True) -> np.ndarray:
+        return np.where(terrain, self.lut[self.masks(terrain, outside_is_terrain)], -1)
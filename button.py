@@ -2,6 +2,8 @@ import pygame
 from pygame.locals import *
 from pygame.math import Vector2 as Vec2
 
+from input_state import input_state
+
 class Button:
     default_img = pygame.Surface((100, 50))
     default_img.fill((255, 255, 255))
@@ -15,6 +17,8 @@ class Button:
         
         self.callback = callback
         self.hovered = False
+        # Set whenever the button looks different, for whatever caches its image (see UiLayer)
+        self.dirty = True
         for key, value in kwargs.items():
             setattr(self, key, value)
   
@@ -24,20 +28,26 @@ class Button:
             return True
         return False
             
-    def draw(self, surface):
+    def draw(self, surface, origin=(0, 0)):
+        # origin is where surface sits on screen
+        rect = self.rect.move(-origin[0], -origin[1])
         if self.hovered:
-            surface.blit(self.h_image, self.rect)
+            surface.blit(self.h_image, rect)
         else:
-            surface.blit(self.image, self.rect)
+            surface.blit(self.image, rect)
         
     def update(self):
-        mouse_pos = pygame.mouse.get_pos()
+        mouse_pos = input_state.mouse_pos()
         if self.rect.collidepoint(mouse_pos) and not self.hovered:
             self.hovered = True
+            self.dirty = True
         elif not self.rect.collidepoint(mouse_pos) and self.hovered:
             self.hovered = False
+            self.dirty = True
   
 class TextButton(Button):
+    __ready = False
+
     def __init__(self, text, rect, font, callback=lambda: None, **kwargs):
         super().__init__(rect, callback=callback)
         
@@ -60,7 +70,14 @@ class TextButton(Button):
         
         self.recalculate_bounds()
         self.render()
-        self.__setattr__ = self.attr_setter
+        self.__ready = True
+
+    def __setattr__(self, key, value):
+        # Only looked up on the class, so it has to be defined here; until __init__ is done values are just stored
+        if self.__ready:
+            self.attr_setter(key, value)
+        else:
+            super().__setattr__(key, value)
   
     def attr_setter(self, key, value):
         super().__setattr__(key, value)
@@ -84,6 +101,7 @@ class TextButton(Button):
         self.image.fill(self.bg_color, self.image.get_rect().inflate(-self.border_width*2, -self.border_width*2))
         text = self.font.render(self.text, True, self.text_color)            
         self.image.blit(text, text.get_rect(center=self.image.get_rect().center))
+        self.dirty = True
  
 
 class ImgButton(Button):
@@ -113,14 +131,16 @@ class ImgButton(Button):
     def recalculate_bounds(self):
         self.image = pygame.transform.scale(self.image, Vec2(self.rect.size) - self.spacing*2)
         self.h_image = pygame.transform.scale(self.h_image, Vec2(self.rect.size) - self.spacing*2)
+        self.dirty = True
     
-    def draw(self, surface):
+    def draw(self, surface, origin=(0, 0)):
+        rect = self.rect.move(-origin[0], -origin[1])
         if self.hovered:
-            surface.fill(self.h_bg_color, self.rect)
-            surface.blit(self.h_image, self.h_image.get_rect(center=self.rect.center))
+            surface.fill(self.h_bg_color, rect)
+            surface.blit(self.h_image, self.h_image.get_rect(center=rect.center))
         else:
-            surface.fill(self.bg_color, self.rect)
-            surface.blit(self.image, self.image.get_rect(center=self.rect.center))
+            surface.fill(self.bg_color, rect)
+            surface.blit(self.image, self.image.get_rect(center=rect.center))
   
 if __name__ == "__main__":
     pygame.init()
@@ -0,0 +1,126 @@
+import os
+
+import pygame
+
+from input_state import input_state
+from replay import EventRecorder
+
+# The sessions replay.py checks frame times with, written from code so that they can be made again when the
+# layout of the editor changes. Run this file to write them into sessions/, then replay them with --save to
+# make a new baseline
+SESSION_DIR = "sessions"
+WINDOW_SIZE = (1000, 700)
+FRAME = 16
+# Screen positions in a 1000x700 window: the New button, the brush and eraser buttons and a free area of the
+# map (64x64 tiles of 16 px drawn from y=100) that the tile picker does not cover
+NEW_BUTTON = (40, 15)
+BRUSH_BUTTON = (35, 60)
+ERASER_BUTTON = (75, 60)
+PAINT_AREA = pygame.Rect(8, 264, 624, 432)
+
+
+class SessionWriter:
+    def __init__(self, name: str, directory: str = SESSION_DIR, size=WINDOW_SIZE):
+        input_state.replaying = True
+        input_state.ticks = 0
+        self.recorder = EventRecorder(os.path.join(directory, f"{name}.jsonl"), size)
+        self.ticks = 0
+
+    def frame(self, *events, wait: int = FRAME):
+        self.ticks += wait
+        input_state.ticks = self.ticks
+        self.recorder.record(list(events))
+
+    def idle(self, ms: int):
+        self.ticks += ms
+
+    def move(self, pos, buttons=(0, 0, 0)):
+        self.frame(pygame.event.Event(pygame.MOUSEMOTION, pos=pos, rel=(0, 0), buttons=buttons, touch=False))
+
+    def click(self, pos, button: int = 1):
+        self.move(pos)
+        self.frame(pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=pos, button=button, touch=False))
+        self.frame(pygame.event.Event(pygame.MOUSEBUTTONUP, pos=pos, button=button, touch=False))
+
+    def drag(self, points: list):
+        self.move(points[0])
+        self.frame(pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=points[0], button=1, touch=False))
+        for pos in points[1:]:
+            self.move(pos, buttons=(1, 0, 0))
+        self.frame(pygame.event.Event(pygame.MOUSEBUTTONUP, pos=points[-1], button=1, touch=False))
+
+    def key(self, key: int, mod: int = 0):
+        self.frame(
+            pygame.event.Event(pygame.KEYDOWN, key=key, mod=mod, unicode="", scancode=0),
+            pygame.event.Event(pygame.KEYUP, key=key, mod=mod, unicode="", scancode=0),
+        )
+
+    def wheel(self, pos, y: int):
+        self.move(pos)
+        self.frame(pygame.event.Event(pygame.MOUSEWHEEL, x=0, y=y, flipped=False, precise_x=0.0, precise_y=float(y), touch=False))
+
+    def resize(self, size):
+        self.frame(pygame.event.Event(pygame.VIDEORESIZE, size=size, w=size[0], h=size[1]))
+
+    def close(self):
+        self.recorder.close()
+        input_state.replaying = False
+
+
+def serpentine(area: pygame.Rect, spacing: int, step: int) -> list:
+    # Left to right then back, one row every spacing px, one point every step px
+    points = []
+    for row, y in enumerate(range(area.top, area.bottom, spacing)):
+        xs = list(range(area.left, area.right, step))
+        points.extend((x, y) for x in (xs if row % 2 == 0 else reversed(xs)))
+    return points
+
+
+def paint_10k_tiles(directory: str = SESSION_DIR):
+    # Ten passes of a 3x3 brush over ~1000 cells, painting and erasing in turn: about 10k tiles written
+    session = SessionWriter("paint_10k_tiles", directory)
+    session.click(NEW_BUTTON)
+    session.key(pygame.K_RIGHTBRACKET)
+    session.key(pygame.K_RIGHTBRACKET)
+    for i in range(10):
+        session.click(ERASER_BUTTON if i % 2 else BRUSH_BUTTON)
+        session.drag(serpentine(PAINT_AREA, 48, 24))
+    session.close()
+
+
+def zoom_sweep(directory: str = SESSION_DIR):
+    # Zooms in and out around a few points of a painted map, pausing now and then so that the chunks refine
+    session = SessionWriter("zoom_sweep", directory)
+    session.click(NEW_BUTTON)
+    session.key(pygame.K_g)
+    for pos in ((320, 400), (100, 300), (600, 600), (320, 400)):
+        for direction in (1, -1):
+            for _ in range(12):
+                session.wheel(pos, direction)
+            session.idle(400)
+            session.move(pos)
+    session.close()
+
+
+def resize_picker(directory: str = SESSION_DIR):
+    # Resizes the window, which moves and rebuilds the tile picker, and picks tiles from every tileset on the way
+    session = SessionWriter("resize_picker", directory)
+    session.click(NEW_BUTTON)
+    sizes = [(1000 + 40 * i, 700 + 20 * i) for i in range(8)] + [(1280 - 40 * i, 860 - 20 * i) for i in range(8)]
+    for size in sizes:
+        session.resize(size)
+        session.key(pygame.K_TAB)
+        picker = (size[0] - 320, 120)
+        session.click(picker)
+        session.wheel(picker, 1)
+        session.click((200, 400))
+    session.close()
+
+
+CANONICAL_SESSIONS = (paint_10k_tiles, zoom_sweep, resize_picker)
+
+
+if __name__ == "__main__":
+    pygame.init()
+    for write_session in CANONICAL_SESSIONS:
+        write_session()
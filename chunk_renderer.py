@@ -0,0 +1,43 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pygame
+
+
+def render_tiles(surfaces: list, rects: list, indices: list, tile_size: tuple) -> pygame.Surface:
+    # indices are rows of dense gid table indices, the table's count standing for EMPTY
+    width, height = tile_size
+    empty = len(surfaces)
+    surf = pygame.Surface((len(indices[0]) * width, len(indices) * height), pygame.SRCALPHA)
+    surf.blits([
+        (surfaces[index], (x * width, y * height), rects[index])
+        for y, row in enumerate(indices)
+        for x, index in enumerate(row)
+        if index != empty
+    ], doreturn=False)
+    return surf
+
+
+def render_block(table, block: np.ndarray, tile_size: tuple, size: tuple) -> pygame.Surface:
+    # block is a copy of the chunk's global ids, table the GidTable they index into
+    surfaces, rects, _ = tiles = table.tiles
+    surf = render_tiles(surfaces, rects, table.visible(block, tiles).tolist(), tile_size)
+    return pygame.transform.scale(surf, size)
+
+
+class ChunkRenderer:
+    # Chunk renders only read a copy of the chunk's cells and the tileset surfaces, so any number can run at once;
+    # the results are swapped into the layers' caches on the main thread
+    def __init__(self, workers: int = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="chunk-renderer")
+
+    def submit(self, table, block: np.ndarray, tile_size: tuple, size: tuple):
+        return self.executor.submit(render_block, table, block, tile_size, size)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+chunk_renderer = ChunkRenderer()
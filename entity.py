@@ -1,4 +1,103 @@
+from functools import lru_cache
+
+import pygame
+from pygame.math import Vector2 as Vec2
+
+from sprite_cache import sprite_cache
+from input_state import input_state
+
+ANIMATIONS = ("idle", "walk", "attack", "damage", "death", "special")
+
+
+class SpriteSheet:
+    __slots__ = ("surface", "frame_size", "frames", "frame_counts", "path")
+
+    def __init__(self, surface: pygame.Surface, frame_size: Vec2 = Vec2(16, 16), path: str = ""):
+        self.surface = surface
+        self.frame_size = Vec2(frame_size)
+        self.path = path
+        self.frames = []
+        self.frame_counts = []
+        columns = int(surface.get_width() // self.frame_size.x)
+        for row in range(int(surface.get_height() // self.frame_size.y)):
+            frames = [surface.subsurface(self.frame_rect(row, column)) for column in range(columns)]
+            count = 0
+            for column, frame in enumerate(frames):
+                if frame.get_bounding_rect().width:
+                    count = column + 1
+            self.frames.append(frames[:max(count, 1)])
+            self.frame_counts.append(max(count, 1))
+
+    def frame_rect(self, row: int, column: int) -> pygame.Rect:
+        return pygame.Rect(
+            column * self.frame_size.x, row * self.frame_size.y,
+            self.frame_size.x, self.frame_size.y
+        )
+
+
+@lru_cache
+def load_sprite_sheet(path: str, frame_size: tuple = (16, 16)) -> SpriteSheet:
+    return SpriteSheet(pygame.image.load(path), Vec2(frame_size), path)
+
+
+def sprite_sheet_path(name: str, variant: int = 0, kind: str = "sprite_sheet", frame_size: int = 16) -> str:
+    file_name = name.replace(" ", "_")
+    return f"assets/Source/Entities/{name}/{kind}_{file_name}_{variant}_{frame_size}x{frame_size}.png"
+
 
 class Entity:
-    def draw(self,surface):
-        return NotImplemented
\ No newline at end of file
+    __slots__ = ("name", "pos", "sprite_sheet", "animation", "loop", "frame_duration", "anim_start")
+
+    def __init__(
+        self,
+        pos: Vec2,
+        sprite_sheet: SpriteSheet,
+        name: str = "",
+        animation: int = 0,
+        loop: bool = True,
+        frame_duration: int = 150,
+    ):
+        self.pos = Vec2(pos)
+        self.sprite_sheet = sprite_sheet
+        self.name = name
+        self.frame_duration = frame_duration
+        self.play(animation, loop)
+
+    @classmethod
+    def from_name(cls, name: str, pos: Vec2, variant: int = 0, **kwargs):
+        return cls(pos, load_sprite_sheet(sprite_sheet_path(name, variant)), name=name, **kwargs)
+
+    def play(self, animation, loop: bool = True):
+        if isinstance(animation, str):
+            if animation not in ANIMATIONS:
+                raise ValueError(f"Unknown animation {animation!r}, expected one of {', '.join(ANIMATIONS)}")
+            animation = ANIMATIONS.index(animation)
+        self.animation = min(animation, len(self.sprite_sheet.frame_counts) - 1)
+        self.loop = loop
+        self.anim_start = input_state.get_ticks()
+
+    @property
+    def frame(self):
+        count = self.sprite_sheet.frame_counts[self.animation]
+        frame = (input_state.get_ticks() - self.anim_start) // self.frame_duration
+        if self.loop:
+            return frame % count
+        return min(frame, count - 1)
+
+    @property
+    def size(self):
+        return self.sprite_sheet.frame_size
+
+    @property
+    def rect(self):
+        return pygame.Rect(self.pos, self.size)
+
+    def update(self):
+        pass
+
+    def draw(self, surface: pygame.Surface, offset: Vec2 = Vec2(0, 0), scaling_factor: float = 1):
+        frames = sprite_cache.get(self.sprite_sheet, scaling_factor)
+        frame = frames[self.animation][self.frame]
+        # The cached frames are only close to the zoom, centring them on the exact rect keeps them over their tiles
+        center = (self.pos + self.size / 2) * scaling_factor + offset
+        surface.blit(frame, frame.get_rect(center=(round(center.x), round(center.y))))
@@ -21,6 +21,13 @@ class FilePicker:
         self.is_folder = False
         return self.file_name
 
+    def prompt_save_file(self, title="Save as", filetypes=[("All files", "*.*")], initialdir="/", defaultextension=""):
+        self.file_name = tkinter.filedialog.asksaveasfilename(
+            title=title, filetypes=filetypes, initialdir=initialdir, defaultextension=defaultextension
+        )
+        self.is_folder = False
+        return self.file_name
+
 
 if __name__ == "__main__":
     file_picker = FilePicker()
@@ -0,0 +1,127 @@
+from contextlib import contextmanager
+
+import numpy as np
+import pygame
+
+from layer import Layer
+
+
+class RegionEdit:
+    def __init__(self):
+        self.writes = []
+
+    def __bool__(self):
+        return bool(self.writes)
+
+    @property
+    def layers(self) -> list:
+        return list({id(write[0]): write[0] for write in self.writes}.values())
+
+    def record(self, layer: Layer, region: pygame.Rect, before: np.ndarray, after: np.ndarray):
+        self.writes.append((layer, pygame.Rect(region), before, after))
+
+    def record_cells(self, layer: Layer, cells: np.ndarray, before: np.ndarray, after: np.ndarray):
+        # cells is (n, 2) x, y, for sparse writes like brush strokes whose bounding box could span the map
+        self.writes.append((layer, cells, before, after))
+
+    def apply(self):
+        for layer, where, _, after in self.writes:
+            write(layer, where, after)
+
+    def revert(self):
+        for layer, where, before, _ in reversed(self.writes):
+            write(layer, where, before)
+
+
+def write(layer: Layer, where, values: np.ndarray):
+    if isinstance(where, pygame.Rect):
+        layer.set_tiles(where.topleft, values, autotile=False)
+    else:
+        layer.set_cells(where, values, autotile=False)
+
+
+class EditHistory:
+    def __init__(self, limit: int = 100):
+        self.limit = limit
+        self.undo_stack = []
+        self.redo_stack = []
+        self.recording = None
+        # Layer version after the last write the history knows of. A layer written since without being recorded
+        # no longer matches the edits' before and after arrays, replaying them would overwrite that write
+        self.versions = {}
+
+    def begin(self, layers: list):
+        # Every write to these layers until end() is recorded into one edit
+        self.end()
+        edit = RegionEdit()
+        self.recording = (list(layers), edit)
+        for layer in layers:
+            layer.edit = edit
+
+    def end(self):
+        if self.recording is None:
+            return
+        layers, edit = self.recording
+        self.recording = None
+        for layer in layers:
+            layer.edit = None
+        self.push(edit)
+
+    @contextmanager
+    def recorded(self, layers: list):
+        self.begin(layers)
+        try:
+            yield
+        finally:
+            self.end()
+
+    def push(self, edit: RegionEdit):
+        if not edit:
+            return
+        self.undo_stack.append(edit)
+        del self.undo_stack[:-self.limit]
+        self.redo_stack.clear()
+        self.seen(edit)
+
+    def seen(self, edit: RegionEdit):
+        for layer in edit.layers:
+            self.versions[id(layer)] = (layer, layer.version)
+
+    def is_stale(self, edit: RegionEdit) -> bool:
+        return any(self.versions.get(id(layer), (None, None))[1] != layer.version for layer in edit.layers)
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.versions = {}
+
+    def drop_stale(self):
+        # Only the edits of layers written behind the history's back go, those of the other layers stay undoable
+        stale = {id(layer) for layer, version in self.versions.values() if layer.version != version}
+        for stack in (self.undo_stack, self.redo_stack):
+            stack[:] = [edit for edit in stack if not any(id(layer) in stale for layer in edit.layers)]
+        for key in stale:
+            del self.versions[key]
+
+    def undo(self):
+        # Undoing in the middle of a stroke would stop recording the rest of it
+        if self.recording is not None:
+            return
+        if self.undo_stack and self.is_stale(self.undo_stack[-1]):
+            self.drop_stale()
+        if self.undo_stack:
+            edit = self.undo_stack.pop()
+            edit.revert()
+            self.seen(edit)
+            self.redo_stack.append(edit)
+
+    def redo(self):
+        if self.recording is not None:
+            return
+        if self.redo_stack and self.is_stale(self.redo_stack[-1]):
+            self.drop_stale()
+        if self.redo_stack:
+            edit = self.redo_stack.pop()
+            edit.apply()
+            self.seen(edit)
+            self.undo_stack.append(edit)
@@ -0,0 +1,35 @@
+import pygame
+
+
+class InputState:
+    # The mouse and clock as the app saw them. Live they come straight from pygame; while a recorded session is
+    # replayed they follow the replayed events and a fixed clock, since the dummy video driver has no mouse
+    def __init__(self):
+        self.replaying = False
+        self.pos = (0, 0)
+        self.pressed = (False, False, False)
+        self.ticks = 0
+
+    def feed(self, event: pygame.event.Event):
+        if not self.replaying:
+            return
+        if event.type in (pygame.MOUSEMOTION, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP):
+            self.pos = tuple(event.pos)
+        if event.type == pygame.MOUSEMOTION:
+            self.pressed = tuple(bool(button) for button in event.buttons[:3])
+        elif event.type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP) and 1 <= event.button <= 3:
+            pressed = list(self.pressed)
+            pressed[event.button - 1] = event.type == pygame.MOUSEBUTTONDOWN
+            self.pressed = tuple(pressed)
+
+    def mouse_pos(self) -> tuple:
+        return self.pos if self.replaying else pygame.mouse.get_pos()
+
+    def mouse_pressed(self) -> tuple:
+        return self.pressed if self.replaying else pygame.mouse.get_pressed()
+
+    def get_ticks(self) -> int:
+        return self.ticks if self.replaying else pygame.time.get_ticks()
+
+
+input_state = InputState()
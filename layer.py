@@ -1,31 +1,173 @@
 import pygame
 from pygame.locals import *
 from pygame.math import Vector2 as Vec2
-import random
+import zlib
+from collections import OrderedDict
+import numpy as np
 
 from tile import Tile
-from tileset import TilesetProperties
+from tileset import TilesetProperties, EMPTY, TILE_BITS, pack_gid, gid_tileset, gid_index, gid_table
+from autotile import AutotileRules, dilate
+from sparse_grid import SparseGrid
+from sprite_cache import surface_bytes
+from memory import memory
+from input_state import input_state
+from chunk_renderer import chunk_renderer, render_tiles
+
+CHUNK_SIZE = 16
+# Random odd 64 bit weights, one per cell of a chunk, for a fast vectorized chunk hash
+HASH_WEIGHTS = np.random.default_rng(0x6d797468).integers(0, 2 ** 63, (CHUNK_SIZE, CHUNK_SIZE), dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+EMPTY_CHUNK_HASH = np.einsum("ab,ab->", np.full((CHUNK_SIZE, CHUNK_SIZE), EMPTY, dtype=np.int64).view(np.uint64), HASH_WEIGHTS)
+
+
+def hash_chunks(data:np.ndarray, rows:range=None) -> np.ndarray:
+    # Weighted sum of every chunk's cells modulo 2 ** 64, computed one chunk row at a time
+    height, width = data.shape
+    chunks_y, chunks_x = -(-height // CHUNK_SIZE), -(-width // CHUNK_SIZE)
+    rows = range(chunks_y) if rows is None else rows
+    if isinstance(data, SparseGrid):
+        # Unstored chunks are all empty, only the stored blocks are hashed
+        hashes = np.full((len(rows), chunks_x), EMPTY_CHUNK_HASH, dtype=np.uint64)
+        slots = data.slots[rows.start:rows.stop]
+        stored = slots >= 0
+        blocks = data.blocks[slots[stored]].astype(np.int64).view(np.uint64)
+        hashes[stored] = np.einsum("nab,ab->n", blocks, HASH_WEIGHTS)
+        return hashes
+    hashes = np.zeros((len(rows), chunks_x), dtype=np.uint64)
+    band = np.full((CHUNK_SIZE, chunks_x * CHUNK_SIZE), EMPTY, dtype=np.int64)
+    for i, y in enumerate(rows):
+        source = data[y * CHUNK_SIZE:(y + 1) * CHUNK_SIZE]
+        band[:] = EMPTY
+        band[:source.shape[0], :width] = source
+        blocks = band.view(np.uint64).reshape(CHUNK_SIZE, chunks_x, CHUNK_SIZE)
+        hashes[i] = np.einsum("ayb,ab->y", blocks, HASH_WEIGHTS)
+    return hashes
+
+def contiguous_runs(values:np.ndarray):
+    # (starts, stops) of the runs of consecutive integers in a sorted array
+    if not len(values):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    breaks = np.flatnonzero(np.diff(values) != 1) + 1
+    return values[np.r_[0, breaks]], values[np.r_[breaks - 1, len(values) - 1]] + 1
 
 class Layer:
+    chunk_budget = 24
+    # Chunks render on this worker pool, at most chunk_budget in flight per layer; None renders them in draw instead
+    renderer = chunk_renderer
+    scaled_chunk_budget = 128 * 1024 * 1024
+    # Layers with fewer occupied chunks than sparse_ratio keep only those, and go back to a dense array above dense_ratio
+    sparse_ratio = 0.25
+    dense_ratio = 0.5
         
-    def __init__(self, pos:Vec2, size:Vec2, tileset_properties:TilesetProperties=None, scaling_factor:float=None, offset:Vec2=Vec2(0,0), active:bool=False):
+    def __init__(self, pos:Vec2, size:Vec2, tileset_properties:TilesetProperties=None, scaling_factor:float=None, offset:Vec2=Vec2(0,0), active:bool=False, autotile:bool=False, tilesets:list=None, collision:bool=False):
         self.pos = pos
         self.size = size
-        self.tileset_properties = tileset_properties if tileset_properties else Tile.default_tileset_properties
         self._scaling_factor = scaling_factor if scaling_factor else Tile.default_scaling_factor   
+        tileset_properties = tileset_properties if tileset_properties else Tile.default_tileset_properties
+        # Cells index into this list through their global ids, layers of one map share the map's list
+        self.tilesets = tilesets if tilesets is not None else [tileset_properties]
+        self.tileset_properties = tileset_properties
         self.active = active
         self.offset = offset
-        self.place_holder_tile = Tile(Vec2(0, 0), 2, self.tileset_properties, self.scaling_factor)
-        self.__rect = pygame.Rect(self.pos, self.size.elementwise() * self.tilesize.elementwise())
-        self.__surf = pygame.Surface(self.__rect.size, pygame.SRCALPHA)
-        self.__scaled_surf = pygame.transform.scale_by(self.__surf, self.scaling_factor)
+        self.autotile = autotile
+        # Every tile of a collision layer blocks movement, whatever its tileset says
+        self.collision = collision
+        self.__packed = None
+        self.chunk_index = None
+        self.snapshots = []
+        # The RegionEdit writes are recorded into while the map's history records (see EditHistory.begin)
+        self.edit = None
+        self.__chunk_hashes = None
+        self.__hashed_version = 0
+        self.version = 0
+        self.chunk_versions = np.zeros((-(-int(self.size.y) // CHUNK_SIZE), -(-int(self.size.x) // CHUNK_SIZE)), dtype=np.int64)
+        self.data = SparseGrid((int(self.size.y), int(self.size.x)))
+        self.__scaled_chunks = OrderedDict()
+        self.__scaled_bytes = 0
+        self.__stale_chunks = set()
+        # Frame each cached chunk was last drawn in, for the global memory budget
+        self.__chunk_frames = {}
+        self.__pending = {}
+        # The blits of the last draw, counted by drawn_version each time they change
+        self.__drawn = []
+        self.drawn_version = 0
         
+    def visible_chunks(self, surface:pygame.Surface, origin:Vec2) -> list:
+        # Chunks in view, nearest to the centre of the view first
+        chunk_size = self.tilesize * CHUNK_SIZE * self.scaling_factor
+        chunks_y, chunks_x = self.chunk_versions.shape
+        left = max(int(-origin.x // chunk_size.x), 0)
+        top = max(int(-origin.y // chunk_size.y), 0)
+        right = min(int((surface.get_width() - origin.x) // chunk_size.x) + 1, chunks_x)
+        bottom = min(int((surface.get_height() - origin.y) // chunk_size.y) + 1, chunks_y)
+
+        data = self.data
+        if isinstance(data, SparseGrid):
+            ys, xs = np.nonzero(data.slots[top:bottom, left:right] >= 0)
+            visible = list(zip((xs + left).tolist(), (ys + top).tolist()))
+        else:
+            visible = [(x, y) for y in range(top, bottom) for x in range(left, right)]
+        center = ((left + right) / 2, (top + bottom) / 2)
+        visible.sort(key=lambda chunk: (chunk[0] - center[0]) ** 2 + (chunk[1] - center[1]) ** 2)
+        return visible
+
+    def is_ready(self, chunk) -> bool:
+        return chunk in self.__scaled_chunks and chunk not in self.__stale_chunks
+
+    def prefetch(self, surface:pygame.Surface, offset:Vec2=None) -> bool:
+        # Starts the renders missing from the view without drawing anything, returns whether none are left
+        if offset is None:
+            offset = self.offset
+        self.collect_rendered()
+        missing = [chunk for chunk in self.visible_chunks(surface, self.pos + offset) if not self.is_ready(chunk)]
+        if self.renderer is None:
+            for chunk in missing[:self.chunk_budget]:
+                self.render_scaled_chunk(chunk)
+            return len(missing) <= self.chunk_budget
+        self.submit_chunks(missing)
+        return not missing
+
     def draw(self, surface:pygame.Surface, offset:Vec2=None):
         if offset is None:
             offset = self.offset
-        surface.blit(self.__scaled_surf, self.pos + offset,)
+        origin = self.pos + offset
+        self.collect_rendered()
+        blits = []
+        missing = []
+        frame = memory.frame
+        # Chunks closest to the centre of the view are built first, the rest over the next frames
+        for chunk in self.visible_chunks(surface, origin):
+            if chunk in self.__scaled_chunks:
+                self.__scaled_chunks.move_to_end(chunk)
+                self.__chunk_frames[chunk] = frame
+            if self.is_ready(chunk):
+                scaled = self.__scaled_chunks[chunk]
+                if scaled is not None:
+                    blits.append((scaled, origin + self.scaled_chunk_rect(chunk).topleft))
+            else:
+                missing.append(chunk)
+
+        if self.renderer is None:
+            for chunk in missing[:self.chunk_budget]:
+                scaled = self.render_scaled_chunk(chunk)
+                if scaled is not None:
+                    blits.append((scaled, origin + self.scaled_chunk_rect(chunk).topleft))
+            missing = missing[self.chunk_budget:]
+        else:
+            self.submit_chunks(missing)
+        for chunk in missing:
+            # Edited and rezoomed chunks keep showing their previous render until the new one is ready
+            scaled = self.placeholder_chunk(chunk)
+            if scaled is not None:
+                blits.append((scaled, origin + self.scaled_chunk_rect(chunk).topleft))
+        surface.blits(blits, doreturn=False)
+        if blits != self.__drawn:
+            self.__drawn = blits
+            self.drawn_version += 1
+        self.evict_scaled_chunks()
+
         if self.active:
-            vec_mouse = Vec2(pygame.mouse.get_pos())-offset
+            vec_mouse = Vec2(input_state.mouse_pos())-offset
             tile_size = self.tilesize.elementwise() * self.scaling_factor
             placeholder_pos = vec_mouse - \
                 vec_mouse.elementwise() % tile_size + \
@@ -34,20 +176,513 @@ class Layer:
     
     def draw_tile(self, tile,pos:Vec2=None):
         if pos is None:
-            tile.draw(self.__surf)
-        else:
-            tile.draw(self.__surf, pos)
-        self.render_scaled_surf()
+            pos = tile.pos
+        tileset_id = self.tilesets.index(tile.tileset_properties) if tile.tileset_properties in self.tilesets else self.tileset_id
+        self.set_tiles(pos, np.array([[pack_gid(tileset_id, tile.index)]], dtype=np.int32))
 
     def solid_fill(self):
-        for i in range(int(self.size.x)):
-            for j in range(int(self.size.y)):
-                self.draw_tile(Tile(Vec2(i, j), 16, self.tileset_properties, self.scaling_factor))
+        self.fill_region(pygame.Rect(0, 0, self.size.x, self.size.y), pack_gid(self.tileset_id, 16))
+
+    def clip_region(self, rect:pygame.Rect) -> pygame.Rect:
+        return pygame.Rect(rect).clip(pygame.Rect(0, 0, self.size.x, self.size.y))
+
+    def set_tiles(self, pos:Vec2, indices, mask:np.ndarray=None, autotile:bool=None):
+        x, y = int(pos[0]), int(pos[1])
+        height, width = (indices if mask is None else mask).shape
+        region = self.clip_region(pygame.Rect(x, y, width, height))
+        if not region.width or not region.height:
+            return
+        if autotile is None:
+            autotile = self.autotile
+        autotile = autotile and self.autotile_rules is not None
+        counted = self.clip_region(region.inflate(2, 2)) if autotile else region
+        if self.snapshots:
+            self.preserve_region(counted)
+        if isinstance(self.data, SparseGrid) and counted.width * counted.height > self.dense_ratio * self.data.size:
+            self.__data = self.data.to_dense()
+        before = self.get_tiles(counted)
+        source = (slice(region.top - y, region.bottom - y), slice(region.left - x, region.right - x))
+        values = indices[source] if np.ndim(indices) else indices
+        target = (slice(region.top, region.bottom), slice(region.left, region.right))
+        if mask is None:
+            self.data[target] = values
+        else:
+            self.data[target] = np.where(mask[source], values, self.data[target])
+        if autotile:
+            region = self.autotile_region(region, None if mask is None else mask[source])
+        after = self.data[counted.top:counted.bottom, counted.left:counted.right]
+        ys, xs = np.nonzero(before != after)
+        self.count_changes(before[ys, xs], after[ys, xs], xs + counted.left, ys + counted.top)
+        if self.edit is not None and len(ys):
+            self.edit.record(self, counted, before, np.array(after))
+        self.mark_dirty(region)
+        self.redraw_region(region)
+        self.update_storage()
+
+    def preserve_region(self, region:pygame.Rect):
+        ys, xs = np.mgrid[
+            region.top // CHUNK_SIZE:(region.bottom - 1) // CHUNK_SIZE + 1,
+            region.left // CHUNK_SIZE:(region.right - 1) // CHUNK_SIZE + 1
+        ]
+        self.preserve_chunks(np.stack((xs.ravel(), ys.ravel()), axis=1))
+
+    def preserve_chunks(self, chunks:np.ndarray):
+        # Open snapshots copy a chunk's old content the first time it is about to be overwritten
+        for snapshot in self.snapshots:
+            snapshot.preserve(chunks)
+
+    def mark_dirty(self, region:pygame.Rect):
+        self.version += 1
+        self.chunk_versions[
+            region.top // CHUNK_SIZE:(region.bottom - 1) // CHUNK_SIZE + 1,
+            region.left // CHUNK_SIZE:(region.right - 1) // CHUNK_SIZE + 1
+        ] = self.version
+
+    def mark_chunks(self, chunks:np.ndarray):
+        self.version += 1
+        self.chunk_versions[chunks[:, 1], chunks[:, 0]] = self.version
+
+    def changed_chunks(self, since:int):
+        if since >= self.version:
+            return []
+        return [(int(x), int(y)) for y, x in zip(*np.nonzero(self.chunk_versions > since))]
+
+    def chunk_hashes(self) -> np.ndarray:
+        # Only the chunk rows touched since the last call are hashed again
+        if self.__chunk_hashes is None:
+            self.__chunk_hashes = hash_chunks(self.data)
+        elif self.__hashed_version < self.version:
+            rows = np.flatnonzero((self.chunk_versions > self.__hashed_version).any(axis=1))
+            for start, stop in zip(*contiguous_runs(rows)):
+                self.__chunk_hashes[start:stop] = hash_chunks(self.data, range(start, stop))
+        self.__hashed_version = self.version
+        return self.__chunk_hashes
+
+    def chunk_rect(self, chunk) -> pygame.Rect:
+        return self.clip_region(pygame.Rect(chunk[0] * CHUNK_SIZE, chunk[1] * CHUNK_SIZE, CHUNK_SIZE, CHUNK_SIZE))
+
+    def get_tiles(self, region:pygame.Rect) -> np.ndarray:
+        region = self.clip_region(region)
+        return self.data[region.top:region.bottom, region.left:region.right].copy()
+
+    def fill_region(self, rect:pygame.Rect, index:int=None):
+        if index is None:
+            index = self.selected_gid
+        rect = pygame.Rect(rect)
+        self.set_tiles(rect.topleft, index, np.ones((rect.height, rect.width), dtype=bool))
+
+    def autotile_region(self, region:pygame.Rect, edited:np.ndarray=None) -> pygame.Rect:
+        # Painting a cell changes the pieces of its 8 neighbours, which in turn depend on theirs
+        affected = self.clip_region(region.inflate(2, 2))
+        window = self.clip_region(affected.inflate(2, 2))
+        # Only the cells of the layer's current tileset form the terrain, other tilesets are left alone
+        cells = self.data[window.top:window.bottom, window.left:window.right]
+        terrain = (cells != EMPTY) & (gid_tileset(cells) == self.tileset_id)
+        inner = (
+            slice(affected.top - window.top, affected.bottom - window.top),
+            slice(affected.left - window.left, affected.right - window.left)
+        )
+        target = cells[inner]
+        resolved = np.where(terrain[inner], pack_gid(self.tileset_id, self.autotile_rules.resolve(terrain)[inner]), target)
+        if edited is not None:
+            # Only cells next to an edited one may change, whatever else lies in the bounding box
+            touched = np.zeros(target.shape, dtype=bool)
+            touched[
+                region.top - affected.top:region.bottom - affected.top,
+                region.left - affected.left:region.right - affected.left
+            ] = edited
+            resolved = np.where(dilate(touched), resolved, target)
+        self.data[affected.top:affected.bottom, affected.left:affected.right] = resolved
+        return affected
+
+    def set_cells(self, cells:np.ndarray, index, autotile:bool=None):
+        # index is one global id for every cell, or one per cell
+        cells = np.asarray(cells, dtype=np.int64).reshape(-1, 2)
+        width, height = self.data.shape[1], self.data.shape[0]
+        inside = (cells[:, 0] >= 0) & (cells[:, 0] < width) & (cells[:, 1] >= 0) & (cells[:, 1] < height)
+        cells = cells[inside]
+        if np.ndim(index):
+            index = np.asarray(index)[inside]
+        if not len(cells):
+            return
+        xs, ys = cells[:, 0], cells[:, 1]
+        if autotile is None:
+            autotile = self.autotile
+        autotile = autotile and self.autotile_rules is not None
+        if autotile:
+            touched_xs = np.clip((xs[:, None] + (-1, -1, -1, 0, 0, 0, 1, 1, 1)).ravel(), 0, width - 1)
+            touched_ys = np.clip((ys[:, None] + (-1, 0, 1, -1, 0, 1, -1, 0, 1)).ravel(), 0, height - 1)
+        else:
+            touched_xs, touched_ys = xs, ys
+        touched_ys, touched_xs = np.divmod(np.unique(touched_ys * width + touched_xs), width)
+        chunks_x = self.chunk_versions.shape[1]
+        ids = np.unique((touched_ys // CHUNK_SIZE) * chunks_x + touched_xs // CHUNK_SIZE)
+        chunks = np.stack((ids % chunks_x, ids // chunks_x), axis=1)
+        if self.snapshots:
+            self.preserve_chunks(chunks)
+        before = self.data[touched_ys, touched_xs]
+        self.data[ys, xs] = index
+        if autotile:
+            left, top = int(xs.min()), int(ys.min())
+            region = pygame.Rect(left, top, int(xs.max()) - left + 1, int(ys.max()) - top + 1)
+            edited = np.zeros((region.height, region.width), dtype=bool)
+            edited[ys - top, xs - left] = True
+            self.autotile_region(region, edited)
+        after = self.data[touched_ys, touched_xs]
+        changed = before != after
+        self.count_changes(before[changed], after[changed], touched_xs[changed], touched_ys[changed])
+        if self.edit is not None and changed.any():
+            self.edit.record_cells(self, np.stack((touched_xs[changed], touched_ys[changed]), axis=1), before[changed], after[changed])
+        self.mark_chunks(chunks)
+        self.redraw_chunks(chunks)
+        self.update_storage()
+
+    def count_changes(self, before:np.ndarray, after:np.ndarray, xs:np.ndarray, ys:np.ndarray):
+        # Keeps the tile histogram (and the per-chunk inverted index, if enabled) in step with a write
+        if not len(before):
+            return
+        self.add_to_histogram(before, -1)
+        self.add_to_histogram(after, 1)
+        if self.chunk_index is not None:
+            self.add_to_chunk_index(before, xs, ys, -1)
+            self.add_to_chunk_index(after, xs, ys, 1)
+
+    def add_to_histogram(self, values:np.ndarray, sign:int):
+        counts = np.bincount(values.ravel() + 1)
+        if len(counts) > len(self.histogram):
+            self.histogram = np.pad(self.histogram, (0, len(counts) - len(self.histogram)))
+        self.histogram[:len(counts)] += sign * counts
+
+    def add_to_chunk_index(self, values:np.ndarray, xs:np.ndarray, ys:np.ndarray, sign:int):
+        chunks_x = self.chunk_versions.shape[1]
+        chunk_count = self.chunk_versions.size
+        ids = (ys.ravel() // CHUNK_SIZE) * chunks_x + xs.ravel() // CHUNK_SIZE
+        keys, counts = np.unique((values.ravel().astype(np.int64) + 1) * chunk_count + ids, return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            index, chunk_id = divmod(key, chunk_count)
+            chunk = (chunk_id % chunks_x, chunk_id // chunks_x)
+            chunks = self.chunk_index.setdefault(index - 1, {})
+            total = chunks.get(chunk, 0) + sign * count
+            if total:
+                chunks[chunk] = total
+            else:
+                chunks.pop(chunk, None)
+                if not chunks:
+                    del self.chunk_index[index - 1]
+
+    def track_positions(self, enabled:bool=True):
+        if not enabled:
+            self.chunk_index = None
+            return
+        self.chunk_index = {}
+        data = np.asarray(self.data)
+        ys, xs = np.indices(data.shape)
+        self.add_to_chunk_index(data, xs, ys, 1)
+
+    def count(self, index:int) -> int:
+        if index + 1 >= len(self.histogram):
+            return 0
+        return int(self.histogram[index + 1])
+
+    def find(self, index:int) -> np.ndarray:
+        if not self.count(index):
+            return np.empty((0, 2), dtype=np.int64)
+        chunks = self.chunk_index.get(index, {}) if self.chunk_index is not None else None
+        if chunks is None or len(chunks) * 4 > self.chunk_versions.size:
+            data = self.data
+            ys, xs = data.find(index) if isinstance(data, SparseGrid) else np.nonzero(data == index)
+            return np.stack((xs, ys), axis=1)
+        found = []
+        for chunk in chunks:
+            region = self.chunk_rect(chunk)
+            ys, xs = np.nonzero(self.data[region.top:region.bottom, region.left:region.right] == index)
+            found.append(np.stack((xs + region.left, ys + region.top), axis=1))
+        return np.concatenate(found)
+
+    def replace_all(self, old:int, new:int) -> int:
+        if old == new:
+            return 0
+        positions = self.find(old)
+        if not len(positions):
+            return 0
+        xs, ys = positions[:, 0], positions[:, 1]
+        chunks_x = self.chunk_versions.shape[1]
+        ids = np.flatnonzero(np.bincount((ys // CHUNK_SIZE) * chunks_x + xs // CHUNK_SIZE))
+        chunks = np.stack((ids % chunks_x, ids // chunks_x), axis=1)
+        if self.snapshots:
+            self.preserve_chunks(chunks)
+        self.data[ys, xs] = new
+        if self.edit is not None:
+            self.edit.record_cells(self, positions, np.full(len(xs), old, dtype=np.int32), np.full(len(xs), new, dtype=np.int32))
+        self.add_to_histogram(np.array([old]), -len(xs))
+        self.add_to_histogram(np.array([new]), len(xs))
+        if self.chunk_index is not None:
+            moved = self.chunk_index.pop(old)
+            target = self.chunk_index.setdefault(new, {})
+            for chunk, count in moved.items():
+                target[chunk] = target.get(chunk, 0) + count
+        self.mark_chunks(chunks)
+        self.redraw_chunks(chunks)
+        self.update_storage()
+        return len(xs)
+
+    def redraw_region(self, region:pygame.Rect):
+        for y in range(region.top // CHUNK_SIZE, (region.bottom - 1) // CHUNK_SIZE + 1):
+            for x in range(region.left // CHUNK_SIZE, (region.right - 1) // CHUNK_SIZE + 1):
+                if (x, y) in self.__scaled_chunks:
+                    self.__stale_chunks.add((x, y))
+
+    def redraw_chunks(self, chunks:np.ndarray):
+        if len(chunks) <= len(self.__scaled_chunks):
+            for x, y in chunks.tolist():
+                if (x, y) in self.__scaled_chunks:
+                    self.__stale_chunks.add((x, y))
+            return
+        edited = np.zeros(self.chunk_versions.shape, dtype=bool)
+        edited[chunks[:, 1], chunks[:, 0]] = True
+        for x, y in self.__scaled_chunks:
+            if edited[y, x]:
+                self.__stale_chunks.add((x, y))
+
+    def render_chunk(self, chunk) -> pygame.Surface:
+        region = self.chunk_rect(chunk)
+        block = self.data[region.top:region.bottom, region.left:region.right]
+        if (block == EMPTY).all():
+            return None
+        table = self.gid_table
+        surfaces, rects, _ = tiles = table.tiles
+        return render_tiles(surfaces, rects, table.visible(block, tiles).tolist(), tuple(self.tilesize))
+
+    @property
+    def gid_table(self):
+        return gid_table(self.tilesets)
+
+    @property
+    def tileset_properties(self) -> TilesetProperties:
+        return self.__tileset_properties
+
+    @tileset_properties.setter
+    def tileset_properties(self, value:TilesetProperties):
+        # The tileset new tiles are painted and autotiled with; cells keep whichever tileset they were painted from
+        if value not in self.tilesets:
+            self.tilesets.append(value)
+        self.__tileset_properties = value
+        self.autotile_rules = AutotileRules.for_tileset(value)
+        index = self.place_holder_tile.index if hasattr(self, "place_holder_tile") else 2
+        self.place_holder_tile = Tile(Vec2(0, 0), min(max(index, 0), value.tile_count - 1), value, self.scaling_factor)
+
+    @property
+    def tileset_id(self) -> int:
+        return self.tilesets.index(self.tileset_properties)
+
+    def rebind_tilesets(self, tilesets:list):
+        # Moves the layer onto another tilesets list, renumbering the global ids of its cells
+        if tilesets is self.tilesets:
+            return
+        for tileset in self.tilesets:
+            if tileset not in tilesets:
+                tilesets.append(tileset)
+        mapping = np.array([tilesets.index(tileset) for tileset in self.tilesets], dtype=np.int32)
+        self.tilesets = tilesets
+        if (mapping != np.arange(len(mapping))).any():
+            data = np.asarray(self.data)
+            filled = data != EMPTY
+            tileset_ids = mapping[gid_tileset(np.where(filled, data, 0))]
+            self.data = np.where(filled, (tileset_ids << TILE_BITS) | gid_index(data), EMPTY).astype(np.int32)
+            self.mark_dirty(pygame.Rect(0, 0, self.size.x, self.size.y))
+            self.clear_scaled_chunks()
+
+    def reload_tileset(self, tileset:TilesetProperties):
+        # Re-renders only the cached chunks holding tiles of the reloaded tileset
+        if tileset is self.tileset_properties:
+            self.place_holder_tile.image = tileset.tileset
+        if tileset not in self.tilesets:
+            return
+        tileset_id = self.tilesets.index(tileset)
+        if not self.histogram[(tileset_id << TILE_BITS) + 1:((tileset_id + 1) << TILE_BITS) + 1].any():
+            return
+        self.cancel_pending()
+        for chunk in list(self.__scaled_chunks):
+            region = self.chunk_rect(chunk)
+            block = self.data[region.top:region.bottom, region.left:region.right]
+            if ((block != EMPTY) & (gid_tileset(block) == tileset_id)).any():
+                self.__stale_chunks.add(chunk)
+
+    def scaled_chunk_rect(self, chunk) -> pygame.Rect:
+        region = self.chunk_rect(chunk)
+        scale_x = self.tilesize.x * self.scaling_factor
+        scale_y = self.tilesize.y * self.scaling_factor
+        left, top = round(region.left * scale_x), round(region.top * scale_y)
+        return pygame.Rect(left, top, round(region.right * scale_x) - left, round(region.bottom * scale_y) - top)
+
+    def scaled_chunk_size(self, chunk) -> tuple:
+        width, height = self.scaled_chunk_rect(chunk).size
+        return max(width, 1), max(height, 1)
+
+    def render_scaled_chunk(self, chunk) -> pygame.Surface:
+        surf = self.render_chunk(chunk)
+        scaled = None
+        if surf is not None:
+            scaled = pygame.transform.scale(surf, self.scaled_chunk_size(chunk))
+        self.store_scaled_chunk(chunk, scaled)
+        return scaled
+
+    def store_scaled_chunk(self, chunk, scaled:pygame.Surface, stale:bool=False):
+        self.discard_scaled_chunk(chunk)
+        self.__scaled_chunks[chunk] = scaled
+        self.__chunk_frames[chunk] = memory.frame
+        if scaled is not None:
+            self.__scaled_bytes += surface_bytes(scaled)
+        if stale:
+            self.__stale_chunks.add(chunk)
+
+    def submit_chunks(self, chunks:list):
+        # Chunks are queued in the given order, nearest to the view centre first
+        for chunk in chunks:
+            if len(self.__pending) >= self.chunk_budget:
+                break
+            if chunk in self.__pending:
+                continue
+            region = self.chunk_rect(chunk)
+            # A copy: dense layers hand out views, which strokes would keep writing to while the worker reads them
+            block = np.array(self.data[region.top:region.bottom, region.left:region.right])
+            if (block == EMPTY).all():
+                self.store_scaled_chunk(chunk, None)
+                continue
+            future = self.renderer.submit(self.gid_table, block, tuple(self.tilesize), self.scaled_chunk_size(chunk))
+            self.__pending[chunk] = (future, self.chunk_versions[chunk[1], chunk[0]])
+
+    def collect_rendered(self):
+        for chunk, (future, version) in list(self.__pending.items()):
+            if future.done():
+                del self.__pending[chunk]
+                # A chunk edited while it rendered is shown but queued again
+                self.store_scaled_chunk(chunk, future.result(), stale=self.chunk_versions[chunk[1], chunk[0]] != version)
+
+    def cancel_pending(self):
+        for future, _ in self.__pending.values():
+            future.cancel()
+        self.__pending.clear()
+
+    @property
+    def rendering(self) -> bool:
+        return bool(self.__pending)
+
+    def placeholder_chunk(self, chunk) -> pygame.Surface:
+        # The chunk's previous render, stretched to the current zoom with a cheap nearest neighbour scale
+        scaled = self.__scaled_chunks.get(chunk)
+        size = self.scaled_chunk_size(chunk)
+        if scaled is not None and scaled.get_size() != size:
+            scaled = pygame.transform.scale(scaled, size)
+            self.store_scaled_chunk(chunk, scaled, stale=True)
+        return scaled
+
+    def discard_scaled_chunk(self, chunk):
+        self.__stale_chunks.discard(chunk)
+        self.__chunk_frames.pop(chunk, None)
+        scaled = self.__scaled_chunks.pop(chunk, None)
+        if scaled is not None:
+            self.__scaled_bytes -= surface_bytes(scaled)
+        return scaled
+
+    def evict_scaled_chunks(self, budget:int=None):
+        budget = self.scaled_chunk_budget if budget is None else budget
+        while self.__scaled_bytes > budget and self.__scaled_chunks:
+            self.discard_scaled_chunk(next(iter(self.__scaled_chunks)))
+
+    def clear_scaled_chunks(self):
+        self.cancel_pending()
+        self.__scaled_chunks.clear()
+        self.__stale_chunks.clear()
+        self.__chunk_frames.clear()
+        self.__scaled_bytes = 0
+        self.__drawn = []
+
+    def memory_usage(self) -> dict:
+        return {"tiles": self.nbytes, "chunks": self.__scaled_bytes}
+
+    def lru_tick(self):
+        if not self.__scaled_chunks:
+            return None
+        return self.__chunk_frames.get(next(iter(self.__scaled_chunks)), 0)
+
+    def evict_lru(self) -> int:
+        scaled = self.discard_scaled_chunk(next(iter(self.__scaled_chunks)))
+        return 0 if scaled is None else surface_bytes(scaled)
+
+    @property
+    def data(self) -> np.ndarray:
+        if self.__packed is not None:
+            self.wake()
+        return self.__data
+
+    @data.setter
+    def data(self, value):
+        # Either a dense int32 array or a SparseGrid, whichever suits the fill ratio is kept
+        self.__packed = None
+        self.__data = value
+        self.__chunk_hashes = None
+        self.histogram = value.histogram() if isinstance(value, SparseGrid) else np.bincount(value.ravel() + 1)
+        if self.chunk_index is not None:
+            self.track_positions()
+        self.update_storage()
+
+    @property
+    def sparse(self) -> bool:
+        return isinstance(self.data, SparseGrid)
+
+    def update_storage(self):
+        data = self.data
+        chunk_count = self.chunk_versions.size
+        if isinstance(data, SparseGrid):
+            if data.chunk_count > self.dense_ratio * chunk_count:
+                self.__data = data.to_dense()
+        elif data.size - self.histogram[0] < self.sparse_ratio * data.size:
+            # Few filled cells is cheap to check; only then are the chunks themselves counted
+            if np.count_nonzero(self.chunk_hashes() != EMPTY_CHUNK_HASH) < self.sparse_ratio * chunk_count:
+                self.__data = SparseGrid.from_dense(data)
+
+    @property
+    def nbytes(self) -> int:
+        if self.__packed is not None:
+            return len(self.__packed[0])
+        return self.__data.nbytes
+
+    @property
+    def hibernated(self):
+        return self.__packed is not None
 
-    def random_fill(self):
-        for i in range(int(self.size.x)):
-            for j in range(int(self.size.y)):
-                self.draw_tile(Tile(Vec2(i, j), random.randint(0, 49), self.tileset_properties, self.scaling_factor))
+    def hibernate(self):
+        # Only the tile indices survive, narrowed and compressed; surfaces are rebuilt from them on wake
+        if self.__packed is not None:
+            return
+        self.clear_scaled_chunks()
+        data = self.__data
+        chunks = None
+        if isinstance(data, SparseGrid):
+            chunks = data.occupied()
+            values = data.blocks[data.slots[chunks[:, 1], chunks[:, 0]]]
+        else:
+            values = data
+        dtype = np.int16 if values.max(initial=EMPTY) < np.iinfo(np.int16).max else np.int32
+        self.__packed = (zlib.compress(values.astype(dtype).tobytes(), 1), dtype, data.shape, chunks)
+        self.__data = None
+
+    def wake(self):
+        if self.__packed is None:
+            return
+        packed, dtype, shape, chunks = self.__packed
+        self.__packed = None
+        values = np.frombuffer(zlib.decompress(packed), dtype=dtype).astype(np.int32)
+        if chunks is None:
+            self.__data = values.reshape(shape)
+        else:
+            self.__data = SparseGrid.from_chunks(shape, chunks, values.reshape(-1, CHUNK_SIZE, CHUNK_SIZE))
+
+    def random_fill(self, seed:int=None):
+        rng = np.random.default_rng(seed)
+        tiles = rng.integers(0, self.tileset_properties.tile_count, (int(self.size.y), int(self.size.x)), dtype=np.int32)
+        self.set_tiles((0, 0), pack_gid(self.tileset_id, tiles), autotile=False)
 
     def update(self):
         pass
@@ -61,32 +696,49 @@ class Layer:
         value = max(0.01, value)
         self._scaling_factor = value
         self.place_holder_tile.scaling_factor = value
-        self.render_scaled_surf()
+        # Cached chunks stay on screen as placeholders until they are rendered again at the new zoom
+        self.cancel_pending()
+        self.__stale_chunks.update(self.__scaled_chunks)
 
     @property
     def selected_index(self):
         return self.place_holder_tile.index
-    
+
     @selected_index.setter
     def selected_index(self, value):
         self.place_holder_tile.index = value
 
-    def render_scaled_surf(self):
-        self.__scaled_surf = pygame.transform.scale_by(self.__surf, self.scaling_factor)
+    @property
+    def selected_gid(self):
+        return pack_gid(self.tileset_id, self.selected_index)
 
-    def add_tile(self,tile:Tile=None,offset:Vec2=None):
+    def mouse_cell(self,offset:Vec2=None) -> Vec2:
+        return self.cell_at(input_state.mouse_pos(), offset)
+
+    def cell_at(self,screen_pos:Vec2,offset:Vec2=None) -> Vec2:
+        if offset is None:
+            offset = self.offset
+        vec_mouse = Vec2(screen_pos)-offset-self.pos
+        tile_size = self.tilesize.elementwise() * self.scaling_factor
+        return ((vec_mouse - \
+                vec_mouse.elementwise() % tile_size).elementwise() / self.scaling_factor \
+            ).elementwise() // self.tilesize
+
+    def screen_rect(self,region:pygame.Rect,offset:Vec2=None) -> pygame.Rect:
         if offset is None:
             offset = self.offset
+        tile_size = self.tilesize.elementwise() * self.scaling_factor
+        top_left = Vec2(region.topleft).elementwise() * tile_size + offset + self.pos
+        return pygame.Rect(top_left, Vec2(region.size).elementwise() * tile_size)
+
+    def add_tile(self,tile:Tile=None,offset:Vec2=None):
         if tile:
             self.draw_tile(tile)
         else:
-            vec_mouse = Vec2(pygame.mouse.get_pos())-offset
-            tile_size = self.tilesize.elementwise() * self.scaling_factor
-            placeholder_pos = ((vec_mouse - \
-                    vec_mouse.elementwise() % tile_size).elementwise() / self.scaling_factor \
-                ).elementwise() // self.tilesize
-        
-            self.draw_tile(self.place_holder_tile,pos=placeholder_pos)
+            self.draw_tile(self.place_holder_tile,pos=self.mouse_cell(offset))
+
+    def remove_tile(self,offset:Vec2=None):
+        self.set_tiles(self.mouse_cell(offset), np.array([[EMPTY]], dtype=np.int32))
 
     @property
     def tilesize(self):
@@ -159,6 +811,9 @@ if __name__ == "__main__":
                     
                 elif event.key == K_DOWN:
                     layers[selected_layer].selected_index -= 1
+                
+                elif event.key == K_a:
+                    layers[selected_layer].autotile = not layers[selected_layer].autotile
                     
         for layer in layers:
             layer.update()
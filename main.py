@@ -2,10 +2,30 @@ import pygame
 from pygame.locals import *
 from pygame.math import Vector2 as Vec2
 
+import glob
+import os
+import sys
+
 from mapClass import Map
+from map_file import MapSaver, SAVE_DONE, load_map
+from layer import EMPTY
+from stroke import Stroke
+from shapes import SHAPES, mask_outline, shape_mask
+from selection import SelectionTool
+from nav_grid import PathTool
+from terrain import generate_layer
+from tileset import TilesetProperties, pack_gid, tile_atlas
 from button import TextButton, ImgButton
+from ui_layer import UiLayer
 from tile_picker import TilePicker
+from minimap import Minimap
+from tileset_watcher import TilesetWatcher, TILESET_CHANGED
 from file_picker import FilePicker
+from map_browser import MapBrowser
+from memory import memory, MB
+from chunk_renderer import chunk_renderer
+from input_state import input_state
+from replay import EventRecorder
 
 class Main():
     def __init__(self, 
@@ -17,17 +37,32 @@ class Main():
         self.display = pygame.display.set_mode(size, RESIZABLE)
         self.clock = clock
         self.ui = []
+        self.toolbar = UiLayer()
         self.maps = []
         self.current_map_index = None
+        self.tilesets = []
+        self.tileset_watcher = TilesetWatcher(self.tilesets)
+        self.hibernate_delay = 5000
+        self.map_deactivated_at = {}
+        self.saver = MapSaver()
+        self.file_picker = None
+        self.map_browser = None
+        self.thumbnail_dir = "thumbnails"
+        self.map_filetypes = [("Mythscape map", "*.mythmap"), ("All files", "*.*")]
+        self.autosave_dir = "autosave"
+        self.autosave_interval = 60000
+        self.autosave_event = pygame.event.custom_type()
+        self.autosaved_versions = {}
         self.windowed_size = size
         self.screen_size = screen_size
         self.running = False
+        self.recorder = None
         
         self.primary_color = (8,112,194)
         self.text_color = (255,255,255)
         self.bg_color = (32,32,32)
         self.h_bg_color = (45,45,45)
-        self.font=pygame.font.Font("Assets/RetroGaming.ttf", 13)
+        self.font=pygame.font.Font("assets/RetroGaming.ttf", 13)
         
         self.config_file = config_file
         
@@ -42,8 +77,26 @@ class Main():
             "brush": 0,
             "eraser": 1,
             "bucket": 2,
-            "cursor": 3
+            "cursor": 3,
+            "rectangle": 4,
+            "rectangle_outline": 5,
+            "circle": 6,
+            "stamp": 7,
+            "path": 8
         }
+        self.current_tool = "brush"
+        self.stroke = None
+        self.brush_size = 1
+        self.shape_start = None
+        self.tile_picker = None
+        self.minimap = None
+        self.selection = None
+        self.path_tool = None
+        self.terrain_seed = 0
+        self.show_memory = False
+        # Message shown at the bottom of the window until its tick, for errors a print would hide in a windowed app
+        self.status = None
+        self.status_duration = 6000
         
         
         self.setup()
@@ -51,6 +104,7 @@ class Main():
     
     def setup(self):
         self.load_config()
+        self.setup_autosave()
         self.setup_ui()
         self.setup_map()
     
@@ -58,15 +112,19 @@ class Main():
         if self.config_file=="": return
         pass
     
+    def setup_autosave(self):
+        pygame.time.set_timer(self.autosave_event, self.autosave_interval)
+    
     def setup_ui(self):
         self.setup_toolbar()
+        self.ui.append(self.toolbar)
     
     def setup_toolbar(self):
         # Top toolbar
         top_btn_width = 80
         top_btn_height = 30
         for i, name in enumerate(self.top_toolbar_actions.keys()):
-            self.ui.append(TextButton(
+            self.toolbar.add(TextButton(
                 font=self.font,
                 text=name,
                 rect=pygame.Rect(i*top_btn_width, 0, top_btn_width, top_btn_height),
@@ -85,8 +143,8 @@ class Main():
         btn_side = 40
         fill=btn_side*(1/4)
         for i, name in enumerate(self.tools.keys()):
-            self.ui.append(ImgButton(
-                img=pygame.image.load(f"Assets/UI/{name}.png"),
+            self.toolbar.add(ImgButton(
+                img=self.tool_icon(name),
                 rect=pygame.Rect(i*(btn_side+btn_spacing)+btn_margin.x, top_btn_height+btn_margin.y, btn_side, btn_side),
                 callback=self.tool_select_callback,
                 spacing=Vec2(fill, fill),
@@ -94,11 +152,155 @@ class Main():
                 h_bg_color=self.h_bg_color,
                 name=name
                 ))
+    def tool_icon(self, name:str) -> pygame.Surface:
+        path = f"assets/UI/{name}.png"
+        if os.path.exists(path):
+            return pygame.image.load(path)
+        icon = pygame.Surface((16,16), SRCALPHA)
+        if name == "rectangle":
+            pygame.draw.rect(icon, self.text_color, (2,3,12,10))
+        elif name == "rectangle_outline":
+            pygame.draw.rect(icon, self.text_color, (2,3,12,10), 2)
+        elif name == "circle":
+            pygame.draw.circle(icon, self.text_color, (8,8), 6)
+        elif name == "stamp":
+            for x, y in ((2,2),(9,2),(2,9),(9,9)):
+                pygame.draw.rect(icon, self.text_color, (x,y,5,5))
+        elif name == "path":
+            pygame.draw.lines(icon, self.text_color, False, ((2,13),(6,5),(10,11),(14,3)), 2)
+        else:
+            # A tool without an icon of its own still gets a visible button: its initial in a box
+            pygame.draw.rect(icon, self.text_color, icon.get_rect(), 1)
+            letter = self.font.render(name[:1].upper(), True, self.text_color)
+            icon.blit(letter, letter.get_rect(center=icon.get_rect().center))
+        return icon
+    
     def setup_map(self):
-        pass
+        self.load_tilesets()
+        self.setup_tile_picker()
+        self.tileset_watcher.start()
+    
+    def setup_tile_picker(self):
+        if not self.tilesets:
+            return
+        
+        def tile_picked(picker):
+            if self.active_layer is not None:
+                self.active_layer.tileset_properties = picker.tileset
+                self.active_layer.selected_index = picker.value
+        
+        self.tile_picker = TilePicker(
+            self.tile_picker_rect(self.display.get_width()),
+            self.tilesets[0],
+            callback=tile_picked
+        )
+        self.ui.append(self.tile_picker)
+    
+    def tile_picker_rect(self, width:int) -> pygame.Rect:
+        return pygame.Rect(width-340, 100, 320, 160)
+    
+    def minimap_rect(self, width:int) -> pygame.Rect:
+        return pygame.Rect(width-220, 280, 200, 200)
+    
+    def load_tilesets(self, root:str="assets/Biome/Foreground/"):
+        for path in sorted(glob.glob(root+"*/*.png")):
+            self.tilesets.append(TilesetProperties(
+                name=".".join(path[len(root):].split(".")[:-1]).replace("/"," "),
+                tilesize=Vec2(16,16),
+                tilemargin=Vec2(0,0),
+                tilespacing=Vec2(0,0),
+                tileset=pygame.image.load(path),
+                color=pygame.Color(0,0,0,0),
+                path=path
+                ))
+        # Packed in one go, so the atlas starts out as one sheet per tile size
+        tile_atlas.import_tilesets(self.tilesets)
+    
+    @property
+    def current_map(self):
+        if self.current_map_index is None:
+            return None
+        return self.maps[self.current_map_index]
+    
+    def add_map(self, tile_map:Map):
+        self.maps.append(tile_map)
+        self.switch_map(len(self.maps) - 1)
+    
+    def switch_map(self, index:int):
+        if self.current_map is not None:
+            self.current_map.history.end()
+            self.map_deactivated_at[id(self.current_map)] = input_state.get_ticks()
+        self.current_map_index = index
+        self.map_deactivated_at.pop(id(self.current_map), None)
+        previous = self.selection
+        self.selection = SelectionTool(self.current_map, color=self.primary_color)
+        if self.minimap is None:
+            self.minimap = Minimap(self.minimap_rect(self.display.get_width()), self.current_map)
+            self.ui.append(self.minimap)
+        else:
+            self.minimap.set_map(self.current_map)
+        if previous is not None:
+            self.selection.take_clipboard(previous)
+        self.path_tool = PathTool(self.current_map, color=self.primary_color)
+    
+    def hibernate_inactive_maps(self):
+        now = input_state.get_ticks()
+        for tile_map in self.maps:
+            deactivated_at = self.map_deactivated_at.get(id(tile_map))
+            if deactivated_at is None or tile_map.hibernated:
+                continue
+            if now - deactivated_at >= self.hibernate_delay:
+                tile_map.hibernate()
     
     def tool_select_callback(self, button):
-        print(f"Clicked on: {button.name}")
+        self.current_tool = button.name
+    
+    @property
+    def active_layer(self):
+        if self.current_map is None or not self.current_map.is_tile_layer_active:
+            return None
+        return self.current_map.layers[self.current_map.active_layer]
+    
+    def on_map_click(self, event):
+        if event.button != 1 or self.current_map is None:
+            return
+        if self.current_tool == "cursor":
+            self.selection.press(event.pos)
+            return
+        if self.current_tool == "path":
+            self.path_tool.press(event.pos)
+            return
+        if self.active_layer is None:
+            return
+        layer = self.active_layer
+        if self.current_tool in ("brush", "eraser"):
+            # The whole stroke, up to the release, is undone at once
+            self.current_map.history.begin(self.current_map.layers)
+            self.stroke = Stroke(layer, EMPTY if self.current_tool == "eraser" else None, self.brush_size)
+            self.stroke.add_point(event.pos)
+        elif self.current_tool in SHAPES:
+            self.shape_start = layer.cell_at(event.pos)
+        elif self.current_tool == "stamp" and self.tile_picker is not None:
+            layer.tileset_properties = self.tile_picker.tileset
+            with self.current_map.history.recorded(self.current_map.layers):
+                layer.set_tiles(layer.cell_at(event.pos), pack_gid(layer.tileset_id, self.tile_picker.stamp))
+    
+    def on_map_release(self, event):
+        if event.button != 1:
+            return
+        if self.current_tool == "cursor" and self.selection:
+            self.selection.release(event.pos)
+        if self.stroke:
+            self.stroke.flush()
+            self.stroke = None
+            self.current_map.history.end()
+        if self.shape_start is not None:
+            layer = self.active_layer
+            if layer is not None:
+                rect, mask = shape_mask(self.current_tool, self.shape_start, layer.cell_at(event.pos))
+                with self.current_map.history.recorded(self.current_map.layers):
+                    layer.set_tiles(rect.topleft, layer.selected_gid, mask)
+            self.shape_start = None
     
     def run(self):
         self.running = True
@@ -108,53 +310,288 @@ class Main():
             self.draw()
             pygame.display.flip()
             self.clock.tick(60)
+        self.shutdown()
+        chunk_renderer.shutdown()
+
+    def shutdown(self):
+        self.saver.shutdown()
+        self.tileset_watcher.stop()
+        if self.map_browser is not None:
+            self.map_browser.shutdown()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def start_recording(self, path:str):
+        # Everything process_events sees from here on is written to path, for replay.py
+        self.recorder = EventRecorder(path, self.display.get_size())
+    
+    def on_edit_shortcut(self, key):
+        if self.current_map is None:
+            return
+        editing = self.stroke is not None or self.shape_start is not None
+        if key == K_z and not editing:
+            self.current_map.history.undo()
+        elif key == K_y and not editing:
+            self.current_map.history.redo()
+        elif key == K_c:
+            self.selection.copy()
+        elif key == K_x:
+            self.selection.cut()
+        elif key == K_v:
+            self.current_tool = "cursor"
+            self.selection.paste(input_state.mouse_pos())
+    
+    def cycle_tileset(self):
+        index = (self.tilesets.index(self.tile_picker.tileset) + 1) % len(self.tilesets)
+        self.tile_picker.set_tileset(self.tilesets[index])
+        if self.active_layer is not None:
+            self.active_layer.tileset_properties = self.tilesets[index]
+    
+    def on_tileset_changed(self, event):
+        tileset = event.tileset
+        tileset.tileset = event.surface
+        for tile_map in self.maps:
+            if tileset in tile_map.tilesets:
+                tile_map.reload_tileset(tileset)
+        if self.tile_picker is not None and self.tile_picker.tileset is tileset:
+            self.tile_picker.reload_tileset()
+    
+    def generate_terrain(self):
+        with self.current_map.history.recorded(self.current_map.layers):
+            generate_layer(self.active_layer, self.terrain_seed)
+        self.terrain_seed += 1
     
     def process_events(self):
-        for event in pygame.event.get():
+        events = pygame.event.get()
+        if self.recorder is not None:
+            self.recorder.record(events)
+        for event in events:
+            input_state.feed(event)
+            if self.map_browser is not None and self.map_browser.handle_event(event):
+                continue
             if event.type == QUIT:
                 self.running = False
             elif event.type == VIDEORESIZE:
                 if not self.display.get_flags() & FULLSCREEN:
                     self.windowed_size = event.size
+                if self.tile_picker is not None:
+                    self.tile_picker.rect = self.tile_picker_rect(event.size[0])
+                if self.minimap is not None:
+                    self.minimap.rect = self.minimap_rect(event.size[0])
             elif event.type == KEYDOWN:
                 if event.key == K_F11:
                     if self.display.get_flags() & FULLSCREEN:
                         self.display = pygame.display.set_mode(self.windowed_size, RESIZABLE)
                     else:
                         self.display = pygame.display.set_mode(self.screen_size, FULLSCREEN)
+                elif event.key == K_F3:
+                    self.show_memory = not self.show_memory
+                elif event.key in (K_c, K_x, K_v, K_z, K_y) and event.mod & KMOD_CTRL:
+                    self.on_edit_shortcut(event.key)
+                elif event.key == K_RETURN and self.selection:
+                    self.selection.commit()
+                elif event.key == K_ESCAPE and self.current_tool == "path" and self.path_tool:
+                    self.path_tool.cancel()
+                elif event.key == K_ESCAPE and self.selection:
+                    self.selection.cancel()
+                elif event.key == K_h and self.path_tool:
+                    self.path_tool.show_heatmap = not self.path_tool.show_heatmap
+                elif event.key == K_k and self.active_layer is not None:
+                    self.active_layer.collision = not self.active_layer.collision
+                elif event.key == K_l and self.selection:
+                    self.selection.all_layers = not self.selection.all_layers
+                elif event.key == K_RIGHTBRACKET:
+                    self.brush_size += 1
+                elif event.key == K_LEFTBRACKET:
+                    self.brush_size = max(self.brush_size - 1, 1)
+                elif event.key == K_g and self.active_layer is not None:
+                    self.generate_terrain()
+                elif event.key == K_TAB and self.tile_picker is not None:
+                    self.cycle_tileset()
             elif event.type == MOUSEBUTTONDOWN:
                 for ui in self.ui:
                     if ui.on_click():
                         break
+                else:
+                    self.on_map_click(event)
+            elif event.type == MOUSEMOTION:
+                if self.stroke:
+                    self.stroke.add_point(event.pos)
+                if self.current_tool == "cursor" and self.selection and event.buttons[0]:
+                    self.selection.motion(event.pos)
+                if self.current_tool == "path" and self.path_tool:
+                    self.path_tool.motion(event.pos)
+            elif event.type == MOUSEBUTTONUP:
+                self.on_map_release(event)
+            elif event.type == MOUSEWHEEL and self.current_map is not None:
+                if self.tile_picker is None or not self.tile_picker.rect.collidepoint(input_state.mouse_pos()):
+                    self.current_map.zoom_at(input_state.mouse_pos(), 1.1 ** event.y)
+            elif event.type == SAVE_DONE:
+                self.on_save_done(event)
+            elif event.type == TILESET_CHANGED:
+                self.on_tileset_changed(event)
+            elif event.type == self.autosave_event:
+                self.autosave()
         
         
     def update(self):
+        if self.map_browser is not None:
+            self.map_browser.update()
         for ui in self.ui:
             ui.update()
+        if self.stroke:
+            self.stroke.flush()
         if self.current_map_index is not None:
             self.maps[self.current_map_index].update()
+        if self.current_tool == "path" and self.path_tool:
+            self.path_tool.update()
+        self.hibernate_inactive_maps()
+        memory.next_frame()
         
+    def draw_memory(self):
+        # Debug overlay: bytes per owner, biggest first, with their categories
+        breakdown = memory.breakdown()
+        totals = {owner: sum(categories.values()) for owner, categories in breakdown.items()}
+        lines = [f"{sum(totals.values()) / MB:.1f} / {memory.budget / MB:.0f} MB  {self.clock.get_fps():.0f} fps"]
+        for owner in sorted(totals, key=totals.get, reverse=True):
+            details = ", ".join(f"{category} {size / MB:.1f}" for category, size in breakdown[owner].items() if size >= MB / 10)
+            lines.append(f"{owner}: {totals[owner] / MB:.1f} MB" + (f" ({details})" if details else ""))
+        height = self.font.get_linesize()
+        top = self.display.get_height() - height * len(lines) - 5
+        for i, line in enumerate(lines):
+            text = self.font.render(line, True, self.text_color, self.bg_color)
+            self.display.blit(text, (5, top + i * height))
+
+    def show_status(self, text:str):
+        self.status = (text, input_state.get_ticks() + self.status_duration)
+
+    def draw_status(self):
+        if self.status is None:
+            return
+        text, until = self.status
+        if input_state.get_ticks() >= until:
+            self.status = None
+            return
+        surf = self.font.render(text, True, self.text_color, self.bg_color)
+        rect = surf.get_rect(midbottom=(self.display.get_width() // 2, self.display.get_height() - 10))
+        self.display.fill(self.bg_color, rect.inflate(8, 6))
+        pygame.draw.rect(self.display, self.primary_color, rect.inflate(8, 6), 1)
+        self.display.blit(surf, rect)
+
     def draw(self):
         self.display.fill(self.bg_color)
         if self.current_map_index is not None:
             self.maps[self.current_map_index].draw(self.display)
+        if self.shape_start is not None and self.active_layer is not None:
+            layer = self.active_layer
+            rect, mask = shape_mask(self.current_tool, self.shape_start, layer.mouse_cell())
+            screen = layer.screen_rect(rect)
+            cell = Vec2(screen.width / rect.width, screen.height / rect.height)
+            for start, end in mask_outline(mask):
+                pygame.draw.line(
+                    self.display, self.primary_color,
+                    Vec2(screen.topleft) + Vec2(start).elementwise() * cell, Vec2(screen.topleft) + Vec2(end).elementwise() * cell
+                )
+        if self.selection:
+            self.selection.draw(self.display)
+        if self.current_tool == "path" and self.path_tool:
+            self.path_tool.draw(self.display)
         for ui in self.ui:
             ui.draw(self.display)
+        if self.map_browser is not None:
+            self.map_browser.draw(self.display)
+        if self.show_memory:
+            self.draw_memory()
+        self.draw_status()
     
     def new_map(self,b):
-        pass
+        tile_map = Map(Vec2(64,64), self.tilesets, [], [], display_offset=Vec2(0,100))
+        tile_map.append_layer()
+        self.add_map(tile_map)
+    
+    def prompt_map_path(self, save:bool=False):
+        if self.file_picker is None:
+            self.file_picker = FilePicker()
+        if save:
+            return self.file_picker.prompt_save_file(
+                title="Save map", filetypes=self.map_filetypes, initialdir=os.getcwd(), defaultextension=".mythmap"
+            )
+        return self.file_picker.prompt_file(title="Open map", filetypes=self.map_filetypes, initialdir=os.getcwd())
     
     def open_map(self,b):
-        pass
+        if self.map_browser is None:
+            self.map_browser = MapBrowser(
+                self.font, self.tilesets, callback=self.load_map_file, directory=os.getcwd(),
+                cache_dir=self.thumbnail_dir, text_color=self.text_color, bg_color=self.bg_color,
+                h_bg_color=self.h_bg_color, border_color=self.primary_color
+            )
+        self.map_browser.show()
+    
+    def load_map_file(self, path:str):
+        try:
+            tile_map = load_map(path, self.tilesets)
+        except (ValueError, OSError, pygame.error) as error:
+            self.show_status(f"Opening {os.path.basename(path)} failed: {error}")
+            return
+        tile_map.display_offset = Vec2(0,100)
+        self.add_map(tile_map)
     
     def save_map(self,b):
-        pass
+        if self.current_map is None:
+            return
+        if self.current_map.path is None:
+            self.save_as_map(b)
+            return
+        self.saver.save_async(self.current_map, self.current_map.path)
     
     def save_as_map(self,b):
-        pass
+        if self.current_map is None:
+            return
+        path = self.prompt_map_path(save=True)
+        if not path:
+            return
+        self.current_map.path = path
+        self.saver.save_async(self.current_map, path)
+    
+    def autosave_path(self, tile_map:Map) -> str:
+        if tile_map.path is not None:
+            root, ext = os.path.splitext(tile_map.path)
+            return f"{root}.autosave{ext}"
+        return os.path.join(self.autosave_dir, f"untitled_{self.maps.index(tile_map)}.mythmap")
+    
+    def autosave(self):
+        # Same background pipeline as a manual save, only for maps changed since their last save or autosave
+        for tile_map in self.maps:
+            if not tile_map.is_modified or self.saver.is_saving(tile_map):
+                continue
+            if self.autosaved_versions.get(id(tile_map)) == (tile_map.layer_versions, tile_map.entity_version):
+                continue
+            path = self.autosave_path(tile_map)
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.saver.save_async(tile_map, path, autosave=True)
+    
+    def on_save_done(self, event):
+        if not event.ok:
+            self.show_status(f"Saving {os.path.basename(event.path)} failed: {event.error}")
+        elif event.autosave:
+            self.autosaved_versions[id(event.map)] = (event.versions, event.entity_version)
+        else:
+            event.map.mark_saved(event.versions, event.entity_version)
     
     def export_map(self,b):
-        pass
+        if self.current_map is None:
+            return
+        if self.file_picker is None:
+            self.file_picker = FilePicker()
+        path = self.file_picker.prompt_save_file(
+            title="Export map",
+            filetypes=[("Tiled map", "*.tmx"), ("Tiled JSON map", "*.json")],
+            initialdir=os.getcwd(),
+            defaultextension=".tmx"
+        )
+        if path:
+            self.current_map.export(path)
         
     
     
@@ -168,4 +605,6 @@ if __name__ == "__main__":
     windowed_size = (w//(4/3), h//(4/3))
 
     main = Main(windowed_size,screen_size=(w,h))
+    if "--record" in sys.argv:
+        main.start_recording(sys.argv[sys.argv.index("--record") + 1])
     main.run()
\ No newline at end of file
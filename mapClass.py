@@ -2,13 +2,30 @@ import pygame
 from pygame.locals import *
 from pygame.math import Vector2 as Vec2
 
+import os
 from typing import List
 
+import numpy as np
+
 from layer import Layer
 from entity import Entity
+from history import EditHistory
+from spatial_hash import SpatialHash
 from tileset import TilesetProperties
+from map_export import export_map
+from memory import memory
+from input_state import input_state
+from sprite_cache import surface_bytes
 
 class Map:
+    # While the zoom keeps changing, the last frame of the layers is stretched instead of drawing them. Once it has
+    # not changed for refine_delay ms the layers render at the new zoom, and replace the preview when all are done
+    progressive_zoom = True
+    refine_delay = 150
+    # Only entities on screen during the last draw are updated when set, for maps with many entities whose
+    # off-screen behaviour does not matter. Off by default, so entities keep moving out of view
+    cull_entity_updates = False
+
     def __init__(self,
                  size:Vec2,
                  tilesets:List[TilesetProperties],
@@ -17,28 +34,108 @@ class Map:
                  active_layer:int=-1,
                  display_offset:Vec2=Vec2(0,0),
                  display_scale:float=1.0,
-                 default_tileset_index:int=0):
+                 default_tileset_index:int=0,
+                 entity_cell_size:int=64):
         self.size = size
         self.tilesets = tilesets
         self.layers = layers
         self.entities = entities
+        self.entity_grid = SpatialHash(entity_cell_size)
+        for entity in self.entities:
+            self.entity_grid.insert(entity, entity.pos.x, entity.pos.y)
+        self.visible_entities = []
+        self.history = EditHistory()
+        self.path = None
+        self.entity_version = 0
+        self.saved_versions = None
+        self.saved_entity_version = 0
         self.active_layer = active_layer
+        self.__frame = None
+        self.__captured = None
+        self.__preview = None
+        self.__zoomed_at = 0
         self.display_offset = display_offset
         self.display_scale = display_scale
         self.default_tileset_index = default_tileset_index
+        memory.register(self)
         
     def draw(self,surface:pygame.Surface):
-        for layer in self.layers:
-            layer.draw(surface,self.display_offset)
-        for entity in self.entities:
-            entity.draw(surface,self.display_offset)
+        if self.__preview is not None and input_state.get_ticks() - self.__zoomed_at >= self.refine_delay:
+            # Input went idle: the layers render at the new zoom behind the preview, which stays until they are done
+            if all([layer.prefetch(surface, self.display_offset) for layer in self.layers]):
+                self.__preview = None
+        if self.__preview is not None:
+            self.draw_preview(surface)
+        else:
+            self.__preview = None
+            for layer in self.layers:
+                layer.draw(surface,self.display_offset)
+            # Copied only when a layer drew something else than in the copied frame, idle frames copy nothing
+            drawn = (surface.get_size(), tuple((id(layer), layer.drawn_version) for layer in self.layers))
+            if self.progressive_zoom and drawn != self.__captured:
+                self.capture_frame(surface)
+                self.__captured = drawn
+        self.visible_entities = self.entities_in_rect(self.view_rect(surface))
+        for entity in self.visible_entities:
+            entity.draw(surface,self.display_offset,self.display_scale)
         
+    def capture_frame(self, surface:pygame.Surface):
+        frame = self.__frame[0] if self.__frame is not None and self.__frame[0].get_size() == surface.get_size() else None
+        if frame is None:
+            frame = pygame.Surface(surface.get_size())
+        frame.blit(surface, (0, 0))
+        self.__frame = (frame, self._display_scale, Vec2(self._display_offset))
+
+    def draw_preview(self, surface:pygame.Surface):
+        # Nearest neighbour stretch of the part of the last frame that is still on screen
+        frame, scale, offset = self.__preview
+        ratio = self._display_scale / scale
+        shift = self._display_offset - offset * ratio
+        screen = surface.get_rect()
+        source = pygame.Rect(
+            (Vec2(screen.topleft) - shift) / ratio,
+            Vec2(screen.size) / ratio + Vec2(2, 2),
+        ).clip(frame.get_rect())
+        if not source.width or not source.height:
+            return
+        target = Vec2(source.topleft) * ratio + shift
+        size = (max(round(source.width * ratio), 1), max(round(source.height * ratio), 1))
+        surface.blit(pygame.transform.scale(frame.subsurface(source), size), target)
+
+    def zoom_at(self, screen_pos:Vec2, factor:float):
+        # Keeps the map point under screen_pos in place
+        anchor = self.to_map_pos(screen_pos)
+        self.display_scale = self.display_scale * factor
+        self.display_offset = Vec2(screen_pos) - anchor * self.display_scale
+
     def update(self):
         for layer in self.layers:
             layer.update()
-        for entity in self.entities:
+        for entity in self.visible_entities if self.cull_entity_updates else self.entities:
             entity.update()
     
+    def to_map_pos(self,screen_pos:Vec2) -> Vec2:
+        return (Vec2(screen_pos) - self.display_offset) / self.display_scale
+    
+    def view_rect(self,surface:pygame.Surface) -> pygame.Rect:
+        return pygame.Rect(self.to_map_pos((0,0)), Vec2(surface.get_size()) / self.display_scale)
+    
+    def entities_in_rect(self,rect:pygame.Rect) -> List[Entity]:
+        # Entities are hashed by their top left corner, so the ones hanging into the rect from above/left are included
+        cell_size = self.entity_grid.cell_size
+        search_rect = pygame.Rect(rect.x - cell_size, rect.y - cell_size, rect.w + cell_size, rect.h + cell_size)
+        entities = [entity for entity in self.entity_grid.query_rect(search_rect) if rect.colliderect(entity.rect)]
+        entities.sort(key=lambda entity: entity.pos.y)
+        return entities
+    
+    def entity_at(self,screen_pos:Vec2) -> Entity:
+        pos = self.to_map_pos(screen_pos)
+        rect = pygame.Rect(pos, (1, 1))
+        for entity in reversed(self.entities_in_rect(rect)):
+            if entity.rect.collidepoint(pos):
+                return entity
+        return None
+    
     @property
     def active_layer(self):
         return self._active_layer
@@ -65,8 +162,6 @@ class Map:
         self._display_offset = value
         for layer in self.layers:
             layer.offset = value
-        for entity in self.entities:
-            entity.offset = value
     
     @property
     def display_scale(self):
@@ -74,11 +169,12 @@ class Map:
     
     @display_scale.setter
     def display_scale(self,value:float):
+        if self.progressive_zoom and self.__preview is None:
+            self.__preview = self.__frame
+        self.__zoomed_at = input_state.get_ticks()
         self._display_scale = max(0.001,value)
         for layer in self.layers:
             layer.scaling_factor = self._display_scale
-        for entity in self.entities:
-            entity.scaling_factor = self._display_scale
     
     def append_layer(self,layer:Layer=None,active:bool=True,index:int=-1):
         if layer is None:
@@ -89,9 +185,12 @@ class Map:
                 scaling_factor=self.display_scale,
                 offset=self.display_offset,
                 active=active,
-                tileset_properties=tileset
+                tileset_properties=tileset,
+                tilesets=self.tilesets
             )
             layer.selected_index = 16
+        else:
+            layer.rebind_tilesets(self.tilesets)
         if index == -1:
             self.layers.append(layer)
         else:
@@ -99,15 +198,107 @@ class Map:
         if active:
             self.active_layer = len(self.layers) - 1
     
+    def histogram(self) -> np.ndarray:
+        # Index 0 counts empty cells, index i + 1 counts tile i
+        histogram = np.zeros(0, dtype=np.int64)
+        for layer in self.layers:
+            if len(layer.histogram) > len(histogram):
+                histogram = np.pad(histogram, (0, len(layer.histogram) - len(histogram)))
+            histogram[:len(layer.histogram)] += layer.histogram
+        return histogram
+    
+    def count(self,index:int) -> int:
+        return sum(layer.count(index) for layer in self.layers)
+    
+    def find(self,index:int) -> np.ndarray:
+        found = [np.empty((0, 3), dtype=np.int64)]
+        for i,layer in enumerate(self.layers):
+            positions = layer.find(index)
+            if len(positions):
+                found.append(np.column_stack((np.full(len(positions), i), positions)))
+        return np.concatenate(found)
+    
+    def replace_all(self,old:int,new:int,layers:List[int]=None) -> int:
+        if layers is None:
+            layers = range(len(self.layers))
+        return sum(self.layers[i].replace_all(old, new) for i in layers)
+    
+    def reload_tileset(self,tileset:TilesetProperties):
+        for layer in self.layers:
+            layer.reload_tileset(tileset)
+    
+    @property
+    def memory_name(self) -> str:
+        return "map " + (os.path.basename(self.path) if self.path else f"{id(self):x}")
+
+    def memory_usage(self) -> dict:
+        usage = {f"layer {i}": sum(layer.memory_usage().values()) for i, layer in enumerate(self.layers)}
+        if self.__frame is not None:
+            usage["zoom preview"] = surface_bytes(self.__frame[0])
+        return usage
+
+    def lru_tick(self):
+        ticks = [tick for tick in (layer.lru_tick() for layer in self.layers) if tick is not None]
+        return min(ticks, default=None)
+
+    def evict_lru(self) -> int:
+        tick = self.lru_tick()
+        for layer in self.layers:
+            if layer.lru_tick() == tick:
+                return layer.evict_lru()
+        return 0
+
+    @property
+    def hibernated(self):
+        return all(layer.hibernated for layer in self.layers)
+    
+    def hibernate(self):
+        self.visible_entities = []
+        self.__frame = self.__preview = self.__captured = None
+        for layer in self.layers:
+            layer.hibernate()
+    
+    @property
+    def layer_versions(self):
+        return [(id(layer), layer.version) for layer in self.layers]
+    
+    @property
+    def is_modified(self):
+        return self.saved_versions != self.layer_versions or self.saved_entity_version != self.entity_version
+    
+    def mark_saved(self,versions:list,entity_version:int):
+        self.saved_versions = versions
+        self.saved_entity_version = entity_version
+    
     def append_entity(self,entity:Entity):
         self.entities.append(entity)
+        self.entity_grid.insert(entity, entity.pos.x, entity.pos.y)
+        self.entity_version += 1
+    
+    def remove_entity(self,entity:Entity):
+        self.entities.remove(entity)
+        self.entity_grid.remove(entity)
+        self.entity_version += 1
+    
+    def move_entity(self,entity:Entity,pos:Vec2):
+        entity.pos = Vec2(pos)
+        self.entity_grid.move(entity, entity.pos.x, entity.pos.y)
+        self.entity_version += 1
+    
+    @property
+    def tilesize(self):
+        if self.layers:
+            return self.layers[0].tilesize
+        if self.tilesets:
+            return self.tilesets[self.default_tileset_index].tilesize
+        return Vec2(16,16)
     
     @property
     def is_tile_layer_active(self):
         return self.active_layer != -1
     
-    def export(self,format="jpg"):
-        return NotImplemented
+    def export(self,path:str,format:str=None,compression:str="zlib"):
+        export_map(self, path, format, compression)
 
     def __str__(self):
         return "Map with {} layers and {} entities".format(len(self.layers),len(self.entities))+\
@@ -117,6 +308,8 @@ class Map:
 if __name__=="__main__":
     import glob
     
+    from stroke import Stroke
+    
     map_size = Vec2(50,50)
     
     tilesets = []
@@ -150,6 +343,7 @@ if __name__=="__main__":
     clock = pygame.time.Clock()
     
     drag = False
+    stroke = None
     running = True
     
     while running:
@@ -157,19 +351,25 @@ if __name__=="__main__":
             if event.type == pygame.QUIT:
                 running = False
             elif event.type == pygame.MOUSEWHEEL:
-                my_map.display_scale += event.y * 0.1
+                my_map.zoom_at(pygame.mouse.get_pos(), 1.1 ** event.y)
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 if event.button == 1:
                     drag = True
                 elif event.button == 3:
                     if my_map.is_tile_layer_active:
-                        my_map.layers[my_map.active_layer].add_tile()
+                        stroke = Stroke(my_map.layers[my_map.active_layer])
+                        stroke.add_point(event.pos)
             elif event.type == pygame.MOUSEBUTTONUP:
                 if event.button == 1:
                     drag = False
+                elif event.button == 3 and stroke:
+                    stroke.flush()
+                    stroke = None
             elif event.type == pygame.MOUSEMOTION:
                 if drag:
                     my_map.display_offset += Vec2(event.rel)
+                if stroke:
+                    stroke.add_point(event.pos)
             elif event.type == pygame.KEYDOWN:
                 if event.key == K_SPACE:
                     my_map.active_layer = (my_map.active_layer + 1) % len(my_map.layers)
@@ -193,7 +393,21 @@ if __name__=="__main__":
                 elif event.key == K_KP_PLUS:
                     my_map.append_layer()
                     print(my_map)
+                
+                elif event.key == K_a:
+                    if my_map.is_tile_layer_active:
+                        layer = my_map.layers[my_map.active_layer]
+                        layer.autotile = not layer.autotile
+                
+                elif event.key == K_e:
+                    entity = my_map.entity_at(pygame.mouse.get_pos())
+                    if entity is None:
+                        my_map.append_entity(Entity.from_name("skeleton", my_map.to_map_pos(pygame.mouse.get_pos())))
+                    else:
+                        my_map.remove_entity(entity)
                     
+        if stroke:
+            stroke.flush()
         my_map.update()
 
         screen.fill((0, 0, 0))
@@ -0,0 +1,379 @@
+import hashlib
+import os
+import struct
+import zlib
+from bisect import insort
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pygame
+from pygame.locals import *
+
+from map_file import ChunkFile, find_tileset
+from minimap import get_tile_colors
+from tileset import EMPTY, gid_tileset, gid_index
+from sprite_cache import surface_bytes
+from memory import memory
+from input_state import input_state
+
+MAP_EXTENSION = ".mythmap"
+
+
+def thumbnail_key(path: str, size: tuple) -> str:
+    # "<map>.<version>": the first part names the map and the thumbnail size, the second changes whenever the file
+    # is rewritten, so stale thumbnails are never looked up again and can be told apart from the current one
+    stat = os.stat(path)
+    name = hashlib.sha1(f"{os.path.abspath(path)}|{size[0]}x{size[1]}".encode()).hexdigest()
+    version = hashlib.sha1(f"{stat.st_mtime_ns}|{stat.st_size}".encode()).hexdigest()[:16]
+    return f"{name}.{version}"
+
+
+def prune_thumbnails(cache_dir: str, key: str, limit: int):
+    # Drops the other thumbnails of the map just cached, then the least recently used ones past limit, such as
+    # those of deleted maps. Cache hits touch their file, so its modification time tells when it was last used
+    name = key.split(".")[0] + "."
+    try:
+        entries = list(os.scandir(cache_dir))
+    except OSError:
+        return
+    kept = []
+    for entry in entries:
+        # Temporary files belong to workers still writing them
+        if not entry.name.endswith(".png") or entry.name.endswith(".tmp.png") or entry.name == key + ".png":
+            continue
+        if entry.name.startswith(name):
+            remove_file(entry.path)
+            continue
+        try:
+            kept.append((entry.stat().st_mtime_ns, entry.path))
+        except OSError:
+            pass
+    # One place is left for the thumbnail just written
+    kept.sort()
+    for _, path in kept[:max(len(kept) - limit + 1, 0)]:
+        remove_file(path)
+
+
+def remove_file(path: str):
+    # Another browser's workers may have removed it first
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def render_thumbnail(path: str, tilesets: list, size: tuple) -> pygame.Surface:
+    # One sampled cell per pixel, coloured with the tile's average colour like the minimap
+    chunk_file = ChunkFile.open(path)
+    header = chunk_file.header
+    # Tilesets the editor does not know yet are loaded for the thumbnail only
+    tilesets = list(tilesets)
+    map_tilesets = [find_tileset(tileset, tilesets) for tileset in header["tilesets"]]
+    width, height = (int(side) for side in header["size"])
+    step = max(width / size[0], height / size[1], 1)
+    columns, rows = max(int(width / step), 1), max(int(height / step), 1)
+    ys, xs = np.meshgrid(
+        ((np.arange(rows) + 0.5) * step).astype(np.int64), ((np.arange(columns) + 0.5) * step).astype(np.int64),
+        indexing="ij"
+    )
+
+    counts = [tileset.tile_count for tileset in map_tilesets]
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+    colors = np.concatenate([get_tile_colors(tileset)[:-1] for tileset in map_tilesets] + [np.zeros((1, 4), dtype=np.uint8)])
+    pixels = np.zeros((rows, columns, 3), dtype=np.uint8)
+    for layer_header, data in zip(header["layers"], chunk_file.read_layers()):
+        layer_height, layer_width = data.shape
+        inside = (ys < layer_height) & (xs < layer_width)
+        gids = np.full((rows, columns), EMPTY, dtype=np.int32)
+        gids[inside] = data[ys[inside], xs[inside]]
+        dense = np.where(gids == EMPTY, len(colors) - 1, offsets[gid_tileset(gids)] + gid_index(gids))
+        layer_colors = colors[dense]
+        opaque = layer_colors[..., 3] > 0
+        pixels[opaque] = layer_colors[..., :3][opaque]
+    return pygame.surfarray.make_surface(pixels.transpose(1, 0, 2))
+
+
+def load_thumbnail(path: str, tilesets: list, size: tuple, cache_dir: str, cache_limit: int = 1024):
+    # Runs on the browser's workers: the cached image if the map did not change since, else a fresh render saved
+    # next to the others, replacing the map's older ones. Maps that fail to read get no thumbnail
+    try:
+        key = thumbnail_key(path, size)
+        cached = os.path.join(cache_dir, key + ".png")
+        if os.path.exists(cached):
+            try:
+                surf = pygame.image.load(cached)
+                os.utime(cached)
+                return surf
+            except pygame.error:
+                pass
+        surf = render_thumbnail(path, tilesets, size)
+    except (OSError, ValueError, KeyError, IndexError, struct.error, zlib.error, pygame.error):
+        return None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Written under a temporary name, a browser running at the same time never reads half an image
+        temp_path = f"{cached}.{os.getpid()}.tmp.png"
+        pygame.image.save(surf, temp_path)
+        os.replace(temp_path, cached)
+        prune_thumbnails(cache_dir, key, cache_limit)
+    except (OSError, pygame.error):
+        pass
+    return surf
+
+
+class MapBrowser:
+    # An open dialog drawn over the editor. The folder is listed a few entries per frame and only the thumbnails
+    # of the entries on screen are requested, so large folders open at once and fill in as they are read
+    def __init__(
+        self,
+        font: pygame.font.Font,
+        tilesets: list,
+        callback=lambda path: None,
+        directory: str = ".",
+        cache_dir: str = "thumbnails",
+        thumbnail_size: tuple = (96, 96),
+        text_color: pygame.Color = pygame.Color(255, 255, 255),
+        bg_color: pygame.Color = pygame.Color(32, 32, 32),
+        h_bg_color: pygame.Color = pygame.Color(45, 45, 45),
+        border_color: pygame.Color = pygame.Color(8, 112, 194),
+        entries_per_frame: int = 64,
+        thumbnail_limit: int = 512,
+        cache_limit: int = 1024,
+        workers: int = 2,
+    ):
+        self.font = font
+        self.tilesets = tilesets
+        self.callback = callback
+        self.cache_dir = cache_dir
+        self.thumbnail_size = thumbnail_size
+        self.text_color = text_color
+        self.bg_color = bg_color
+        self.h_bg_color = h_bg_color
+        self.border_color = border_color
+        self.entries_per_frame = entries_per_frame
+        self.thumbnail_limit = thumbnail_limit
+        # Thumbnails kept in cache_dir, across every folder browsed
+        self.cache_limit = cache_limit
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="map-browser")
+        self.rect = pygame.Rect(0, 0, 0, 0)
+        self.active = False
+        self.padding = 8
+        self.header_height = 30
+        self.cell_size = (thumbnail_size[0] + self.padding, thumbnail_size[1] + font.get_linesize() + self.padding)
+        self.scroll = 0
+        # (path, mtime, size) -> thumbnail, None for maps that could not be read
+        self.thumbnails = OrderedDict()
+        self.pending = {}
+        self.labels = {}
+        self.directory = None
+        self.entries = []
+        self.scan = None
+        self.open_directory(directory)
+        memory.register(self, "ui")
+
+    def memory_usage(self) -> dict:
+        return {"map browser": sum(surface_bytes(surf) for surf in self.thumbnails.values() if surf is not None)}
+
+    def show(self):
+        self.active = True
+        # Reopening lists the folder again, files may have been saved or removed meanwhile
+        self.open_directory(self.directory)
+
+    def close(self):
+        self.active = False
+        self.cancel_pending()
+        if self.scan is not None:
+            self.scan.close()
+            self.scan = None
+
+    def shutdown(self):
+        self.close()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def open_directory(self, directory: str):
+        self.cancel_pending()
+        if self.scan is not None:
+            self.scan.close()
+        self.directory = os.path.abspath(directory)
+        self.scroll = 0
+        self.labels = {}
+        # (is a file, sort name, name, path, stamp), folders first; ".." leads unless at the root
+        self.entries = []
+        parent = os.path.dirname(self.directory)
+        if parent != self.directory:
+            self.entries.append((False, "", "..", parent, None))
+        try:
+            self.scan = os.scandir(self.directory)
+        except OSError:
+            self.scan = None
+
+    def read_entries(self):
+        for _ in range(self.entries_per_frame):
+            try:
+                entry = next(self.scan)
+            except StopIteration:
+                self.scan.close()
+                self.scan = None
+                return
+            except OSError:
+                continue
+            if entry.name.startswith("."):
+                continue
+            try:
+                if entry.is_dir():
+                    insort(self.entries, (False, entry.name.lower(), entry.name, entry.path, None))
+                elif entry.name.lower().endswith(MAP_EXTENSION):
+                    stat = entry.stat()
+                    stamp = (entry.path, stat.st_mtime_ns, stat.st_size)
+                    insort(self.entries, (True, entry.name.lower(), entry.name, entry.path, stamp))
+            except OSError:
+                continue
+
+    @property
+    def grid_rect(self) -> pygame.Rect:
+        return pygame.Rect(
+            self.rect.left + self.padding, self.rect.top + self.header_height,
+            self.rect.width - self.padding * 2, self.rect.height - self.header_height - self.padding
+        )
+
+    @property
+    def columns(self) -> int:
+        return max(self.grid_rect.width // self.cell_size[0], 1)
+
+    @property
+    def max_scroll(self) -> int:
+        rows = -(-len(self.entries) // self.columns)
+        return max(rows * self.cell_size[1] - self.grid_rect.height, 0)
+
+    def visible_range(self) -> range:
+        columns = self.columns
+        first = self.scroll // self.cell_size[1] * columns
+        last = (self.scroll + self.grid_rect.height) // self.cell_size[1] * columns + columns
+        return range(first, min(last, len(self.entries)))
+
+    def entry_rect(self, i: int) -> pygame.Rect:
+        grid = self.grid_rect
+        row, column = divmod(i, self.columns)
+        return pygame.Rect(
+            grid.left + column * self.cell_size[0], grid.top + row * self.cell_size[1] - self.scroll,
+            self.cell_size[0] - self.padding, self.cell_size[1] - self.padding
+        )
+
+    def entry_at(self, pos) -> int:
+        if not self.grid_rect.collidepoint(pos):
+            return None
+        for i in self.visible_range():
+            if self.entry_rect(i).collidepoint(pos):
+                return i
+        return None
+
+    def cancel_pending(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending = {}
+
+    def request_thumbnails(self):
+        # Jobs for entries scrolled out of view are dropped before they start
+        visible = {self.entries[i][4] for i in self.visible_range() if self.entries[i][0]}
+        for stamp in [stamp for stamp in self.pending if stamp not in visible]:
+            if self.pending[stamp].cancel():
+                del self.pending[stamp]
+        for stamp in visible:
+            if stamp in self.thumbnails:
+                self.thumbnails.move_to_end(stamp)
+            elif stamp not in self.pending:
+                self.pending[stamp] = self.executor.submit(
+                    load_thumbnail, stamp[0], self.tilesets, self.thumbnail_size, self.cache_dir, self.cache_limit
+                )
+
+    def collect_thumbnails(self):
+        for stamp, future in list(self.pending.items()):
+            if future.done():
+                del self.pending[stamp]
+                surf = future.result()
+                self.thumbnails[stamp] = surf.convert() if surf is not None and pygame.display.get_surface() else surf
+        while len(self.thumbnails) > self.thumbnail_limit:
+            self.thumbnails.popitem(last=False)
+
+    def update(self):
+        if not self.active:
+            return
+        if self.scan is not None:
+            self.read_entries()
+        self.scroll = min(self.scroll, self.max_scroll)
+        self.collect_thumbnails()
+        self.request_thumbnails()
+
+    def handle_event(self, event) -> bool:
+        # Returns whether the event was meant for the browser; while it is open it takes all mouse and key input
+        if not self.active:
+            return False
+        if event.type == KEYDOWN:
+            if event.key == K_ESCAPE:
+                self.close()
+            elif event.key == K_BACKSPACE:
+                self.open_directory(os.path.dirname(self.directory))
+            return True
+        if event.type == MOUSEWHEEL:
+            self.scroll = min(max(self.scroll - event.y * self.cell_size[1] // 2, 0), self.max_scroll)
+            return True
+        if event.type == MOUSEBUTTONDOWN:
+            if event.button == 1:
+                self.on_click(event.pos)
+            return True
+        return event.type in (KEYUP, TEXTINPUT, MOUSEMOTION, MOUSEBUTTONUP)
+
+    def on_click(self, pos):
+        if not self.rect.collidepoint(pos):
+            self.close()
+            return
+        i = self.entry_at(pos)
+        if i is None:
+            return
+        is_file, _, _, path, _ = self.entries[i]
+        if is_file:
+            self.close()
+            self.callback(path)
+        else:
+            self.open_directory(path)
+
+    def label(self, name: str) -> pygame.Surface:
+        text = self.labels.get(name)
+        if text is None:
+            width = self.cell_size[0] - self.padding
+            shown = name
+            while len(shown) > 1 and self.font.size(shown)[0] > width:
+                shown = shown[:-2] + "…"
+            text = self.labels[name] = self.font.render(shown, True, self.text_color)
+        return text
+
+    def draw(self, surface: pygame.Surface):
+        if not self.active:
+            return
+        self.rect = surface.get_rect().inflate(-80, -80)
+        surface.fill(self.bg_color, self.rect)
+        pygame.draw.rect(surface, self.border_color, self.rect, 2)
+        title = self.font.render(self.directory, True, self.text_color)
+        surface.blit(title, (self.rect.left + self.padding, self.rect.top + (self.header_height - title.get_height()) // 2))
+
+        mouse_pos = input_state.mouse_pos()
+        previous_clip = surface.get_clip()
+        surface.set_clip(self.grid_rect.clip(previous_clip))
+        for i in self.visible_range():
+            is_file, _, name, _, stamp = self.entries[i]
+            rect = self.entry_rect(i)
+            thumbnail_rect = pygame.Rect(rect.topleft, self.thumbnail_size)
+            if rect.collidepoint(mouse_pos):
+                surface.fill(self.h_bg_color, rect)
+            thumbnail = self.thumbnails.get(stamp) if is_file else None
+            if thumbnail is not None:
+                surface.blit(thumbnail, thumbnail.get_rect(center=thumbnail_rect.center))
+            elif not is_file:
+                folder = thumbnail_rect.inflate(-thumbnail_rect.width // 3, -thumbnail_rect.height // 2)
+                pygame.draw.rect(surface, self.border_color, folder, 2)
+            else:
+                pygame.draw.rect(surface, self.h_bg_color, thumbnail_rect, 1)
+            text = self.label(name)
+            surface.blit(text, text.get_rect(midtop=(rect.centerx, thumbnail_rect.bottom)))
+        surface.set_clip(previous_clip)
@@ -0,0 +1,190 @@
+import sys
+
+import numpy as np
+import pygame
+
+from layer import CHUNK_SIZE, hash_chunks
+
+
+class LayerDiff:
+    def __init__(self, chunks: np.ndarray, cells: np.ndarray, before: np.ndarray, after: np.ndarray):
+        self.chunks = chunks
+        self.cells = cells
+        self.before = before
+        self.after = after
+
+    def __bool__(self):
+        return len(self.cells) > 0
+
+    def __len__(self):
+        return len(self.cells)
+
+    @property
+    def rect(self) -> pygame.Rect:
+        if not len(self.cells):
+            return pygame.Rect(0, 0, 0, 0)
+        (left, top), (right, bottom) = self.cells.min(axis=0), self.cells.max(axis=0)
+        return pygame.Rect(int(left), int(top), int(right - left + 1), int(bottom - top + 1))
+
+
+def layer_hashes(layer) -> np.ndarray:
+    if isinstance(layer, np.ndarray):
+        return hash_chunks(layer)
+    return layer.chunk_hashes()
+
+
+def layer_data(layer) -> np.ndarray:
+    if isinstance(layer, np.ndarray):
+        return layer
+    return layer.data
+
+
+def chunk_block(data: np.ndarray, x: int, y: int) -> np.ndarray:
+    return data[y * CHUNK_SIZE:(y + 1) * CHUNK_SIZE, x * CHUNK_SIZE:(x + 1) * CHUNK_SIZE]
+
+
+def changed_chunks(*hashes: np.ndarray) -> np.ndarray:
+    # (n, 2) x, y of the chunks whose hash differs between the first and any other revision
+    changed = np.zeros(hashes[0].shape, dtype=bool)
+    for other in hashes[1:]:
+        changed |= other != hashes[0]
+    ys, xs = np.nonzero(changed)
+    return np.stack((xs, ys), axis=1)
+
+
+def diff_layers(base, other) -> LayerDiff:
+    # Accepts layers (hashes are cached on them) or bare index arrays
+    base_data, other_data = layer_data(base), layer_data(other)
+    if base_data.shape != other_data.shape:
+        raise ValueError(f"Cannot diff layers of shape {base_data.shape} and {other_data.shape}")
+    chunks = changed_chunks(layer_hashes(base), layer_hashes(other))
+    cells, before, after = [np.empty((0, 2), dtype=np.int64)], [np.empty(0, dtype=np.int32)], [np.empty(0, dtype=np.int32)]
+    for x, y in chunks.tolist():
+        old, new = chunk_block(base_data, x, y), chunk_block(other_data, x, y)
+        ys, xs = np.nonzero(old != new)
+        cells.append(np.stack((xs + x * CHUNK_SIZE, ys + y * CHUNK_SIZE), axis=1))
+        before.append(old[ys, xs])
+        after.append(new[ys, xs])
+    return LayerDiff(chunks, np.concatenate(cells), np.concatenate(before), np.concatenate(after))
+
+
+def diff_maps(base, other) -> list:
+    if len(base.layers) != len(other.layers):
+        raise ValueError(f"Cannot diff maps with {len(base.layers)} and {len(other.layers)} layers")
+    return [diff_layers(old, new) for old, new in zip(base.layers, other.layers)]
+
+
+def conflict_regions(conflicts: np.ndarray) -> list:
+    # Bounding boxes of conflicting cells, one per conflicting chunk, merged while they touch
+    regions = []
+    ys, xs = np.nonzero(conflicts)
+    if not len(xs):
+        return regions
+    chunk_ids = np.unique(np.stack((xs // CHUNK_SIZE, ys // CHUNK_SIZE), axis=1), axis=0)
+    for x, y in chunk_ids.tolist():
+        block = chunk_block(conflicts, x, y)
+        block_ys, block_xs = np.nonzero(block)
+        rect = pygame.Rect(
+            x * CHUNK_SIZE + int(block_xs.min()), y * CHUNK_SIZE + int(block_ys.min()),
+            int(block_xs.max() - block_xs.min() + 1), int(block_ys.max() - block_ys.min() + 1)
+        )
+        touching = [region for region in regions if region.inflate(2, 2).colliderect(rect)]
+        for region in touching:
+            regions.remove(region)
+            rect.union_ip(region)
+        regions.append(rect)
+    return regions
+
+
+def merge_layers(base, ours, theirs):
+    # Returns the merged indices, the conflict mask (ours is kept there) and the conflict regions
+    base_data, our_data, their_data = layer_data(base), layer_data(ours), layer_data(theirs)
+    if not base_data.shape == our_data.shape == their_data.shape:
+        raise ValueError("Cannot merge layers of different sizes")
+    base_hashes = layer_hashes(base)
+    our_chunks = changed_chunks(base_hashes, layer_hashes(ours))
+    their_chunks = changed_chunks(base_hashes, layer_hashes(theirs))
+    merged = np.array(our_data)
+    conflicts = np.zeros(merged.shape, dtype=bool)
+    ours_changed = {tuple(chunk) for chunk in our_chunks.tolist()}
+    for x, y in their_chunks.tolist():
+        theirs_block = chunk_block(their_data, x, y)
+        if (x, y) not in ours_changed:
+            chunk_block(merged, x, y)[...] = theirs_block
+            continue
+        base_block, ours_block = chunk_block(base_data, x, y), chunk_block(our_data, x, y)
+        their_edits = theirs_block != base_block
+        chunk_block(merged, x, y)[...] = np.where(their_edits & (ours_block == base_block), theirs_block, ours_block)
+        chunk_block(conflicts, x, y)[...] = their_edits & (ours_block != base_block) & (ours_block != theirs_block)
+    return merged, conflicts, conflict_regions(conflicts)
+
+
+def merge_values(base, ours, theirs):
+    if ours == base or ours == theirs:
+        return theirs, False
+    if theirs == base:
+        return ours, False
+    return ours, True
+
+
+def entity_records(tile_map) -> list:
+    return [
+        (entity.name, entity.sprite_sheet.path, tuple(entity.pos), entity.animation, entity.loop)
+        for entity in tile_map.entities
+    ]
+
+
+def merge_maps(base, ours, theirs):
+    # Merges theirs into ours in place; returns {layer index: conflict regions} plus "entities" on conflict
+    conflicts = {}
+    if not len(base.layers) == len(ours.layers) == len(theirs.layers):
+        raise ValueError("Cannot merge maps with a different number of layers")
+    for i, (base_layer, our_layer, their_layer) in enumerate(zip(base.layers, ours.layers, theirs.layers)):
+        merged, _, regions = merge_layers(base_layer, our_layer, their_layer)
+        edits = changed_chunks(our_layer.chunk_hashes(), hash_chunks(merged))
+        if len(edits):
+            rows = np.unique(edits[:, 1])
+            top, bottom = int(rows.min()) * CHUNK_SIZE, (int(rows.max()) + 1) * CHUNK_SIZE
+            our_layer.set_tiles((0, top), merged[top:bottom], autotile=False)
+        if regions:
+            conflicts[i] = regions
+    entities, conflicted = merge_values(entity_records(base), entity_records(ours), entity_records(theirs))
+    if conflicted:
+        conflicts["entities"] = True
+    elif entities != entity_records(ours):
+        for entity in list(ours.entities):
+            ours.remove_entity(entity)
+        for entity in theirs.entities:
+            ours.append_entity(entity)
+    return conflicts
+
+
+def print_diff(diffs: list):
+    for i, diff in enumerate(diffs):
+        if diff:
+            print(f"layer {i}: {len(diff)} cells in {len(diff.chunks)} chunks, {tuple(diff.rect)}")
+
+
+if __name__ == "__main__":
+    # diff: python map_diff.py diff OLD NEW
+    # merge (git merge driver): python map_diff.py merge %O %A %B, writes the result over %A
+    from map_file import load_map, save_map
+
+    command, *paths = sys.argv[1:]
+    tilesets = []
+    if command == "diff":
+        old, new = (load_map(path, tilesets) for path in paths)
+        print_diff(diff_maps(old, new))
+    elif command == "merge":
+        base, ours, theirs = (load_map(path, tilesets) for path in paths)
+        conflicts = merge_maps(base, ours, theirs)
+        save_map(ours, paths[1])
+        for layer, regions in conflicts.items():
+            if layer == "entities":
+                print("conflict: entities changed on both sides, kept ours")
+                continue
+            for region in regions:
+                print(f"conflict: layer {layer} {tuple(region)}, kept ours")
+        sys.exit(1 if conflicts else 0)
+    else:
+        sys.exit(f"unknown command {command}")
@@ -0,0 +1,198 @@
+import base64
+import json
+import os
+import zlib
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+
+from layer import CHUNK_SIZE, EMPTY
+from tileset import gid_tileset, gid_index
+
+TILED_VERSION = "1.10"
+COMPRESSIONS = (None, "zlib", "gzip")
+COMPRESSION_LEVEL = 1
+
+
+def first_gids(tilesets: list) -> list:
+    gids = []
+    gid = 1
+    for tileset in tilesets:
+        gids.append(gid)
+        gid += tileset.tile_count
+    return gids
+
+
+def image_source(tileset, path: str) -> str:
+    if not tileset.path:
+        return f"{tileset.name}.png"
+    return os.path.relpath(tileset.path, os.path.dirname(os.path.abspath(path))).replace(os.sep, "/")
+
+
+def tileset_fields(tileset, first_gid: int, path: str) -> dict:
+    return {
+        "firstgid": first_gid,
+        "name": tileset.name,
+        "tilewidth": int(tileset.tilesize.x),
+        "tileheight": int(tileset.tilesize.y),
+        "spacing": int(tileset.tilespacing.x),
+        "margin": int(tileset.tilemargin.x),
+        "tilecount": tileset.tile_count,
+        "columns": tileset.tile_by_line,
+        "image": image_source(tileset, path),
+        "imagewidth": tileset.tileset.get_width(),
+        "imageheight": tileset.tileset.get_height(),
+    }
+
+
+def entity_fields(entity, object_id: int) -> dict:
+    return {
+        "id": object_id,
+        "name": entity.name,
+        "type": entity.name,
+        "x": entity.pos.x,
+        "y": entity.pos.y,
+        "width": int(entity.size.x),
+        "height": int(entity.size.y),
+        "rotation": 0,
+        "visible": True,
+        "properties": [
+            {"name": "sprite_sheet", "type": "file", "value": entity.sprite_sheet.path},
+            {"name": "animation", "type": "int", "value": entity.animation},
+        ],
+    }
+
+
+def gid_rows(layer, gids: np.ndarray):
+    # Tiled wants little endian uint32 global ids with 0 for empty cells, produced one chunk row band at a time
+    data = layer.data
+    for top in range(0, data.shape[0], CHUNK_SIZE):
+        band = data[top:top + CHUNK_SIZE]
+        filled = band != EMPTY
+        tiled = gids[gid_tileset(np.where(filled, band, 0))] + gid_index(band)
+        yield np.where(filled, tiled, 0).astype("<u4").tobytes()
+
+
+def encoded_layer(layer, gids: np.ndarray, compression: str = "zlib"):
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported compression {compression!r}, expected one of {COMPRESSIONS}")
+    compressor = None
+    if compression == "zlib":
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    elif compression == "gzip":
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+    leftover = b""
+    for rows in gid_rows(layer, gids):
+        if compressor is not None:
+            rows = compressor.compress(rows)
+        # base64 has to be cut on 3 byte boundaries to stay one continuous string
+        rows = leftover + rows
+        cut = len(rows) - len(rows) % 3
+        leftover = rows[cut:]
+        if cut:
+            yield base64.b64encode(rows[:cut]).decode("ascii")
+    if compressor is not None:
+        leftover += compressor.flush()
+    if leftover:
+        yield base64.b64encode(leftover).decode("ascii")
+
+
+def map_fields(tile_map) -> dict:
+    tilesize = tile_map.tilesize
+    return {
+        "width": int(tile_map.size.x),
+        "height": int(tile_map.size.y),
+        "tilewidth": int(tilesize.x),
+        "tileheight": int(tilesize.y),
+        "nextlayerid": len(tile_map.layers) + 2,
+        "nextobjectid": len(tile_map.entities) + 1,
+    }
+
+
+def xml_attributes(fields: dict) -> str:
+    return " ".join(f"{key}={quoteattr(str(value))}" for key, value in fields.items())
+
+
+def export_tmx(tile_map, path: str, compression: str = "zlib"):
+    tilesets = tile_map.tilesets
+    gids = first_gids(tilesets)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        fields = dict(version=TILED_VERSION, orientation="orthogonal", renderorder="right-down", **map_fields(tile_map), infinite=0)
+        file.write(f"<map {xml_attributes(fields)}>\n")
+        for tileset, first_gid in zip(tilesets, gids):
+            fields = tileset_fields(tileset, first_gid, path)
+            image = {"source": fields.pop("image"), "width": fields.pop("imagewidth"), "height": fields.pop("imageheight")}
+            file.write(f" <tileset {xml_attributes(fields)}>\n")
+            file.write(f"  <image {xml_attributes(image)}/>\n")
+            file.write(" </tileset>\n")
+        for i, layer in enumerate(tile_map.layers):
+            fields = {"id": i + 1, "name": f"Layer {i + 1}", "width": int(layer.size.x), "height": int(layer.size.y)}
+            file.write(f" <layer {xml_attributes(fields)}>\n")
+            data = {"encoding": "base64"}
+            if compression:
+                data["compression"] = compression
+            file.write(f"  <data {xml_attributes(data)}>")
+            for text in encoded_layer(layer, np.array(gids, dtype=np.int64), compression):
+                file.write(text)
+            file.write("</data>\n </layer>\n")
+        if tile_map.entities:
+            file.write(f' <objectgroup {xml_attributes({"id": len(tile_map.layers) + 1, "name": "Entities"})}>\n')
+            for object_id, entity in enumerate(tile_map.entities, 1):
+                fields = entity_fields(entity, object_id)
+                properties = fields.pop("properties")
+                del fields["rotation"], fields["visible"]
+                file.write(f"  <object {xml_attributes(fields)}>\n   <properties>\n")
+                for prop in properties:
+                    file.write(f"    <property {xml_attributes(prop)}/>\n")
+                file.write("   </properties>\n  </object>\n")
+            file.write(" </objectgroup>\n")
+        file.write("</map>\n")
+
+
+def export_json(tile_map, path: str, compression: str = "zlib"):
+    tilesets = tile_map.tilesets
+    gids = first_gids(tilesets)
+    header = dict(
+        type="map", version=TILED_VERSION, orientation="orthogonal", renderorder="right-down",
+        **map_fields(tile_map), infinite=False,
+        tilesets=[tileset_fields(tileset, first_gid, path) for tileset, first_gid in zip(tilesets, gids)],
+    )
+    with open(path, "w", encoding="utf-8") as file:
+        # The small parts go through json, layer data is written straight into the open "data" string
+        file.write(json.dumps(header)[:-1])
+        file.write(', "layers": [')
+        for i, layer in enumerate(tile_map.layers):
+            fields = {
+                "type": "tilelayer", "id": i + 1, "name": f"Layer {i + 1}",
+                "x": 0, "y": 0, "width": int(layer.size.x), "height": int(layer.size.y),
+                "opacity": 1, "visible": True, "encoding": "base64",
+            }
+            if compression:
+                fields["compression"] = compression
+            file.write((", " if i else "") + json.dumps(fields)[:-1] + ', "data": "')
+            for text in encoded_layer(layer, np.array(gids, dtype=np.int64), compression):
+                file.write(text)
+            file.write('"}')
+        if tile_map.entities:
+            objects = {
+                "type": "objectgroup", "id": len(tile_map.layers) + 1, "name": "Entities", "x": 0, "y": 0,
+                "opacity": 1, "visible": True, "draworder": "topdown",
+                "objects": [entity_fields(entity, object_id) for object_id, entity in enumerate(tile_map.entities, 1)],
+            }
+            file.write((", " if tile_map.layers else "") + json.dumps(objects))
+        file.write("]}\n")
+
+
+EXPORTERS = {
+    "tmx": export_tmx,
+    "json": export_json,
+}
+
+
+def export_map(tile_map, path: str, format: str = None, compression: str = "zlib"):
+    if format is None:
+        format = os.path.splitext(path)[1][1:].lower()
+    if format not in EXPORTERS:
+        raise ValueError(f"Unknown export format {format!r}, expected one of {tuple(EXPORTERS)}")
+    EXPORTERS[format](tile_map, path, compression)
@@ -0,0 +1,507 @@
+import json
+import os
+import struct
+import threading
+import time
+import weakref
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pygame
+from pygame.math import Vector2 as Vec2
+
+from entity import Entity, load_sprite_sheet
+from layer import Layer, CHUNK_SIZE, EMPTY
+from sparse_grid import SparseGrid
+from mapClass import Map
+from tileset import TilesetProperties
+
+MAGIC = b"MYTHMAP3"
+# Magic, sequence number, then offset, length and crc of the root, and the crc of all that. Saves write the slot
+# the newest superblock is not in, so a crash halfway through leaves the other one pointing at a complete root
+SUPERBLOCK = struct.Struct("<8sQQQII")
+SUPERBLOCK_SLOTS = 2
+HEADER_SIZE = SUPERBLOCK.size * SUPERBLOCK_SLOTS
+CHUNK_ENTRY = np.dtype([("offset", "<u8"), ("length", "<u4"), ("crc", "<u4"), ("hash", "<u8")])
+PAGE_ENTRY = np.dtype([("offset", "<u8"), ("length", "<u4"), ("crc", "<u4")])
+SAVE_DONE = pygame.event.custom_type()
+
+
+class LayerSnapshot:
+    def __init__(self, layer: Layer):
+        self.layer = layer
+        self.version = layer.version
+        self.data = layer.data
+        self.shape = self.data.shape
+        self.hashes = layer.chunk_hashes().copy()
+        self.chunk_versions = layer.chunk_versions.copy()
+        # Chunks overwritten since the snapshot was taken, copied just before the write
+        self.preserved = {}
+        self.lock = threading.Lock()
+        layer.snapshots.append(self)
+
+    def preserve(self, chunks: np.ndarray):
+        with self.lock:
+            for x, y in chunks.tolist():
+                if (x, y) not in self.preserved:
+                    self.preserved[(x, y)] = self.data[
+                        y * CHUNK_SIZE:(y + 1) * CHUNK_SIZE, x * CHUNK_SIZE:(x + 1) * CHUNK_SIZE
+                    ].copy()
+
+    def read_chunk(self, x: int, y: int) -> np.ndarray:
+        with self.lock:
+            block = self.preserved.get((x, y))
+            if block is None:
+                block = self.data[y * CHUNK_SIZE:(y + 1) * CHUNK_SIZE, x * CHUNK_SIZE:(x + 1) * CHUNK_SIZE].copy()
+        return block
+
+    def release(self):
+        if self in self.layer.snapshots:
+            self.layer.snapshots.remove(self)
+        self.preserved = {}
+
+
+class MapSnapshot:
+    # Taken on the main thread; only the tile data is shared with the editor, everything else is copied
+    def __init__(self, tile_map: Map):
+        self.map = tile_map
+        self.layers = [LayerSnapshot(layer) for layer in tile_map.layers]
+        self.versions = tile_map.layer_versions
+        self.entity_version = tile_map.entity_version
+        self.header = map_header(tile_map)
+
+    def release(self):
+        for snapshot in self.layers:
+            snapshot.release()
+
+
+def tileset_header(tileset: TilesetProperties) -> dict:
+    return {
+        "name": tileset.name,
+        "path": tileset.path,
+        "tilesize": list(tileset.tilesize),
+        "tilemargin": list(tileset.tilemargin),
+        "tilespacing": list(tileset.tilespacing),
+        "color": list(tileset.color),
+        "solid": sorted(tileset.solid),
+    }
+
+
+def map_header(tile_map: Map) -> dict:
+    # Cells hold global ids, so the tilesets are written in the map's order
+    tilesets = tile_map.tilesets
+    return {
+        "size": list(tile_map.size),
+        "tilesets": [tileset_header(tileset) for tileset in tilesets],
+        "default_tileset_index": tile_map.default_tileset_index,
+        "active_layer": tile_map.active_layer,
+        "layers": [
+            {
+                "size": list(layer.size),
+                "tileset": tilesets.index(layer.tileset_properties),
+                "autotile": layer.autotile,
+                "collision": layer.collision,
+            }
+            for layer in tile_map.layers
+        ],
+        "entities": [
+            {
+                "name": entity.name,
+                "sprite_sheet": entity.sprite_sheet.path,
+                "frame_size": list(entity.sprite_sheet.frame_size),
+                "pos": list(entity.pos),
+                "animation": entity.animation,
+                "loop": entity.loop,
+            }
+            for entity in tile_map.entities
+        ],
+    }
+
+
+class ChunkFile:
+    # Two superblock slots, then chunk blobs, table pages (one per chunk row) and roots appended over time;
+    # only what the newest root points at is live
+    def __init__(self, path: str, header: dict = None, tables: list = None, pages: list = None,
+                 size: int = HEADER_SIZE, root_length: int = 0, stamp: tuple = None, sequence: int = 0):
+        self.path = path
+        self.header = header
+        self.tables = tables or []
+        self.pages = pages or []
+        self.size = size
+        self.root_length = root_length
+        # The file as last seen, to notice it was replaced (a checkout, a merge) before appending to it
+        self.stamp = stamp
+        self.sequence = sequence
+        # Per layer, the layer last written and its version then. A chunk edited since is written again even if
+        # its hash did not change, the hashes alone would miss an edit that collides
+        self.written = []
+
+    @classmethod
+    def open(cls, path: str):
+        with open(path, "rb") as file:
+            superblocks = [read_superblock(file.read(SUPERBLOCK.size)) for _ in range(SUPERBLOCK_SLOTS)]
+            if not any(superblocks):
+                raise ValueError(f"{path} is not a map file")
+            # Newest first; an older root is only used when the newest one did not make it to disk whole
+            for sequence, root_offset, root_length, root_crc in sorted(filter(None, superblocks), reverse=True):
+                file.seek(root_offset)
+                root = file.read(root_length)
+                if zlib.crc32(root) == root_crc:
+                    break
+            else:
+                raise ValueError(f"{path} is corrupted, no complete root")
+            header, pages = decode_root(root)
+            tables = []
+            for layer, layer_pages in zip(header["layers"], pages):
+                table = np.zeros((len(layer_pages), -(-int(layer["size"][0]) // CHUNK_SIZE)), dtype=CHUNK_ENTRY)
+                for y, page in enumerate(layer_pages):
+                    file.seek(int(page["offset"]))
+                    table[y] = np.frombuffer(zlib.decompress(read_blob(file, page, path)), dtype=CHUNK_ENTRY)
+                tables.append(table)
+            stat = os.fstat(file.fileno())
+        return cls(path, header, tables, pages, stat.st_size, root_length, stat_stamp(stat), sequence)
+
+    def restat(self):
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.stamp = stat_stamp(stat)
+
+    def is_current(self) -> bool:
+        try:
+            return file_stamp(self.path) == self.stamp
+        except OSError:
+            return False
+
+    @property
+    def live_bytes(self) -> int:
+        return HEADER_SIZE + self.root_length + sum(
+            int(table["length"].sum()) + int(pages["length"].sum()) for table, pages in zip(self.tables, self.pages)
+        )
+
+    @property
+    def fragmentation(self) -> float:
+        return 1 - self.live_bytes / self.size if self.size else 0.0
+
+    def read_layers(self) -> list:
+        layers = []
+        with open(self.path, "rb") as file:
+            for layer_header, table in zip(self.header["layers"], self.tables):
+                width, height = (int(side) for side in layer_header["size"])
+                # Only stored chunks are read, straight into a sparse grid the layer densifies if it fills up
+                ys, xs = np.nonzero(table["length"])
+                blocks = np.full((len(ys), CHUNK_SIZE, CHUNK_SIZE), EMPTY, dtype=np.int32)
+                for block, y, x in zip(blocks, ys.tolist(), xs.tolist()):
+                    file.seek(int(table[y, x]["offset"]))
+                    blob = read_blob(file, table[y, x], self.path)
+                    rows, columns = min(height - y * CHUNK_SIZE, CHUNK_SIZE), min(width - x * CHUNK_SIZE, CHUNK_SIZE)
+                    block[:rows, :columns] = np.frombuffer(zlib.decompress(blob), dtype="<i4").reshape(rows, columns)
+                layers.append(SparseGrid.from_chunks((height, width), np.stack((xs, ys), axis=1), blocks))
+        return layers
+
+    def write(self, snapshot: "MapSnapshot", level: int = 1) -> int:
+        # Appends the chunks that changed since the live table and the pages of their rows,
+        # then a new root, and only then points a superblock at it
+        tables, pages = [], []
+        with open(self.path, "r+b") as file:
+            file.seek(self.size)
+            for i, layer in enumerate(snapshot.layers):
+                old_table = self.tables[i] if i < len(self.tables) else None
+                if old_table is not None and old_table.shape == layer.hashes.shape:
+                    table, rows = append_chunks(file, layer, old_table, self.written_version(i, layer.layer), level)
+                    layer_pages = self.pages[i].copy()
+                else:
+                    table, rows = append_chunks(file, layer, None, level=level)
+                    layer_pages = np.zeros(len(table), dtype=PAGE_ENTRY)
+                append_pages(file, table, layer_pages, rows)
+                tables.append(table)
+                pages.append(layer_pages)
+            self.flip(file, snapshot.header, pages)
+        written = self.size
+        self.header, self.tables, self.pages = snapshot.header, tables, pages
+        self.written = [(weakref.ref(layer.layer), layer.version) for layer in snapshot.layers]
+        self.restat()
+        return self.size - written
+
+    def written_version(self, index: int, layer: Layer) -> int:
+        # 0 for a layer this file was not last written from: only its hashes tell what changed
+        if index < len(self.written) and self.written[index][0]() is layer:
+            return self.written[index][1]
+        return 0
+
+    def flip(self, file, header: dict, pages: list):
+        root_offset = file.seek(0, os.SEEK_END)
+        root = encode_root(header, pages)
+        file.write(root)
+        file.flush()
+        os.fsync(file.fileno())
+        sequence = self.sequence + 1
+        file.seek(sequence % SUPERBLOCK_SLOTS * SUPERBLOCK.size)
+        file.write(pack_superblock(sequence, root_offset, root))
+        file.flush()
+        os.fsync(file.fileno())
+        self.root_length = len(root)
+        self.sequence = sequence
+
+    def compact(self):
+        # Copies the live chunks into a fresh file, without recompressing them, and renames it over the old one
+        temp_path = self.path + ".tmp"
+        tables = [table.copy() for table in self.tables]
+        pages = [np.zeros(len(table), dtype=PAGE_ENTRY) for table in tables]
+        with open(self.path, "rb") as source, open(temp_path, "w+b") as file:
+            file.write(bytes(HEADER_SIZE))
+            for table, layer_pages in zip(tables, pages):
+                for y, x in zip(*np.nonzero(table["length"])):
+                    source.seek(int(table[y, x]["offset"]))
+                    table[y, x]["offset"] = file.tell()
+                    file.write(source.read(int(table[y, x]["length"])))
+                append_pages(file, table, layer_pages, np.ones(len(table), dtype=bool))
+            self.flip(file, self.header, pages)
+        os.replace(temp_path, self.path)
+        self.tables, self.pages = tables, pages
+        self.restat()
+
+
+def stat_stamp(stat: os.stat_result) -> tuple:
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def file_stamp(path: str) -> tuple:
+    return stat_stamp(os.stat(path))
+
+
+def pack_superblock(sequence: int, root_offset: int, root: bytes) -> bytes:
+    fields = SUPERBLOCK.pack(MAGIC, sequence, root_offset, len(root), zlib.crc32(root), 0)[:-4]
+    return fields + struct.pack("<I", zlib.crc32(fields))
+
+
+def read_superblock(data: bytes):
+    # (sequence, root offset, root length, root crc), or None for an empty, foreign or torn slot
+    if len(data) < SUPERBLOCK.size:
+        return None
+    magic, sequence, root_offset, root_length, root_crc, crc = SUPERBLOCK.unpack(data)
+    if magic != MAGIC or crc != zlib.crc32(data[:-4]):
+        return None
+    return sequence, root_offset, root_length, root_crc
+
+
+def read_blob(file, entry, path: str) -> bytes:
+    blob = file.read(int(entry["length"]))
+    if zlib.crc32(blob) != int(entry["crc"]):
+        raise ValueError(f"{path} is corrupted at offset {int(entry['offset'])}")
+    return blob
+
+
+def write_blob(file, entry, blob: bytes):
+    entry["offset"] = file.tell()
+    entry["length"] = len(blob)
+    entry["crc"] = zlib.crc32(blob)
+    file.write(blob)
+
+
+def append_chunks(file, layer: LayerSnapshot, old: np.ndarray = None, since: int = 0, level: int = 1):
+    # Returns the layer's new chunk table and which of its rows changed: those whose hash differs from the old
+    # table's, and those edited after version since
+    if old is None:
+        table = np.zeros(layer.hashes.shape, dtype=CHUNK_ENTRY)
+        changed = np.ones(layer.hashes.shape, dtype=bool)
+    else:
+        table = old.copy()
+        changed = (old["hash"] != layer.hashes) | (layer.chunk_versions > since)
+    table["hash"] = layer.hashes
+    for y, x in zip(*np.nonzero(changed)):
+        block = layer.read_chunk(int(x), int(y))
+        if (block == EMPTY).all():
+            table[y, x] = (0, 0, 0, layer.hashes[y, x])
+        else:
+            write_blob(file, table[y, x], zlib.compress(block.astype("<i4").tobytes(), level))
+    return table, changed.any(axis=1)
+
+
+def append_pages(file, table: np.ndarray, pages: np.ndarray, rows: np.ndarray):
+    for y in np.flatnonzero(rows):
+        write_blob(file, pages[y], zlib.compress(table[y].tobytes(), 1))
+
+
+def encode_root(header: dict, pages: list) -> bytes:
+    header = json.dumps(header).encode()
+    return b"".join([struct.pack("<I", len(header)), header] + [layer_pages.tobytes() for layer_pages in pages])
+
+
+def decode_root(data: bytes):
+    header_length, = struct.unpack_from("<I", data)
+    header = json.loads(data[4:4 + header_length])
+    offset = 4 + header_length
+    pages = []
+    for layer in header["layers"]:
+        rows = -(-int(layer["size"][1]) // CHUNK_SIZE)
+        pages.append(np.frombuffer(data, dtype=PAGE_ENTRY, count=rows, offset=offset).copy())
+        offset += rows * PAGE_ENTRY.itemsize
+    return header, pages
+
+
+def create_chunk_file(path: str) -> ChunkFile:
+    # New files are built next to the target and renamed over it once complete
+    with open(path, "wb") as file:
+        file.write(bytes(HEADER_SIZE))
+    return ChunkFile(path)
+
+
+def write_snapshot(snapshot: MapSnapshot, path: str, chunk_file: ChunkFile = None) -> ChunkFile:
+    # A cached chunk file is only appended to while the file on disk is still the one it describes
+    if chunk_file is not None and (chunk_file.path != path or not chunk_file.is_current()):
+        chunk_file = None
+    if chunk_file is None and os.path.exists(path):
+        try:
+            chunk_file = ChunkFile.open(path)
+        except (ValueError, struct.error, zlib.error):
+            chunk_file = None
+    if chunk_file is not None:
+        chunk_file.write(snapshot)
+        return chunk_file
+    chunk_file = create_chunk_file(path + ".tmp")
+    chunk_file.write(snapshot)
+    os.replace(chunk_file.path, path)
+    chunk_file.path = path
+    chunk_file.restat()
+    return chunk_file
+
+
+def save_map(tile_map: Map, path: str):
+    snapshot = MapSnapshot(tile_map)
+    try:
+        write_snapshot(snapshot, path)
+    finally:
+        snapshot.release()
+    tile_map.mark_saved(snapshot.versions, snapshot.entity_version)
+
+
+def find_tileset(header: dict, tilesets: list) -> TilesetProperties:
+    for tileset in tilesets:
+        if header["path"] and tileset.path == header["path"]:
+            return tileset
+    for tileset in tilesets:
+        if tileset.name == header["name"]:
+            return tileset
+    if not header["path"]:
+        raise ValueError(f"Tileset {header['name']} is not loaded and the map does not say where its image is")
+    tileset = TilesetProperties(
+        name=header["name"],
+        tilesize=Vec2(header["tilesize"]),
+        tilemargin=Vec2(header["tilemargin"]),
+        tilespacing=Vec2(header["tilespacing"]),
+        tileset=pygame.image.load(header["path"]),
+        color=pygame.Color(*header["color"]),
+        path=header["path"],
+        solid=frozenset(header.get("solid", ())),
+    )
+    tilesets.append(tileset)
+    return tileset
+
+
+def load_map(path: str, tilesets: list = None) -> Map:
+    tilesets = [] if tilesets is None else tilesets
+    chunk_file = ChunkFile.open(path)
+    header = chunk_file.header
+    map_tilesets = [find_tileset(tileset, tilesets) for tileset in header["tilesets"]]
+    layers = []
+    for layer_header, data in zip(header["layers"], chunk_file.read_layers()):
+        layer = Layer(
+            Vec2(0, 0), Vec2(layer_header["size"]), map_tilesets[layer_header["tileset"]],
+            autotile=layer_header["autotile"], tilesets=map_tilesets,
+            collision=layer_header.get("collision", False)
+        )
+        layer.data = data
+        layers.append(layer)
+    entities = [
+        Entity(
+            Vec2(entity["pos"]),
+            load_sprite_sheet(entity["sprite_sheet"], tuple(int(side) for side in entity["frame_size"])),
+            name=entity["name"],
+            animation=entity["animation"],
+            loop=entity["loop"],
+        )
+        for entity in header["entities"]
+    ]
+    tile_map = Map(
+        Vec2(header["size"]), map_tilesets, [], entities,
+        default_tileset_index=header["default_tileset_index"]
+    )
+    for layer in layers:
+        tile_map.append_layer(layer)
+    if -len(layers) <= header["active_layer"] < len(layers):
+        tile_map.active_layer = header["active_layer"]
+    tile_map.path = path
+    tile_map.mark_saved(tile_map.layer_versions, tile_map.entity_version)
+    return tile_map
+
+
+class MapSaver:
+    def __init__(self, compact_threshold: float = 0.5, compact_min_bytes: int = 1024 * 1024):
+        # A single worker keeps saves of the same file in order, and owns the open chunk files
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="map-saver")
+        # Saves queued or running per map, counted up on the main thread and down on the worker
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.files = {}
+        self.compact_threshold = compact_threshold
+        self.compact_min_bytes = compact_min_bytes
+
+    def is_saving(self, tile_map: Map) -> bool:
+        with self.pending_lock:
+            return self.pending.get(id(tile_map), 0) > 0
+
+    def save_async(self, tile_map: Map, path: str, autosave: bool = False):
+        snapshot = MapSnapshot(tile_map)
+        with self.pending_lock:
+            self.pending[id(tile_map)] = self.pending.get(id(tile_map), 0) + 1
+        return self.executor.submit(self.save, snapshot, path, autosave)
+
+    def save(self, snapshot: MapSnapshot, path: str, autosave: bool = False):
+        start = time.perf_counter()
+        error = None
+        try:
+            self.files[path] = write_snapshot(snapshot, path, self.files.get(path))
+        except Exception as exception:
+            self.files.pop(path, None)
+            error = exception
+        finally:
+            snapshot.release()
+            with self.pending_lock:
+                self.pending[id(snapshot.map)] -= 1
+                if not self.pending[id(snapshot.map)]:
+                    del self.pending[id(snapshot.map)]
+        chunk_file = self.files.get(path)
+        if chunk_file is not None and chunk_file.size >= self.compact_min_bytes and \
+                chunk_file.fragmentation > self.compact_threshold:
+            try:
+                self.executor.submit(self.compact, path)
+            except RuntimeError:
+                # shutdown() has started, the file is compacted on a later save
+                pass
+        # Errors are reported through the result rather than raised, nothing reads the future save_async returns
+        result = {
+            "map": snapshot.map,
+            "path": path,
+            "autosave": autosave,
+            "ok": error is None,
+            "error": error,
+            "versions": snapshot.versions,
+            "entity_version": snapshot.entity_version,
+            "duration": time.perf_counter() - start,
+        }
+        if pygame.display.get_init():
+            pygame.event.post(pygame.event.Event(SAVE_DONE, result))
+        return result
+
+    def compact(self, path: str):
+        chunk_file = self.files.get(path)
+        if chunk_file is None or not chunk_file.is_current():
+            return
+        try:
+            chunk_file.compact()
+        except OSError:
+            self.files.pop(path, None)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
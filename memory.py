@@ -0,0 +1,88 @@
+import heapq
+import weakref
+
+MB = 1024 * 1024
+
+
+def owner_name(owner) -> str:
+    return owner if isinstance(owner, str) else getattr(owner, "memory_name", type(owner).__name__)
+
+
+class MemoryTracker:
+    # Everything holding sizeable caches or surfaces registers here under an owner: a map, "tilesets", "ui"...
+    # Registered objects report their bytes per category through memory_usage(). Those able to drop data also
+    # implement lru_tick(), the frame their least recently used entry was last drawn in, and evict_lru() which
+    # frees that entry and returns the bytes released
+    def __init__(self, budget: int = 1024 * MB):
+        self.budget = budget
+        self.frame = 0
+        self.__entries = {}
+
+    def register(self, obj, owner=None):
+        # Both are held weakly, an owner left unset is the object itself
+        key = id(obj)
+        entry = self.__entries.get(key)
+        ref = entry[0] if entry is not None else weakref.ref(obj, lambda _, key=key: self.__entries.pop(key, None))
+        if owner is None or owner is obj:
+            owner = ref
+        elif not isinstance(owner, str):
+            owner = weakref.ref(owner)
+        self.__entries[key] = (ref, owner)
+
+    def unregister(self, obj):
+        self.__entries.pop(id(obj), None)
+
+    def entries(self) -> list:
+        # (object, owner) pairs still alive
+        entries = []
+        for ref, owner in list(self.__entries.values()):
+            obj = ref()
+            if obj is None:
+                continue
+            if not isinstance(owner, str):
+                owner = owner()
+                if owner is None:
+                    continue
+            entries.append((obj, owner))
+        return entries
+
+    def breakdown(self) -> dict:
+        # {owner name: {category: bytes}}
+        usage = {}
+        for obj, owner in self.entries():
+            categories = usage.setdefault(owner_name(owner), {})
+            for category, size in obj.memory_usage().items():
+                categories[category] = categories.get(category, 0) + size
+        return usage
+
+    def total(self) -> int:
+        return sum(sum(obj.memory_usage().values()) for obj, _ in self.entries())
+
+    def enforce(self, budget: int = None) -> int:
+        # Drops least recently used entries across every cache until the total fits. Entries drawn in the current
+        # frame are kept even over budget, evicting them would only rebuild them on the next one
+        budget = self.budget if budget is None else budget
+        excess = self.total() - budget
+        freed = 0
+        if excess <= 0:
+            return freed
+        caches = [obj for obj, _ in self.entries() if hasattr(obj, "evict_lru")]
+        heap = [(tick, i) for i, tick in enumerate(cache.lru_tick() for cache in caches) if tick is not None]
+        heapq.heapify(heap)
+        while heap and freed < excess:
+            tick, i = heapq.heappop(heap)
+            if tick >= self.frame:
+                break
+            freed += caches[i].evict_lru()
+            tick = caches[i].lru_tick()
+            if tick is not None:
+                heapq.heappush(heap, (tick, i))
+        return freed
+
+    def next_frame(self) -> int:
+        freed = self.enforce()
+        self.frame += 1
+        return freed
+
+
+memory = MemoryTracker()
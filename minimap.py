@@ -0,0 +1,196 @@
+import math
+
+import numpy as np
+import pygame
+from pygame.locals import *
+from pygame.math import Vector2 as Vec2
+
+from tileset import TilesetProperties, GidTable, get_tile_rect
+from sprite_cache import surface_bytes
+from memory import memory
+from input_state import input_state
+
+_tile_colors = {}
+_gid_colors = {}
+
+
+def get_tile_colors(tileset: TilesetProperties) -> np.ndarray:
+    # One averaged RGBA colour per tile, plus a transparent last row so that EMPTY (-1) indexes into it
+    cached = _tile_colors.get(id(tileset))
+    if cached is not None and cached[0] is tileset.tileset:
+        return cached[1]
+
+    rgb = pygame.surfarray.array3d(tileset.tileset).astype(np.float64)
+    alpha = pygame.surfarray.array_alpha(tileset.tileset).astype(np.float64)
+    colors = np.zeros((tileset.tile_count + 1, 4), dtype=np.uint8)
+    for i in range(tileset.tile_count):
+        rect = get_tile_rect(tileset, i)
+        weights = alpha[rect.left:rect.right, rect.top:rect.bottom]
+        total = weights.sum()
+        if total:
+            pixels = rgb[rect.left:rect.right, rect.top:rect.bottom]
+            colors[i, :3] = (pixels * weights[..., None]).sum(axis=(0, 1)) / total
+            colors[i, 3] = 255
+    _tile_colors[id(tileset)] = (tileset.tileset, colors)
+    return colors
+
+
+def get_gid_colors(tilesets: list, table: GidTable) -> np.ndarray:
+    # Same layout as table.dense(): every tile of every tileset, then a transparent row for EMPTY
+    cached = _gid_colors.get(id(tilesets))
+    if cached is not None and cached[0] is table and cached[1] is table.sources:
+        return cached[2]
+    colors = np.concatenate([get_tile_colors(tileset)[:-1] for tileset in tilesets] + [np.zeros((1, 4), dtype=np.uint8)])
+    _gid_colors[id(tilesets)] = (table, table.sources, colors)
+    return colors
+
+
+class Minimap:
+    def __init__(
+        self,
+        rect: pygame.Rect,
+        tile_map,
+        background_color: pygame.Color = pygame.Color(32, 32, 32),
+        view_color: pygame.Color = pygame.Color(8, 112, 194),
+        chunks_per_frame: int = 32,
+    ):
+        self.rect = rect
+        self.map = tile_map
+        self.background_color = background_color
+        self.view_color = view_color
+        self.chunks_per_frame = chunks_per_frame
+        self.view_size = Vec2(rect.size)
+        self.rebuild()
+        memory.register(self, tile_map)
+
+    def memory_usage(self) -> dict:
+        return {"minimap": surface_bytes(self.overview) + surface_bytes(self.surf)}
+
+    def set_map(self, tile_map):
+        self.map = tile_map
+        self.rebuild()
+        memory.register(self, tile_map)
+
+    def rebuild(self):
+        self.map_size = (int(self.map.size.x), int(self.map.size.y))
+        self.factor = min(self.rect.width / self.map_size[0], self.rect.height / self.map_size[1])
+        self.overview = pygame.Surface(self.map_size)
+        self.surf = pygame.Surface((
+            max(round(self.map_size[0] * self.factor), 1),
+            max(round(self.map_size[1] * self.factor), 1)
+        ))
+        self.layer_ids = tuple(id(layer) for layer in self.map.layers)
+        self.seen_versions = {id(layer): layer.version for layer in self.map.layers}
+        self.pending = set()
+        self.render_region(pygame.Rect((0, 0), self.map_size))
+
+    def render_region(self, region: pygame.Rect):
+        block = np.empty((region.height, region.width, 3), dtype=np.uint8)
+        block[:] = tuple(self.background_color)[:3]
+        for layer in self.map.layers:
+            table = layer.gid_table
+            colors = get_gid_colors(layer.tilesets, table)[table.dense(layer.data[region.top:region.bottom, region.left:region.right])]
+            opaque = colors[..., 3] > 0
+            block[opaque] = colors[..., :3][opaque]
+
+        pixels = pygame.surfarray.pixels3d(self.overview)
+        pixels[region.left:region.right, region.top:region.bottom] = block.transpose(1, 0, 2)
+        del pixels
+
+        left, top = math.floor(region.left * self.factor), math.floor(region.top * self.factor)
+        right = min(math.ceil(region.right * self.factor), self.surf.get_width())
+        bottom = min(math.ceil(region.bottom * self.factor), self.surf.get_height())
+        if right <= left or bottom <= top:
+            return
+        src_left, src_top = int(left / self.factor), int(top / self.factor)
+        src_right = min(max(math.ceil(right / self.factor), src_left + 1), self.map_size[0])
+        src_bottom = min(max(math.ceil(bottom / self.factor), src_top + 1), self.map_size[1])
+        source = self.overview.subsurface(pygame.Rect(src_left, src_top, src_right - src_left, src_bottom - src_top))
+        self.surf.blit(pygame.transform.scale(source, (right - left, bottom - top)), (left, top))
+
+    def update(self):
+        if (int(self.map.size.x), int(self.map.size.y)) != self.map_size or \
+                tuple(id(layer) for layer in self.map.layers) != self.layer_ids:
+            self.rebuild()
+            return
+
+        for layer in self.map.layers:
+            seen = self.seen_versions[id(layer)]
+            if seen != layer.version:
+                self.pending.update(layer.changed_chunks(seen))
+                self.seen_versions[id(layer)] = layer.version
+
+        for _ in range(min(self.chunks_per_frame, len(self.pending))):
+            x, y = self.pending.pop()
+            self.render_region(self.map.layers[0].chunk_rect((x, y)))
+
+    def draw(self, surface: pygame.Surface):
+        self.view_size = Vec2(surface.get_size())
+        surface.fill(self.background_color, self.rect)
+        surface.blit(self.surf, self.rect)
+
+        view = self.map.view_rect(surface)
+        tilesize = self.map.tilesize
+        view_rect = pygame.Rect(
+            self.rect.left + view.left / tilesize.x * self.factor,
+            self.rect.top + view.top / tilesize.y * self.factor,
+            view.width / tilesize.x * self.factor,
+            view.height / tilesize.y * self.factor,
+        ).clip(self.rect)
+        if view_rect.width and view_rect.height:
+            pygame.draw.rect(surface, self.view_color, view_rect, 1)
+
+    def on_click(self) -> bool:
+        mouse_pos = Vec2(input_state.mouse_pos())
+        if not self.rect.collidepoint(mouse_pos):
+            return False
+        tile_pos = (mouse_pos - self.rect.topleft) / self.factor
+        map_pos = tile_pos.elementwise() * self.map.tilesize
+        self.map.display_offset = self.view_size / 2 - map_pos * self.map.display_scale
+        return True
+
+
+if __name__ == "__main__":
+    import random
+
+    from mapClass import Map
+
+    pygame.init()
+    screen = pygame.display.set_mode((800, 600))
+    pygame.display.set_caption("Minimap Test")
+    clock = pygame.time.Clock()
+
+    grass = TilesetProperties(
+        name="Grass",
+        tilesize=Vec2(16, 16),
+        tilemargin=Vec2(0, 0),
+        tilespacing=Vec2(0, 0),
+        tileset=pygame.image.load("assets/Biome/Foreground/Textured/Grass.png"),
+        color=pygame.Color(0, 0, 0, 0),
+    )
+    my_map = Map(Vec2(256, 256), [grass], [], [], display_scale=0.5)
+    my_map.append_layer()
+    my_map.layers[0].autotile = True
+    minimap = Minimap(pygame.Rect(600, 0, 200, 200), my_map)
+
+    running = True
+    while running:
+        for event in pygame.event.get():
+            if event.type == QUIT:
+                running = False
+            elif event.type == MOUSEBUTTONDOWN:
+                if event.button == 1 and not minimap.on_click():
+                    x, y = random.randrange(256), random.randrange(256)
+                    my_map.layers[0].fill_region(pygame.Rect(x, y, 12, 8))
+                elif event.button == 3:
+                    my_map.layers[0].add_tile()
+
+        my_map.update()
+        minimap.update()
+
+        screen.fill((0, 0, 0))
+        my_map.draw(screen)
+        minimap.draw(screen)
+
+        pygame.display.flip()
+        clock.tick(60)
@@ -0,0 +1,282 @@
+import math
+from collections import OrderedDict
+
+import numpy as np
+import pygame
+from pygame.math import Vector2 as Vec2
+
+from layer import CHUNK_SIZE, EMPTY
+from tileset import GidTable
+from sprite_cache import surface_bytes
+from memory import memory
+from input_state import input_state
+
+# (dx, dy, cost) of the 8 moves; diagonals may not cut the corner of a blocked cell
+MOVES = (
+    (1, 0, 1.0), (-1, 0, 1.0), (0, 1, 1.0), (0, -1, 1.0),
+    (1, 1, math.sqrt(2)), (1, -1, math.sqrt(2)), (-1, 1, math.sqrt(2)), (-1, -1, math.sqrt(2)),
+)
+
+_solid_gids = {}
+
+
+def get_solid_gids(tilesets: list, table: GidTable) -> np.ndarray:
+    # Same layout as table.dense(): whether each tile blocks movement, then False for EMPTY
+    solid_sets = tuple(frozenset(tileset.solid) for tileset in tilesets)
+    cached = _solid_gids.get(id(tilesets))
+    if cached is not None and cached[0] is table and cached[1] == solid_sets:
+        return cached[2]
+    solid = np.zeros(table.count + 1, dtype=bool)
+    for tileset, offset, tiles in zip(tilesets, table.offsets.tolist(), solid_sets):
+        indices = [index for index in tiles if 0 <= index < tileset.tile_count]
+        solid[np.array(indices, dtype=np.int64) + offset] = True
+    _solid_gids[id(tilesets)] = (table, solid_sets, solid)
+    return solid
+
+
+class NavGrid:
+    # Walkability of every cell of a map: blocked where a collision layer has any tile, or any layer a solid one.
+    # Kept in step with edits chunk by chunk; flood fields are cached per start cell until the grid changes.
+    def __init__(self, tile_map, field_limit: int = 4):
+        self.map = tile_map
+        self.field_limit = field_limit
+        self.version = 0
+        self.__fields = OrderedDict()
+        self.rebuild()
+
+    def layout(self) -> tuple:
+        # Anything here changing means every cell has to be recomputed
+        return (
+            (int(self.map.size.x), int(self.map.size.y)),
+            tuple((id(layer), layer.collision) for layer in self.map.layers),
+            tuple(frozenset(tileset.solid) for tileset in self.map.tilesets),
+        )
+
+    def rebuild(self):
+        self.__layout = self.layout()
+        self.shape = (int(self.map.size.y), int(self.map.size.x))
+        self.seen_versions = {id(layer): layer.version for layer in self.map.layers}
+        self.blocked = self.blocked_region(pygame.Rect(0, 0, self.shape[1], self.shape[0]))
+        self.changed()
+
+    def blocked_region(self, region: pygame.Rect) -> np.ndarray:
+        blocked = np.zeros((region.height, region.width), dtype=bool)
+        for layer in self.map.layers:
+            cells = layer.data[region.top:region.bottom, region.left:region.right]
+            if layer.collision:
+                blocked |= cells != EMPTY
+                continue
+            table = layer.gid_table
+            solid = get_solid_gids(layer.tilesets, table)
+            if solid.any():
+                blocked |= solid[table.dense(cells)]
+        return blocked
+
+    def changed(self):
+        self.version += 1
+        self.__fields.clear()
+        height, width = self.shape
+        # A blocked border around the grid lets the searches step to neighbours without bounds checks
+        self.stride = width + 2
+        self.open = np.zeros((height + 2, width + 2), dtype=bool)
+        self.open[1:-1, 1:-1] = ~self.blocked
+        self.open = self.open.ravel()
+
+    def update(self) -> bool:
+        # Recomputes only the chunks edited since the last update, returns whether walkability changed
+        if self.layout() != self.__layout:
+            self.rebuild()
+            return True
+        chunks = set()
+        for layer in self.map.layers:
+            seen = self.seen_versions[id(layer)]
+            if layer.version > seen:
+                chunks.update(layer.changed_chunks(seen))
+                self.seen_versions[id(layer)] = layer.version
+        bounds = pygame.Rect(0, 0, self.shape[1], self.shape[0])
+        changed = False
+        for x, y in chunks:
+            region = pygame.Rect(x * CHUNK_SIZE, y * CHUNK_SIZE, CHUNK_SIZE, CHUNK_SIZE).clip(bounds)
+            blocked = self.blocked_region(region)
+            target = self.blocked[region.top:region.bottom, region.left:region.right]
+            if (blocked != target).any():
+                target[...] = blocked
+                changed = True
+        if changed:
+            self.changed()
+        return changed
+
+    @property
+    def nbytes(self) -> int:
+        return self.blocked.nbytes + self.open.nbytes + sum(costs.nbytes for costs in self.__fields.values())
+
+    def index(self, cell) -> int:
+        return (int(cell[1]) + 1) * self.stride + int(cell[0]) + 1
+
+    def walkable(self, cell) -> bool:
+        x, y = int(cell[0]), int(cell[1])
+        return 0 <= x < self.shape[1] and 0 <= y < self.shape[0] and not self.blocked[y, x]
+
+    def padded_flood(self, start) -> np.ndarray:
+        # Cost of the cheapest walk from start to every cell of the padded grid, inf where unreachable.
+        # Dijkstra run as vectorized wavefronts: a move costs at least 1, so every frontier cell within 1 of the
+        # cheapest one is final and the whole batch is settled and expanded at once
+        start = (int(start[0]), int(start[1]))
+        costs = self.__fields.get(start)
+        if costs is not None:
+            self.__fields.move_to_end(start)
+            return costs
+        costs = np.full(self.open.shape, np.inf)
+        if self.walkable(start):
+            settled = ~self.open
+            first = self.index(start)
+            costs[first] = 0
+            frontier = np.array([first], dtype=np.int64)
+            owner = np.zeros(self.open.shape, dtype=np.int64)
+            while len(frontier):
+                frontier_costs = costs[frontier]
+                final = frontier_costs < frontier_costs.min() + 1
+                done, frontier = frontier[final], frontier[~final]
+                settled[done] = True
+                reached = [frontier]
+                for dx, dy, step in MOVES:
+                    source = done
+                    if dx and dy:
+                        source = source[self.open[source + dx] & self.open[source + dy * self.stride]]
+                    moved = source + (dy * self.stride + dx)
+                    unsettled = ~settled[moved]
+                    moved = moved[unsettled]
+                    np.minimum.at(costs, moved, costs[source[unsettled]] + step)
+                    reached.append(moved)
+                frontier = np.concatenate(reached)
+                # Cells reached from several neighbours are kept once
+                owner[frontier] = np.arange(len(frontier))
+                frontier = frontier[owner[frontier] == np.arange(len(frontier))]
+        self.__fields[start] = costs
+        while len(self.__fields) > self.field_limit:
+            self.__fields.popitem(last=False)
+        return costs
+
+    def flood(self, start) -> np.ndarray:
+        height, width = self.shape
+        return self.padded_flood(start).reshape(height + 2, width + 2)[1:-1, 1:-1]
+
+    def reachable(self, start, goal) -> bool:
+        return self.walkable(goal) and self.padded_flood(start)[self.index(goal)] < np.inf
+
+    def find_path(self, start, goal) -> list:
+        # The start's cost field answers every goal: walking back from the goal to a neighbour whose cost plus the
+        # move gives the current cost yields a cheapest path, as A* would, in time proportional to its length
+        if not self.walkable(start) or not self.reachable(start, goal):
+            return None
+        costs = memoryview(self.padded_flood(start))
+        walkable = memoryview(self.open.view(np.uint8))
+        stride = self.stride
+        current, target = self.index(goal), self.index(start)
+        path = [current]
+        while current != target:
+            cost = costs[current]
+            # Sums along long paths drift, so the tolerance grows with the cost
+            tolerance = 1e-6 * max(cost, 1.0)
+            for dx, dy, step in MOVES:
+                if dx and dy and not (walkable[current + dx] and walkable[current + dy * stride]):
+                    continue
+                neighbour = current + dy * stride + dx
+                if abs(costs[neighbour] + step - cost) < tolerance:
+                    break
+            else:
+                # The field does not match the grid (it should never happen), no path beats a wrong one
+                return None
+            current = neighbour
+            path.append(current)
+        path.reverse()
+        return [(cell % stride - 1, cell // stride - 1) for cell in path]
+
+
+class PathTool:
+    # First click sets the start, the path then follows the mouse until a second click pins the goal
+    def __init__(self, tile_map, color: pygame.Color = pygame.Color(8, 112, 194)):
+        self.map = tile_map
+        self.color = color
+        self.nav = None
+        self.start = None
+        self.goal = None
+        self.path = None
+        self.show_heatmap = False
+        self.__heatmap = None
+        memory.register(self, tile_map)
+
+    def memory_usage(self) -> dict:
+        usage = {}
+        if self.nav is not None:
+            usage["nav"] = self.nav.nbytes
+        if self.__heatmap is not None:
+            usage["heatmap"] = surface_bytes(self.__heatmap[1])
+        return usage
+
+    def cell_at(self, screen_pos: Vec2) -> tuple:
+        cell = self.map.to_map_pos(screen_pos).elementwise() // self.map.tilesize
+        return int(cell.x), int(cell.y)
+
+    def press(self, screen_pos: Vec2):
+        if self.nav is None:
+            self.nav = NavGrid(self.map)
+        cell = self.cell_at(screen_pos)
+        if self.start is None or self.goal is not None:
+            self.start, self.goal = cell, None
+        else:
+            self.goal = cell
+        self.path = self.nav.find_path(self.start, cell)
+
+    def motion(self, screen_pos: Vec2):
+        if self.start is not None and self.goal is None:
+            self.path = self.nav.find_path(self.start, self.cell_at(screen_pos))
+
+    def cancel(self):
+        self.start = self.goal = self.path = None
+
+    def update(self):
+        if self.nav is not None and self.nav.update() and self.start is not None:
+            self.path = self.nav.find_path(self.start, self.goal if self.goal is not None else self.cell_at(input_state.mouse_pos()))
+
+    def heatmap(self) -> pygame.Surface:
+        # One pixel per cell: reachable cells shaded by their distance from the start, blocked ones darkened
+        key = (self.nav.version, self.start)
+        if self.__heatmap is not None and self.__heatmap[0] == key:
+            return self.__heatmap[1]
+        costs = self.nav.flood(self.start)
+        reachable = np.isfinite(costs)
+        t = np.where(reachable, costs, 0) / max(float(costs[reachable].max(initial=0)), 1)
+        surf = pygame.Surface((self.nav.shape[1], self.nav.shape[0]), pygame.SRCALPHA)
+        pixels = pygame.surfarray.pixels3d(surf)
+        pixels[..., 0] = np.where(reachable, t * 255, 0).T
+        pixels[..., 1] = np.where(reachable, 64, 0).T
+        pixels[..., 2] = np.where(reachable, (1 - t) * 255, 0).T
+        del pixels
+        alpha = pygame.surfarray.pixels_alpha(surf)
+        alpha[...] = np.where(reachable, 110, np.where(self.nav.blocked, 140, 0)).T
+        del alpha
+        self.__heatmap = (key, surf)
+        return surf
+
+    def draw(self, surface: pygame.Surface):
+        if not self.map.layers or self.start is None:
+            return
+        layer = self.map.layers[0]
+        if self.show_heatmap:
+            heatmap = self.heatmap()
+            # Only the visible part is scaled, whatever the map size
+            view = pygame.Rect(self.cell_at((0, 0)), (0, 0))
+            view.union_ip(pygame.Rect(self.cell_at(surface.get_size()), (1, 1)))
+            view = view.clip(heatmap.get_rect())
+            if view.width and view.height:
+                target = layer.screen_rect(view)
+                surface.blit(pygame.transform.scale(heatmap.subsurface(view), target.size), target)
+        if self.path:
+            centers = [layer.screen_rect(pygame.Rect(cell, (1, 1))).center for cell in self.path]
+            if len(centers) > 1:
+                pygame.draw.lines(surface, self.color, False, centers, 3)
+        for cell in (self.start, self.goal):
+            if cell is not None:
+                rect = layer.screen_rect(pygame.Rect(cell, (1, 1)))
+                pygame.draw.circle(surface, self.color, rect.center, max(rect.width // 3, 3))
@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pygame
+
+from input_state import input_state
+
+# Only what the user did is recorded; events the app posts to itself (saves, reloads, timers) happen again on replay
+INPUT_EVENTS = (
+    pygame.QUIT, pygame.KEYDOWN, pygame.KEYUP, pygame.TEXTINPUT,
+    pygame.MOUSEMOTION, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP, pygame.MOUSEWHEEL,
+    pygame.VIDEORESIZE,
+)
+EVENT_TYPES = {pygame.event.event_name(event_type): event_type for event_type in INPUT_EVENTS}
+PHASES = ("events", "update", "draw", "frame")
+PERCENTILES = (50, 95, 99)
+
+
+def encode_event(event: pygame.event.Event) -> dict:
+    fields = {"type": pygame.event.event_name(event.type)}
+    for key, value in event.dict.items():
+        if key == "window":
+            continue
+        fields[key] = list(value) if isinstance(value, tuple) else value
+    return fields
+
+
+def decode_event(fields: dict) -> pygame.event.Event:
+    fields = dict(fields)
+    event_type = EVENT_TYPES[fields.pop("type")]
+    return pygame.event.Event(event_type, {key: tuple(value) if isinstance(value, list) else value for key, value in fields.items()})
+
+
+class EventRecorder:
+    # One JSON line per frame that had input: the ms since recording started and the events of that frame.
+    # The first line holds the window size the session starts with
+    def __init__(self, path: str, size):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.file = open(path, "w", encoding="utf-8")
+        self.start = input_state.get_ticks()
+        self.file.write(json.dumps({"size": [int(size[0]), int(size[1])], "pygame": pygame.version.ver}) + "\n")
+
+    def record(self, events: list):
+        events = [encode_event(event) for event in events if event.type in INPUT_EVENTS]
+        if events:
+            self.file.write(json.dumps({"t": input_state.get_ticks() - self.start, "events": events}) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+def load_session(path: str):
+    # Returns the header and a list of (ms, event) in order
+    with open(path, encoding="utf-8") as file:
+        header = json.loads(file.readline())
+        events = []
+        for line in file:
+            if line.strip():
+                frame = json.loads(line)
+                events.extend((frame["t"], decode_event(fields)) for fields in frame["events"])
+    return header, events
+
+
+def percentiles(times: list) -> dict:
+    times = np.asarray(times, dtype=np.float64)
+    if not len(times):
+        return {}
+    stats = {f"p{q}": float(np.percentile(times, q)) for q in PERCENTILES}
+    stats["max"] = float(times.max())
+    return stats
+
+
+def calibrate(repeats: int = 20) -> float:
+    # ms a fixed mix of tile blits, scaling and array work takes right now. Reports carry it so that a baseline
+    # made on another machine, or on this one under another load, is scaled to the speed of the current run
+    tile = pygame.Surface((16, 16), pygame.SRCALPHA)
+    tile.fill((200, 120, 40, 255))
+    sheet = pygame.Surface((512, 512), pygame.SRCALPHA)
+    cells = np.random.default_rng(0).integers(-1, 4096, (64, 64))
+    start = time.perf_counter()
+    for _ in range(repeats):
+        sheet.blits([(tile, (x * 16, y * 16)) for y in range(32) for x in range(32)], doreturn=False)
+        pygame.transform.scale(sheet, (700, 700))
+        np.unique(np.where(cells == -1, 4096, cells & 0xFFF), return_counts=True)
+    return (time.perf_counter() - start) * 1000 / repeats
+
+
+def median_report(reports: list) -> dict:
+    # Each statistic's median over several replays of one session. A single replay picks up whatever else the
+    # machine was doing, enough to move a p95 by half
+    phases = {
+        phase: {name: float(np.median([report["phases"][phase][name] for report in reports])) for name in stats}
+        for phase, stats in reports[0]["phases"].items()
+    }
+    report = {"session": reports[0]["session"], "frames": reports[0]["frames"], "runs": len(reports), "phases": phases}
+    if all("calibration" in report for report in reports):
+        report["calibration"] = float(np.median([report["calibration"] for report in reports]))
+    return report
+
+
+def regressions(report: dict, baseline: dict, tolerance: float = 0.25, slack: float = 1.0) -> list:
+    # Phases whose p95 grew by more than tolerance, plus slack ms so that millisecond noise never fails a build.
+    # The baseline is first scaled by how much slower or faster the machine ran the calibration
+    scale = report["calibration"] / baseline["calibration"] if "calibration" in report and "calibration" in baseline else 1.0
+    failed = []
+    for phase, stats in baseline["phases"].items():
+        current = report["phases"].get(phase)
+        if current and current["p95"] > stats["p95"] * scale * (1 + tolerance) + slack:
+            failed.append((phase, stats["p95"], current["p95"]))
+    return failed
+
+
+class Replayer:
+    # Feeds a recorded session to a fresh Main, one frame every step ms of a fixed clock, and times each phase
+    def __init__(self, path: str, step: float = 1000 / 60, settle_frames: int = 30):
+        self.path = path
+        self.step = step
+        self.settle_frames = settle_frames
+        self.header, self.events = load_session(path)
+
+    def run(self, main_class=None) -> dict:
+        if main_class is None:
+            from main import Main as main_class
+        input_state.replaying = True
+        input_state.ticks = 0
+        input_state.pos = (0, 0)
+        input_state.pressed = (False, False, False)
+        try:
+            main = main_class(pygame.math.Vector2(self.header["size"]))
+            # Autosaves run on wall clock time and would land on random frames
+            pygame.time.set_timer(main.autosave_event, 0)
+            times = {phase: [] for phase in PHASES}
+            pending = list(reversed(self.events))
+            frame = 0
+            settle = self.settle_frames
+            main.running = True
+            while main.running and (pending or settle > 0):
+                input_state.ticks = round(frame * self.step)
+                while pending and pending[-1][0] <= input_state.ticks:
+                    event = pending.pop()[1]
+                    if event.type == pygame.VIDEORESIZE:
+                        main.display = pygame.display.set_mode(event.size, pygame.RESIZABLE)
+                    pygame.event.post(event)
+                if not pending:
+                    settle -= 1
+                start = time.perf_counter()
+                main.process_events()
+                events_done = time.perf_counter()
+                main.update()
+                update_done = time.perf_counter()
+                main.draw()
+                draw_done = time.perf_counter()
+                times["events"].append((events_done - start) * 1000)
+                times["update"].append((update_done - events_done) * 1000)
+                times["draw"].append((draw_done - update_done) * 1000)
+                times["frame"].append((draw_done - start) * 1000)
+                frame += 1
+            main.shutdown()
+        finally:
+            input_state.replaying = False
+        return {
+            "session": os.path.basename(self.path),
+            "frames": frame,
+            "phases": {phase: percentiles(values) for phase, values in times.items()},
+        }
+
+
+def replay_session(path: str, runs: int = 3, main_class=None) -> dict:
+    reports = []
+    for _ in range(runs):
+        # Calibrated right before each run, so that both see the same load
+        calibration = calibrate()
+        reports.append(dict(Replayer(path).run(main_class), calibration=calibration))
+    return median_report(reports)
+
+
+def check_sessions(paths: list, baseline: dict, runs: int = 3, tolerance: float = 0.25, slack: float = 1.0, main_class=None):
+    # Returns the reports and the (session, phase, baseline p95, p95) of every regression
+    reports = {}
+    failed = []
+    for path in paths:
+        report = replay_session(path, runs, main_class)
+        reports[report["session"]] = report
+        if report["session"] in baseline:
+            failed.extend((report["session"], *regression) for regression in regressions(report, baseline[report["session"]], tolerance, slack))
+    return reports, failed
+
+
+def format_report(report: dict) -> str:
+    runs = f", median of {report['runs']} runs" if report.get("runs", 1) > 1 else ""
+    lines = [f"{report['session']}: {report['frames']} frames{runs}"]
+    for phase, stats in report["phases"].items():
+        lines.append(f"  {phase:<7}" + "  ".join(f"{name} {value:7.2f} ms" for name, value in stats.items()))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded editor sessions and report frame times")
+    parser.add_argument("sessions", nargs="+", help="session files written by main.py --record")
+    parser.add_argument("--baseline", help="JSON report to compare p95 frame times against")
+    parser.add_argument("--save", help="write the reports to this JSON file, e.g. to make a new baseline")
+    parser.add_argument("--runs", type=int, default=3, help="replays per session, the report holds their median")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p95 growth over the baseline")
+    parser.add_argument("--slack", type=float, default=1.0, help="allowed p95 growth in ms on top of the tolerance")
+    args = parser.parse_args()
+
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    pygame.init()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+    reports, failed = check_sessions(args.sessions, baseline, args.runs, args.tolerance, args.slack)
+    for report in reports.values():
+        print(format_report(report))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(reports, file, indent=1)
+    for session, phase, before, after in failed:
+        print(f"{session}: {phase} p95 went from {before:.2f} to {after:.2f} ms")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,220 @@
+import numpy as np
+import pygame
+from pygame.math import Vector2 as Vec2
+
+from layer import Layer, EMPTY
+from shapes import normalize
+from tileset import TILE_BITS, gid_tileset, gid_index
+
+
+def tileset_position(tilesets: list, tileset) -> int:
+    # Where tileset sits in a map's list, matched by identity then by image path; added at the end if missing
+    for i, other in enumerate(tilesets):
+        if other is tileset:
+            return i
+    for i, other in enumerate(tilesets):
+        if tileset.path and other.path == tileset.path:
+            return i
+    tilesets.append(tileset)
+    return len(tilesets) - 1
+
+
+def remap_gids(array: np.ndarray, source_tilesets: list, tilesets: list) -> np.ndarray:
+    # Global ids hold the position of their tileset in their map's list, which differs from map to map
+    if source_tilesets is tilesets:
+        return array
+    mapping = np.array([tileset_position(tilesets, tileset) for tileset in source_tilesets], dtype=np.int32)
+    filled = array != EMPTY
+    tileset_ids = mapping[gid_tileset(np.where(filled, array, 0))] if len(mapping) else np.zeros_like(array)
+    return np.where(filled, (tileset_ids << TILE_BITS) | gid_index(array), EMPTY).astype(np.int32)
+
+
+class FloatingSelection:
+    def __init__(self, layers, arrays, pos: Vec2, source: pygame.Rect = None):
+        self.layers = layers
+        self.arrays = arrays
+        self.pos = Vec2(pos)
+        self.source = source
+        # Previews are throwaway layers, so they draw from the same lazy chunk cache without touching the map
+        self.previews = []
+        for layer, array in zip(layers, arrays):
+            preview = Layer(
+                Vec2(0, 0), Vec2(array.shape[1], array.shape[0]),
+                layer.tileset_properties, layer.scaling_factor, tilesets=layer.tilesets
+            )
+            preview.data = array.copy()
+            self.previews.append(preview)
+
+    @property
+    def rect(self) -> pygame.Rect:
+        height, width = self.arrays[0].shape
+        return pygame.Rect(int(self.pos.x), int(self.pos.y), width, height)
+
+    def draw(self, surface: pygame.Surface, offset: Vec2):
+        for layer, preview in zip(self.layers, self.previews):
+            if preview.scaling_factor != layer.scaling_factor:
+                preview.scaling_factor = layer.scaling_factor
+            preview.pos = Vec2(layer.screen_rect(self.rect, Vec2(0, 0)).topleft)
+            preview.draw(surface, offset)
+
+    def commit(self):
+        dest = self.rect
+        region = dest.union(self.source) if self.source else dest
+        for layer, array in zip(self.layers, self.arrays):
+            clipped = layer.clip_region(region)
+            if not clipped.width or not clipped.height:
+                continue
+            before = layer.get_tiles(clipped)
+            after = before.copy()
+            if self.source:
+                source = self.source.clip(clipped)
+                after[
+                    source.top - clipped.top:source.bottom - clipped.top,
+                    source.left - clipped.left:source.right - clipped.left
+                ] = EMPTY
+            overlap = dest.clip(clipped)
+            if overlap.width and overlap.height:
+                pasted = array[
+                    overlap.top - dest.top:overlap.bottom - dest.top,
+                    overlap.left - dest.left:overlap.right - dest.left
+                ]
+                target = after[
+                    overlap.top - clipped.top:overlap.bottom - clipped.top,
+                    overlap.left - clipped.left:overlap.right - clipped.left
+                ]
+                target[...] = np.where(pasted != EMPTY, pasted, target)
+            layer.set_tiles(clipped.topleft, after, autotile=False)
+
+
+class SelectionTool:
+    def __init__(self, tile_map, color: pygame.Color = pygame.Color(8, 112, 194)):
+        self.map = tile_map
+        self.color = color
+        self.all_layers = False
+        self.rect = None
+        self.clipboard = None
+        # The tilesets list the clipboard's global ids index into, that of the map it was copied from
+        self.clipboard_tilesets = None
+        self.floating = None
+        self.selection_start = None
+        self.drag_start = None
+        self.drag_origin = None
+
+    @property
+    def layers(self):
+        if self.all_layers:
+            return list(self.map.layers)
+        if self.map.is_tile_layer_active:
+            return [self.map.layers[self.map.active_layer]]
+        return []
+
+    def cell_at(self, screen_pos: Vec2) -> Vec2:
+        return self.map.to_map_pos(screen_pos).elementwise() // self.map.tilesize
+
+    def clip(self, rect: pygame.Rect) -> pygame.Rect:
+        # Selections hold only cells of the map, so that a lifted or copied block starts where its tiles were
+        rect = pygame.Rect(rect).clip(pygame.Rect(0, 0, self.map.size.x, self.map.size.y))
+        return rect if rect.width and rect.height else None
+
+    def press(self, screen_pos: Vec2):
+        cell = self.cell_at(screen_pos)
+        if self.floating is not None:
+            if self.floating.rect.collidepoint(cell):
+                self.start_drag(cell)
+                return
+            self.commit()
+        if self.rect is not None and self.rect.collidepoint(cell) and self.layers:
+            layers = self.layers
+            self.floating = FloatingSelection(
+                layers, [layer.get_tiles(self.rect) for layer in layers], self.rect.topleft, source=self.rect
+            )
+            self.start_drag(cell)
+            return
+        self.selection_start = cell
+        self.rect = self.clip(normalize(cell, cell))
+
+    def start_drag(self, cell: Vec2):
+        self.drag_start = cell
+        self.drag_origin = Vec2(self.floating.pos)
+
+    def motion(self, screen_pos: Vec2):
+        cell = self.cell_at(screen_pos)
+        if self.selection_start is not None:
+            self.rect = self.clip(normalize(self.selection_start, cell))
+        elif self.drag_start is not None:
+            self.floating.pos = self.drag_origin + cell - self.drag_start
+
+    def release(self, screen_pos: Vec2):
+        self.motion(screen_pos)
+        self.selection_start = None
+        if self.drag_start is not None:
+            self.drag_start = None
+            if self.floating.source is not None:
+                self.commit()
+
+    def commit(self):
+        if self.floating is None:
+            return
+        with self.map.history.recorded(self.map.layers):
+            self.floating.commit()
+        self.rect = self.clip(self.floating.rect)
+        self.floating = None
+
+    def cancel(self):
+        self.floating = None
+        self.selection_start = None
+        self.drag_start = None
+
+    def take_clipboard(self, other: "SelectionTool"):
+        # The ids are renumbered for this map's tilesets when pasted
+        self.clipboard = other.clipboard
+        self.clipboard_tilesets = other.clipboard_tilesets
+
+    def copy(self):
+        # Each array goes with the index of the layer it was copied from
+        if self.rect is not None:
+            self.clipboard = [(self.map.layers.index(layer), layer.get_tiles(self.rect)) for layer in self.layers]
+            self.clipboard_tilesets = self.map.tilesets
+
+    def cut(self):
+        self.copy()
+        if self.rect is None:
+            return
+        with self.map.history.recorded(self.map.layers):
+            for layer in self.layers:
+                region = layer.clip_region(self.rect)
+                if region.width and region.height:
+                    layer.set_tiles(region.topleft, np.full((region.height, region.width), EMPTY, dtype=np.int32), autotile=False)
+
+    def paste_targets(self) -> list:
+        # (layer, array) pairs: a single copied layer goes to the active layer, several go back to the layers
+        # they came from, keeping only the active one's when a single layer is edited
+        if not self.clipboard or not self.layers:
+            return []
+        clipboard = [(index, remap_gids(array, self.clipboard_tilesets, self.map.tilesets)) for index, array in self.clipboard]
+        if len(clipboard) == 1 and not self.all_layers:
+            return [(self.layers[0], clipboard[0][1])]
+        targets = {id(layer) for layer in self.layers}
+        return [
+            (self.map.layers[index], array) for index, array in clipboard
+            if index < len(self.map.layers) and id(self.map.layers[index]) in targets
+        ]
+
+    def paste(self, screen_pos: Vec2):
+        targets = self.paste_targets()
+        if not targets:
+            return
+        self.commit()
+        self.floating = FloatingSelection(
+            [layer for layer, _ in targets], [array for _, array in targets], self.cell_at(screen_pos)
+        )
+
+    def draw(self, surface: pygame.Surface):
+        if not self.map.layers:
+            return
+        layer = self.map.layers[0]
+        if self.floating is not None:
+            self.floating.draw(surface, self.map.display_offset)
+            pygame.draw.rect(surface, self.color, layer.screen_rect(self.floating.rect), 1)
+        elif self.rect is not None:
+            pygame.draw.rect(surface, self.color, layer.screen_rect(self.rect), 1)
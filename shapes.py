@@ -0,0 +1,49 @@
+import numpy as np
+import pygame
+
+
+def normalize(start, end) -> pygame.Rect:
+    left, right = sorted((int(start[0]), int(end[0])))
+    top, bottom = sorted((int(start[1]), int(end[1])))
+    return pygame.Rect(left, top, right - left + 1, bottom - top + 1)
+
+
+def rectangle_mask(width: int, height: int, filled: bool = True) -> np.ndarray:
+    if filled:
+        return np.ones((height, width), dtype=bool)
+    mask = np.zeros((height, width), dtype=bool)
+    mask[0, :] = mask[-1, :] = True
+    mask[:, 0] = mask[:, -1] = True
+    return mask
+
+
+def ellipse_mask(width: int, height: int, filled: bool = True) -> np.ndarray:
+    ys, xs = np.ogrid[:height, :width]
+    radius_x, radius_y = width / 2, height / 2
+    inside = ((xs + 0.5 - radius_x) / radius_x) ** 2 + ((ys + 0.5 - radius_y) / radius_y) ** 2 <= 1
+    if filled:
+        return inside
+    padded = np.pad(inside, 1)
+    interior = inside & padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+    return inside & ~interior
+
+
+def mask_outline(mask: np.ndarray) -> list:
+    # Cell edges between the mask and the cells around it, as ((x, y), (x, y)) corners counted from the mask's top left
+    padded = np.pad(mask, 1)
+    horizontal = padded[:-1, 1:-1] != padded[1:, 1:-1]
+    vertical = padded[1:-1, :-1] != padded[1:-1, 1:]
+    return [((x, y), (x + 1, y)) for y, x in np.argwhere(horizontal).tolist()] + \
+        [((x, y), (x, y + 1)) for y, x in np.argwhere(vertical).tolist()]
+
+
+SHAPES = {
+    "rectangle": lambda width, height: rectangle_mask(width, height, True),
+    "rectangle_outline": lambda width, height: rectangle_mask(width, height, False),
+    "circle": lambda width, height: ellipse_mask(width, height, True),
+}
+
+
+def shape_mask(shape: str, start, end):
+    rect = normalize(start, end)
+    return rect, SHAPES[shape](rect.width, rect.height)
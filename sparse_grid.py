@@ -0,0 +1,211 @@
+import numpy as np
+
+from tileset import EMPTY
+
+CHUNK_SIZE = 16
+
+
+class SparseGrid:
+    # A 2D int32 grid that only stores its non-empty chunks: a small chunk -> slot table plus a pool of 16x16 blocks.
+    # Reads return copies; writes go through item assignment with two slices or two index arrays.
+    dtype = np.dtype(np.int32)
+    ndim = 2
+
+    def __init__(self, shape:tuple):
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.slots = np.full((-(-self.shape[0] // CHUNK_SIZE), -(-self.shape[1] // CHUNK_SIZE)), -1, dtype=np.int32)
+        # Slots below `used` are live unless listed in `free`, the rest of the pool is spare capacity
+        self.blocks = np.empty((0, CHUNK_SIZE, CHUNK_SIZE), dtype=np.int32)
+        self.used = 0
+        self.free = []
+
+    @classmethod
+    def from_dense(cls, data:np.ndarray) -> "SparseGrid":
+        grid = cls(data.shape)
+        chunks_y, chunks_x = grid.slots.shape
+        padded = np.full((chunks_y * CHUNK_SIZE, chunks_x * CHUNK_SIZE), EMPTY, dtype=np.int32)
+        padded[:data.shape[0], :data.shape[1]] = data
+        blocks = padded.reshape(chunks_y, CHUNK_SIZE, chunks_x, CHUNK_SIZE).swapaxes(1, 2)
+        occupied = (blocks != EMPTY).any(axis=(2, 3))
+        grid.blocks = blocks[occupied].copy()
+        grid.used = len(grid.blocks)
+        grid.slots[occupied] = np.arange(len(grid.blocks), dtype=np.int32)
+        return grid
+
+    @classmethod
+    def from_chunks(cls, shape:tuple, chunks:np.ndarray, blocks:np.ndarray) -> "SparseGrid":
+        # chunks is (n, 2) x, y and blocks (n, 16, 16)
+        grid = cls(shape)
+        grid.blocks = np.ascontiguousarray(blocks, dtype=np.int32)
+        grid.used = len(grid.blocks)
+        grid.slots[chunks[:, 1], chunks[:, 0]] = np.arange(len(chunks), dtype=np.int32)
+        return grid
+
+    @property
+    def size(self) -> int:
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return self.slots.nbytes + self.blocks.nbytes
+
+    @property
+    def chunk_count(self) -> int:
+        return self.used - len(self.free)
+
+    def occupied(self) -> np.ndarray:
+        # (n, 2) x, y of the stored chunks
+        ys, xs = np.nonzero(self.slots >= 0)
+        return np.stack((xs, ys), axis=1)
+
+    def block(self, x:int, y:int) -> np.ndarray:
+        slot = self.slots[y, x]
+        return None if slot < 0 else self.blocks[slot]
+
+    def copy(self) -> "SparseGrid":
+        grid = SparseGrid(self.shape)
+        grid.slots = self.slots.copy()
+        grid.blocks = self.blocks[:self.used].copy()
+        grid.used = self.used
+        grid.free = list(self.free)
+        return grid
+
+    def to_dense(self) -> np.ndarray:
+        chunks_y, chunks_x = self.slots.shape
+        padded = np.full((chunks_y, chunks_x, CHUNK_SIZE, CHUNK_SIZE), EMPTY, dtype=np.int32)
+        occupied = self.slots >= 0
+        padded[occupied] = self.blocks[self.slots[occupied]]
+        return padded.swapaxes(1, 2).reshape(chunks_y * CHUNK_SIZE, chunks_x * CHUNK_SIZE)[:self.shape[0], :self.shape[1]].copy()
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.to_dense()
+        return data if dtype is None else data.astype(dtype)
+
+    def histogram(self) -> np.ndarray:
+        counts = np.bincount(self.blocks[self.slots[self.slots >= 0]].ravel() + 1, minlength=1)
+        counts[0] = self.size - counts[1:].sum()
+        return counts
+
+    def find(self, value:int):
+        # ys, xs of the cells holding value, looking only at stored chunks
+        if value == EMPTY:
+            return np.nonzero(self.to_dense() == EMPTY)
+        chunks = self.occupied()
+        found, ys, xs = np.nonzero(self.blocks[self.slots[chunks[:, 1], chunks[:, 0]]] == value)
+        return chunks[found, 1] * CHUNK_SIZE + ys, chunks[found, 0] * CHUNK_SIZE + xs
+
+    def allocate(self, x:int, y:int) -> int:
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = self.used
+            self.used += 1
+            if slot == len(self.blocks):
+                grown = np.empty((max(slot * 2, 8), CHUNK_SIZE, CHUNK_SIZE), dtype=np.int32)
+                grown[:slot] = self.blocks
+                self.blocks = grown
+        self.blocks[slot] = EMPTY
+        self.slots[y, x] = slot
+        return slot
+
+    def release(self, x:int, y:int):
+        self.free.append(int(self.slots[y, x]))
+        self.slots[y, x] = -1
+
+    def __eq__(self, other):
+        return self.to_dense() == other
+
+    def __ne__(self, other):
+        return self.to_dense() != other
+
+    __hash__ = None
+
+    def ravel(self) -> np.ndarray:
+        return self.to_dense().ravel()
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            if isinstance(key, np.ndarray) and key.dtype == bool:
+                return self.to_dense()[key]
+            key = (key, slice(None))
+        rows, columns = key
+        if isinstance(rows, (int, np.integer)) and isinstance(columns, slice):
+            return self.get_region(slice(rows, rows + 1), columns)[0]
+        if isinstance(rows, slice) and isinstance(columns, (int, np.integer)):
+            return self.get_region(rows, slice(columns, columns + 1))[:, 0]
+        if isinstance(rows, slice) and isinstance(columns, slice):
+            return self.get_region(rows, columns)
+        ys, xs = np.asarray(rows, dtype=np.int64), np.asarray(columns, dtype=np.int64)
+        slots = self.slots[ys // CHUNK_SIZE, xs // CHUNK_SIZE]
+        found = slots >= 0
+        values = np.full(ys.shape, EMPTY, dtype=np.int32)
+        values[found] = self.blocks[slots[found], ys[found] % CHUNK_SIZE, xs[found] % CHUNK_SIZE]
+        return values
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        rows, columns = key
+        if isinstance(rows, slice) and isinstance(columns, slice):
+            self.set_region(rows, columns, value)
+        else:
+            self.set_cells(np.asarray(rows, dtype=np.int64), np.asarray(columns, dtype=np.int64), value)
+
+    def get_region(self, rows:slice, columns:slice) -> np.ndarray:
+        top, bottom, _ = rows.indices(self.shape[0])
+        left, right, _ = columns.indices(self.shape[1])
+        values = np.full((max(bottom - top, 0), max(right - left, 0)), EMPTY, dtype=np.int32)
+        if not values.size:
+            return values
+        chunk_top, chunk_left = top // CHUNK_SIZE, left // CHUNK_SIZE
+        slots = self.slots[chunk_top:(bottom - 1) // CHUNK_SIZE + 1, chunk_left:(right - 1) // CHUNK_SIZE + 1]
+        for y, x in zip(*np.nonzero(slots >= 0)):
+            block = self.blocks[slots[y, x]]
+            cell_top, cell_left = (chunk_top + y) * CHUNK_SIZE, (chunk_left + x) * CHUNK_SIZE
+            y0, y1 = max(top, cell_top), min(bottom, cell_top + CHUNK_SIZE)
+            x0, x1 = max(left, cell_left), min(right, cell_left + CHUNK_SIZE)
+            values[y0 - top:y1 - top, x0 - left:x1 - left] = block[y0 - cell_top:y1 - cell_top, x0 - cell_left:x1 - cell_left]
+        return values
+
+    def set_region(self, rows:slice, columns:slice, value):
+        top, bottom, _ = rows.indices(self.shape[0])
+        left, right, _ = columns.indices(self.shape[1])
+        if bottom <= top or right <= left:
+            return
+        values = np.broadcast_to(np.asarray(value, dtype=np.int32), (bottom - top, right - left))
+        for chunk_y in range(top // CHUNK_SIZE, (bottom - 1) // CHUNK_SIZE + 1):
+            cell_top = chunk_y * CHUNK_SIZE
+            y0, y1 = max(top, cell_top), min(bottom, cell_top + CHUNK_SIZE)
+            band = values[y0 - top:y1 - top]
+            # Chunks that stay empty and are not stored are skipped without touching the pool
+            filled = (band != EMPTY).any(axis=0)
+            for chunk_x in range(left // CHUNK_SIZE, (right - 1) // CHUNK_SIZE + 1):
+                cell_left = chunk_x * CHUNK_SIZE
+                x0, x1 = max(left, cell_left), min(right, cell_left + CHUNK_SIZE)
+                slot = self.slots[chunk_y, chunk_x]
+                if slot < 0:
+                    if not filled[x0 - left:x1 - left].any():
+                        continue
+                    slot = self.allocate(chunk_x, chunk_y)
+                block = self.blocks[slot]
+                block[y0 - cell_top:y1 - cell_top, x0 - cell_left:x1 - cell_left] = band[:, x0 - left:x1 - left]
+                if (block == EMPTY).all():
+                    self.release(chunk_x, chunk_y)
+
+    def set_cells(self, ys:np.ndarray, xs:np.ndarray, value):
+        values = np.broadcast_to(np.asarray(value, dtype=np.int32), ys.shape).ravel()
+        ys, xs = ys.ravel(), xs.ravel()
+        chunk_ys, chunk_xs = ys // CHUNK_SIZE, xs // CHUNK_SIZE
+        missing = (self.slots[chunk_ys, chunk_xs] < 0) & (values != EMPTY)
+        chunks_x = self.slots.shape[1]
+        if missing.any():
+            for chunk_id in np.unique(chunk_ys[missing] * chunks_x + chunk_xs[missing]).tolist():
+                self.allocate(chunk_id % chunks_x, chunk_id // chunks_x)
+        slots = self.slots[chunk_ys, chunk_xs]
+        stored = slots >= 0
+        self.blocks[slots[stored], ys[stored] % CHUNK_SIZE, xs[stored] % CHUNK_SIZE] = values[stored]
+        cleared = np.unique((chunk_ys * chunks_x + chunk_xs)[stored & (values == EMPTY)])
+        if len(cleared):
+            emptied = (self.blocks[self.slots.ravel()[cleared]] == EMPTY).all(axis=(1, 2))
+            for chunk_id in cleared[emptied].tolist():
+                self.release(chunk_id % chunks_x, chunk_id // chunks_x)
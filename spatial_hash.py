@@ -0,0 +1,68 @@
+from collections import defaultdict
+
+import pygame
+
+
+class SpatialHash:
+    def __init__(self, cell_size: int = 64):
+        self.cell_size = cell_size
+        self.cells = defaultdict(dict)
+        self.__keys = {}
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def __contains__(self, item):
+        return item in self.__keys
+
+    def __iter__(self):
+        return iter(self.__keys)
+
+    def key(self, x: float, y: float):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def insert(self, item, x: float, y: float):
+        if item in self.__keys:
+            self.move(item, x, y)
+            return
+        key = self.key(x, y)
+        self.cells[key][item] = None
+        self.__keys[item] = key
+
+    def remove(self, item):
+        key = self.__keys.pop(item)
+        cell = self.cells[key]
+        del cell[item]
+        if not cell:
+            del self.cells[key]
+
+    def move(self, item, x: float, y: float):
+        key = self.key(x, y)
+        old_key = self.__keys[item]
+        if key == old_key:
+            return
+        self.remove(item)
+        self.cells[key][item] = None
+        self.__keys[item] = key
+
+    def clear(self):
+        self.cells.clear()
+        self.__keys.clear()
+
+    def query_cell(self, key):
+        cell = self.cells.get(key)
+        return cell.keys() if cell else ()
+
+    def query_rect(self, rect: pygame.Rect):
+        min_x, min_y = self.key(rect.left, rect.top)
+        max_x, max_y = self.key(rect.right, rect.bottom)
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self.cells):
+            for (x, y), cell in self.cells.items():
+                if min_x <= x <= max_x and min_y <= y <= max_y:
+                    yield from cell
+            return
+        for y in range(min_y, max_y + 1):
+            for x in range(min_x, max_x + 1):
+                cell = self.cells.get((x, y))
+                if cell:
+                    yield from cell
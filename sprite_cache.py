@@ -0,0 +1,77 @@
+import math
+from collections import OrderedDict
+
+import pygame
+
+from memory import memory
+
+
+def quantize_scale(scale: float, steps: int = 8) -> float:
+    # steps scales per doubling, so that the cached size is within 2 ** (1 / 2steps), about 4%, of the real one at
+    # every zoom. 1 and the other powers of two stay exact
+    if scale <= 0:
+        return scale
+    return 2 ** (round(math.log2(scale) * steps) / steps)
+
+
+def surface_bytes(surface: pygame.Surface) -> int:
+    return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+
+class SpriteFrameCache:
+    def __init__(self, budget: int = 64 * 1024 * 1024, steps: int = 8):
+        self.budget = budget
+        self.steps = steps
+        self.used = 0
+        self.__entries = OrderedDict()
+        memory.register(self, "sprites")
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, sprite_sheet, scale: float):
+        scale = quantize_scale(scale, self.steps)
+        key = (sprite_sheet, scale)
+        entry = self.__entries.get(key)
+        if entry is not None:
+            self.__entries.move_to_end(key)
+            self.__entries[key] = (entry[0], entry[1], memory.frame)
+            return entry[0]
+
+        if scale == 1:
+            frames = sprite_sheet.frames
+            size = 0
+        else:
+            frames = [
+                [pygame.transform.scale_by(frame, scale) for frame in row]
+                for row in sprite_sheet.frames
+            ]
+            size = sum(surface_bytes(frame) for row in frames for frame in row)
+        self.__entries[key] = (frames, size, memory.frame)
+        self.used += size
+        self.evict()
+        return frames
+
+    def evict(self, budget: int = None):
+        budget = self.budget if budget is None else budget
+        while self.used > budget and len(self.__entries) > 1:
+            _, (_, size, _) = self.__entries.popitem(last=False)
+            self.used -= size
+
+    def memory_usage(self) -> dict:
+        return {"frames": self.used}
+
+    def lru_tick(self):
+        return next(iter(self.__entries.values()))[2] if self.__entries else None
+
+    def evict_lru(self) -> int:
+        _, (_, size, _) = self.__entries.popitem(last=False)
+        self.used -= size
+        return size
+
+    def invalidate(self, sprite_sheet=None):
+        for key in [key for key in self.__entries if sprite_sheet is None or key[0] is sprite_sheet]:
+            self.used -= self.__entries.pop(key)[1]
+
+
+sprite_cache = SpriteFrameCache()
@@ -0,0 +1,59 @@
+import numpy as np
+from pygame.math import Vector2 as Vec2
+
+from layer import Layer
+
+
+def bresenham(x0: int, y0: int, x1: int, y1: int):
+    dx, dy = abs(x1 - x0), -abs(y1 - y0)
+    step_x = 1 if x0 < x1 else -1
+    step_y = 1 if y0 < y1 else -1
+    error = dx + dy
+    while True:
+        yield x0, y0
+        if x0 == x1 and y0 == y1:
+            return
+        doubled = 2 * error
+        if doubled >= dy:
+            error += dy
+            x0 += step_x
+        if doubled <= dx:
+            error += dx
+            y0 += step_y
+
+
+class Stroke:
+    def __init__(self, layer: Layer, index: int = None, size: int = 1):
+        self.layer = layer
+        self.index = layer.selected_gid if index is None else index
+        self.size = size
+        self.visited = set()
+        self.pending = []
+        self.last = None
+
+    def add_cell(self, cell: Vec2):
+        cell = int(cell[0]), int(cell[1])
+        if self.last is None:
+            cells = (cell,)
+        else:
+            cells = bresenham(*self.last, *cell)
+        for point in cells:
+            if point not in self.visited:
+                self.visited.add(point)
+                self.pending.append(point)
+        self.last = cell
+
+    def add_point(self, screen_pos: Vec2):
+        self.add_cell(self.layer.cell_at(screen_pos))
+
+    def flush(self):
+        # Everything gathered since the last frame lands as a single layer write
+        if not self.pending:
+            return
+        cells = np.array(self.pending, dtype=np.int64)
+        if self.size > 1:
+            first = -(self.size // 2)
+            ys, xs = np.mgrid[first:first + self.size, first:first + self.size]
+            cells = (cells[:, None, :] + np.stack((xs.ravel(), ys.ravel()), axis=1)).reshape(-1, 2)
+        self.layer.set_cells(cells, self.index)
+        self.pending = []
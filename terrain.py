@@ -0,0 +1,98 @@
+import numpy as np
+import pygame
+
+from autotile import AutotileRules
+from layer import Layer, EMPTY
+from tileset import pack_gid
+
+# (upper noise threshold, tile index in the layer's tileset) pairs, checked in order; 16 is the plain center tile of the Biome sheets
+DEFAULT_BIOMES = (
+    (0.5, EMPTY),
+    (1.0, 16),
+)
+
+
+def smoothstep(t: np.ndarray) -> np.ndarray:
+    return t * t * (3 - 2 * t)
+
+
+def value_noise(shape: tuple, scale: float, rng: np.random.Generator) -> np.ndarray:
+    # Random values on a lattice every `scale` cells, smoothly interpolated in between
+    height, width = shape
+    lattice = rng.random((int(height / scale) + 2, int(width / scale) + 2), dtype=np.float32)
+    ys = np.arange(height, dtype=np.float32) / scale
+    xs = np.arange(width, dtype=np.float32) / scale
+    y0, x0 = ys.astype(np.int64), xs.astype(np.int64)
+    ty, tx = smoothstep(ys - y0)[:, None], smoothstep(xs - x0)[None, :]
+    top = lattice[np.ix_(y0, x0)] * (1 - tx) + lattice[np.ix_(y0, x0 + 1)] * tx
+    bottom = lattice[np.ix_(y0 + 1, x0)] * (1 - tx) + lattice[np.ix_(y0 + 1, x0 + 1)] * tx
+    return top * (1 - ty) + bottom * ty
+
+
+def fractal_noise(
+    shape: tuple,
+    seed: int,
+    scale: float = 64,
+    octaves: int = 4,
+    persistence: float = 0.5,
+) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    noise = np.zeros(shape, dtype=np.float32)
+    amplitude, total = 1.0, 0.0
+    for _ in range(octaves):
+        noise += value_noise(shape, max(scale, 1), rng) * amplitude
+        total += amplitude
+        amplitude *= persistence
+        scale /= 2
+    noise /= total
+    # Stretch to the full 0..1 range so biome thresholds mean the same thing for any octave count
+    low, high = noise.min(), noise.max()
+    if high > low:
+        noise = (noise - low) / (high - low)
+    return noise
+
+
+def biome_indices(noise: np.ndarray, biomes=DEFAULT_BIOMES) -> np.ndarray:
+    thresholds = np.array([threshold for threshold, _ in biomes[:-1]], dtype=np.float32)
+    indices = np.array([index for _, index in biomes], dtype=np.int32)
+    return indices[np.digitize(noise, thresholds, right=True)]
+
+
+def autotile_edges(indices: np.ndarray, rules: AutotileRules) -> np.ndarray:
+    # Edge pieces replace the borders of the land, the inside keeps its biome tiles
+    terrain = indices != EMPTY
+    resolved = rules.resolve(terrain)
+    edges = terrain & (resolved != rules.template["center"])
+    return np.where(edges, resolved, indices)
+
+
+def generate(
+    shape: tuple,
+    seed: int,
+    biomes=DEFAULT_BIOMES,
+    scale: float = 64,
+    octaves: int = 4,
+    persistence: float = 0.5,
+    rules: AutotileRules = None,
+) -> np.ndarray:
+    indices = biome_indices(fractal_noise(shape, seed, scale, octaves, persistence), biomes)
+    if rules is not None:
+        indices = autotile_edges(indices, rules)
+    return indices
+
+
+def generate_layer(
+    layer: Layer,
+    seed: int,
+    biomes=DEFAULT_BIOMES,
+    scale: float = 64,
+    octaves: int = 4,
+    persistence: float = 0.5,
+    autotile: bool = None,
+):
+    if autotile is None:
+        autotile = layer.autotile
+    rules = layer.autotile_rules if autotile else None
+    region = pygame.Rect(0, 0, layer.size.x, layer.size.y)
+    after = pack_gid(layer.tileset_id, generate((region.height, region.width), seed, biomes, scale, octaves, persistence, rules))
+    layer.set_tiles(region.topleft, after, autotile=False)
@@ -0,0 +1,41 @@
+import os
+import sys
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pygame
+import pytest
+from pygame.math import Vector2 as Vec2
+
+pygame.init()
+
+from tileset import TilesetProperties
+
+
+def pytest_addoption(parser):
+    parser.addoption("--perf", action="store_true", help="also run the frame time benchmarks marked perf")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "perf: wall clock benchmark, only run with --perf")
+
+
+def pytest_collection_modifyitems(config, items):
+    # The benchmarks take most of the suite's time; CI runs them through replay.py --baseline
+    if config.getoption("--perf"):
+        return
+    deselected = [item for item in items if "perf" in item.keywords]
+    if deselected:
+        config.hook.pytest_deselected(items=deselected)
+        items[:] = [item for item in items if "perf" not in item.keywords]
+
+
+@pytest.fixture
+def tileset():
+    # 4x4 tiles of 16 px, each a flat colour
+    image = pygame.Surface((64, 64), pygame.SRCALPHA)
+    for i in range(16):
+        image.fill((i * 15, 255 - i * 15, 128, 255), ((i % 4) * 16, (i // 4) * 16, 16, 16))
+    return TilesetProperties("Test", Vec2(16, 16), Vec2(0, 0), Vec2(0, 0), image, pygame.Color(0, 0, 0, 0))
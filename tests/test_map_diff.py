@@ -0,0 +1,91 @@
+import numpy as np
+import pygame
+from pygame.math import Vector2 as Vec2
+
+from mapClass import Map
+from map_diff import diff_layers, merge_layers, merge_maps
+from tileset import EMPTY
+
+
+def base_layer() -> np.ndarray:
+    # Never holds the 1 to 6 the tests write
+    cells = np.random.default_rng(0).integers(6, 17, (64, 64)).astype(np.int32)
+    cells[cells == 6] = EMPTY
+    return cells
+
+
+def test_edits_in_separate_chunks_merge_cleanly():
+    base = base_layer()
+    ours, theirs = base.copy(), base.copy()
+    ours[0:8, 0:8] = 1
+    theirs[40:50, 40:50] = 2
+    merged, conflicts, regions = merge_layers(base, ours, theirs)
+    expected = base.copy()
+    expected[0:8, 0:8] = 1
+    expected[40:50, 40:50] = 2
+    assert (merged == expected).all()
+    assert not conflicts.any() and regions == []
+
+
+def test_edits_to_different_cells_of_one_chunk_merge_cleanly():
+    base = base_layer()
+    ours, theirs = base.copy(), base.copy()
+    ours[2, 2] = 1
+    theirs[3, 3] = 2
+    # The same change on both sides is not a conflict either
+    ours[5, 5] = theirs[5, 5] = 3
+    merged, conflicts, regions = merge_layers(base, ours, theirs)
+    assert merged[2, 2] == ours[2, 2] and merged[3, 3] == theirs[3, 3] and merged[5, 5] == ours[5, 5]
+    assert not conflicts.any() and regions == []
+
+
+def test_conflicting_cells_keep_ours_and_are_reported():
+    base = base_layer()
+    ours, theirs = base.copy(), base.copy()
+    ours[20:24, 20:24] = 3
+    theirs[22:26, 22:26] = 4
+    # A second conflict far away gets a region of its own
+    ours[60, 1] = 5
+    theirs[60, 1] = 6
+    merged, conflicts, regions = merge_layers(base, ours, theirs)
+
+    overlap = np.zeros(base.shape, dtype=bool)
+    overlap[22:24, 22:24] = True
+    overlap[60, 1] = True
+    assert (conflicts == overlap).all()
+    assert (merged[20:24, 20:24] == 3).all()
+    # Their cells outside the overlap still come through
+    assert (merged[24:26, 22:26] == 4).all() and (merged[22:24, 24:26] == 4).all()
+    assert merged[60, 1] == 5
+    assert sorted(tuple(region) for region in regions) == [(1, 60, 1, 1), (22, 22, 2, 2)]
+
+
+def test_regions_spanning_chunks_are_joined():
+    base = np.full((64, 64), EMPTY, dtype=np.int32)
+    ours, theirs = base.copy(), base.copy()
+    ours[10:20, 12:20] = 1
+    theirs[10:20, 12:20] = 2
+    _, conflicts, regions = merge_layers(base, ours, theirs)
+    assert conflicts.sum() == 80
+    assert [tuple(region) for region in regions] == [(12, 10, 8, 10)]
+
+
+def test_merge_maps_writes_into_ours(tileset):
+    def make(data: np.ndarray) -> Map:
+        tile_map = Map(Vec2(64, 64), [tileset], [], [])
+        tile_map.append_layer()
+        tile_map.layers[0].set_tiles((0, 0), data, autotile=False)
+        return tile_map
+
+    base = base_layer()
+    ours, theirs = base.copy(), base.copy()
+    ours[0:4, 0:4] = 1
+    theirs[30:34, 30:34] = 2
+    theirs[1, 1] = 3
+    our_map = make(ours)
+    conflicts = merge_maps(make(base), our_map, make(theirs))
+    assert list(conflicts) == [0]
+    assert [tuple(region) for region in conflicts[0]] == [(1, 1, 1, 1)]
+    assert (our_map.layers[0].data[30:34, 30:34] == 2).all()
+    assert (our_map.layers[0].data[0:4, 0:4] == 1).all()
+    assert not diff_layers(np.asarray(our_map.layers[0].data), merge_layers(base, ours, theirs)[0])
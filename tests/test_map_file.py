@@ -0,0 +1,110 @@
+import numpy as np
+import pygame
+from pygame.math import Vector2 as Vec2
+
+from mapClass import Map
+from map_file import ChunkFile, MapSnapshot, SUPERBLOCK, SUPERBLOCK_SLOTS, load_map, write_snapshot
+from tileset import EMPTY
+
+
+def make_map(tileset) -> Map:
+    # Sizes that are not multiples of the chunk size, so the edge chunks are partial
+    tile_map = Map(Vec2(70, 45), [tileset], [], [])
+    tile_map.append_layer()
+    tile_map.append_layer()
+    rng = np.random.default_rng(0)
+    for layer in tile_map.layers:
+        cells = np.stack((rng.integers(0, 70, 200), rng.integers(0, 45, 200)), axis=1)
+        layer.set_cells(cells, rng.integers(0, 16, 200).astype(np.int32), autotile=False)
+    tile_map.layers[1].fill_region(pygame.Rect(0, 30, 70, 15), 5)
+    return tile_map
+
+
+def save(tile_map: Map, path: str, chunk_file: ChunkFile = None) -> ChunkFile:
+    snapshot = MapSnapshot(tile_map)
+    try:
+        return write_snapshot(snapshot, path, chunk_file)
+    finally:
+        snapshot.release()
+
+
+def assert_layers(layers: list, tile_map: Map):
+    assert len(layers) == len(tile_map.layers)
+    for data, layer in zip(layers, tile_map.layers):
+        assert (np.asarray(data) == np.asarray(layer.data)).all()
+
+
+def test_write_incremental_compact_read(tmp_path, tileset):
+    path = str(tmp_path / "map.mythmap")
+    tile_map = make_map(tileset)
+    chunk_file = save(tile_map, path)
+    assert_layers(chunk_file.read_layers(), tile_map)
+    full_size = chunk_file.size
+
+    # Only the chunks written since are appended
+    tile_map.layers[0].set_tiles((3, 4), np.full((2, 2), 9, dtype=np.int32), autotile=False)
+    tile_map.layers[1].fill_region(pygame.Rect(0, 30, 70, 15), EMPTY)
+    chunk_file = save(tile_map, path, chunk_file)
+    assert chunk_file.size - full_size < full_size
+    assert chunk_file.fragmentation > 0
+    assert_layers(chunk_file.read_layers(), tile_map)
+    assert_layers(ChunkFile.open(path).read_layers(), tile_map)
+
+    chunk_file.compact()
+    assert chunk_file.fragmentation == 0
+    assert chunk_file.size < full_size
+    assert_layers(chunk_file.read_layers(), tile_map)
+    reopened = ChunkFile.open(path)
+    assert reopened.size == chunk_file.size
+    assert_layers(reopened.read_layers(), tile_map)
+
+    # Appending to the compacted file still works, and the map loads back whole
+    tile_map.layers[1].set_tiles((69, 44), np.array([[4]], dtype=np.int32), autotile=False)
+    chunk_file = save(tile_map, path, chunk_file)
+    loaded = load_map(path, [tileset])
+    assert_layers([layer.data for layer in loaded.layers], tile_map)
+
+
+def test_file_replaced_on_disk_is_reopened(tmp_path, tileset):
+    path = str(tmp_path / "map.mythmap")
+    tile_map = make_map(tileset)
+    chunk_file = save(tile_map, path)
+
+    other = make_map(tileset)
+    other.layers[0].fill_region(pygame.Rect(0, 0, 70, 45), 2)
+    save(other, str(tmp_path / "other.mythmap"))
+    (tmp_path / "other.mythmap").replace(path)
+    assert not chunk_file.is_current()
+
+    tile_map.layers[0].set_tiles((0, 0), np.array([[1]], dtype=np.int32), autotile=False)
+    save(tile_map, path, chunk_file)
+    assert_layers(ChunkFile.open(path).read_layers(), tile_map)
+
+
+def test_torn_superblock_falls_back_to_the_previous_root(tmp_path, tileset):
+    path = str(tmp_path / "map.mythmap")
+    tile_map = make_map(tileset)
+    chunk_file = save(tile_map, path)
+    before = [np.asarray(layer.data).copy() for layer in tile_map.layers]
+    tile_map.layers[0].fill_region(pygame.Rect(0, 0, 70, 45), 3)
+    chunk_file = save(tile_map, path, chunk_file)
+
+    # A crash halfway through writing the newest superblock
+    with open(path, "r+b") as file:
+        file.seek(chunk_file.sequence % SUPERBLOCK_SLOTS * SUPERBLOCK.size + 12)
+        file.write(b"\xff" * 8)
+    reopened = ChunkFile.open(path)
+    assert reopened.sequence == chunk_file.sequence - 1
+    for data, expected in zip(reopened.read_layers(), before):
+        assert (np.asarray(data) == expected).all()
+
+
+def test_edited_chunks_are_written_even_if_their_hash_matches(tmp_path, tileset):
+    path = str(tmp_path / "map.mythmap")
+    tile_map = make_map(tileset)
+    chunk_file = save(tile_map, path)
+    tile_map.layers[0].set_tiles((3, 4), np.full((2, 2), 9, dtype=np.int32), autotile=False)
+    # As if the edited chunk's new hash collided with the one on disk
+    chunk_file.tables[0]["hash"] = tile_map.layers[0].chunk_hashes()
+    chunk_file = save(tile_map, path, chunk_file)
+    assert_layers(ChunkFile.open(path).read_layers(), tile_map)
@@ -0,0 +1,44 @@
+import json
+import os
+
+import pytest
+
+import canonical_sessions
+from replay import check_sessions, regressions
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SESSION_DIR = os.path.join(ROOT, "sessions")
+SESSIONS = [os.path.join(SESSION_DIR, f"{write_session.__name__}.jsonl") for write_session in canonical_sessions.CANONICAL_SESSIONS]
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # The editor loads its assets relative to the working directory, under both spellings of the folder
+    for name in ("assets", "Assets"):
+        os.symlink(os.path.join(ROOT, "assets"), tmp_path / name)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_sessions_match_their_code(workdir):
+    os.mkdir("sessions")
+    for write_session, path in zip(canonical_sessions.CANONICAL_SESSIONS, SESSIONS):
+        write_session("sessions")
+        # The header names the pygame version that wrote the file, only the frames have to match
+        with open(path, encoding="utf-8") as committed, open(os.path.join("sessions", os.path.basename(path)), encoding="utf-8") as written:
+            assert committed.readlines()[1:] == written.readlines()[1:], f"{path} is out of date, run canonical_sessions.py"
+
+
+def test_regressions():
+    baseline = {"phases": {"draw": {"p95": 2.0}, "update": {"p95": 1.0}}}
+    report = {"phases": {"draw": {"p95": 3.6}, "update": {"p95": 2.2}}}
+    assert regressions(report, baseline) == [("draw", 2.0, 3.6)]
+    assert regressions(report, baseline, tolerance=0.1, slack=0.5) == [("draw", 2.0, 3.6), ("update", 1.0, 2.2)]
+
+
+@pytest.mark.perf
+def test_canonical_sessions_keep_their_frame_times(workdir):
+    with open(os.path.join(SESSION_DIR, "baseline.json"), encoding="utf-8") as file:
+        baseline = json.load(file)
+    _, failed = check_sessions(SESSIONS, baseline)
+    assert not failed, "\n".join(f"{session}: {phase} p95 went from {before:.2f} to {after:.2f} ms" for session, phase, before, after in failed)
@@ -0,0 +1,111 @@
+import numpy as np
+import pygame
+from pygame.math import Vector2 as Vec2
+
+from layer import Layer
+from sparse_grid import SparseGrid, CHUNK_SIZE
+from tileset import EMPTY
+
+
+def stored_chunks(dense: np.ndarray) -> int:
+    chunks_y, chunks_x = -(-dense.shape[0] // CHUNK_SIZE), -(-dense.shape[1] // CHUNK_SIZE)
+    padded = np.full((chunks_y * CHUNK_SIZE, chunks_x * CHUNK_SIZE), EMPTY, dtype=np.int32)
+    padded[:dense.shape[0], :dense.shape[1]] = dense
+    return int((padded.reshape(chunks_y, CHUNK_SIZE, chunks_x, CHUNK_SIZE) != EMPTY).any(axis=(1, 3)).sum())
+
+
+def test_reads_match_dense_after_random_writes():
+    # Shape not a multiple of the chunk size, so edge chunks are partial
+    rng = np.random.default_rng(0)
+    shape = (70, 45)
+    grid = SparseGrid(shape)
+    dense = np.full(shape, EMPTY, dtype=np.int32)
+    for step in range(300):
+        if step % 3:
+            ys, xs = rng.integers(0, shape[0], 40), rng.integers(0, shape[1], 40)
+            values = rng.choice([EMPTY, EMPTY, 3, 4097], 40).astype(np.int32)
+            grid[ys, xs] = values
+            # Repeated cells: the last write wins in both
+            dense[ys, xs] = values
+        else:
+            top, left = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+            bottom, right = top + rng.integers(0, 30), left + rng.integers(0, 30)
+            value = int(rng.choice([EMPTY, 7]))
+            grid[top:bottom, left:right] = value
+            dense[top:bottom, left:right] = value
+        assert grid.chunk_count == stored_chunks(dense)
+    assert (grid.to_dense() == dense).all()
+    assert (grid[10:60, 5:40] == dense[10:60, 5:40]).all()
+    assert (grid[33] == dense[33]).all()
+    assert (grid[:, 44] == dense[:, 44]).all()
+    ys, xs = rng.integers(0, shape[0], 100), rng.integers(0, shape[1], 100)
+    assert (grid[ys, xs] == dense[ys, xs]).all()
+    assert (grid.histogram() == np.bincount(dense.ravel() + 1, minlength=len(grid.histogram()))).all()
+    ys, xs = grid.find(7)
+    assert sorted(zip(ys.tolist(), xs.tolist())) == sorted(zip(*(axis.tolist() for axis in np.nonzero(dense == 7))))
+
+
+def test_emptied_chunks_are_released_and_reused():
+    grid = SparseGrid((64, 64))
+    grid[0:16, 0:16] = 1
+    grid[40, 40] = 2
+    assert grid.chunk_count == 2
+    grid[0:16, 0:16] = EMPTY
+    grid[np.array([40]), np.array([40])] = EMPTY
+    assert grid.chunk_count == 0
+    used = grid.used
+    grid[20, 20] = 3
+    assert grid.chunk_count == 1 and grid.used == used
+    assert grid[20, 20:21].tolist() == [3]
+
+
+def test_round_trips_through_dense_and_chunks():
+    rng = np.random.default_rng(1)
+    dense = np.full((50, 33), EMPTY, dtype=np.int32)
+    dense[rng.integers(0, 50, 30), rng.integers(0, 33, 30)] = rng.integers(0, 16, 30)
+    grid = SparseGrid.from_dense(dense)
+    assert (grid.to_dense() == dense).all()
+    chunks = grid.occupied()
+    rebuilt = SparseGrid.from_chunks(grid.shape, chunks, grid.blocks[grid.slots[chunks[:, 1], chunks[:, 0]]])
+    assert (rebuilt.to_dense() == dense).all()
+    copy = grid.copy()
+    copy[0:50, 0:33] = 5
+    assert (grid.to_dense() == dense).all()
+
+
+def test_layer_switches_between_sparse_and_dense(tileset):
+    layer = Layer(Vec2(0, 0), Vec2(64, 64), tileset, tilesets=[tileset])
+    expected = np.full((64, 64), EMPTY, dtype=np.int32)
+    assert layer.sparse
+
+    layer.set_tiles((2, 3), np.full((4, 5), 6, dtype=np.int32), autotile=False)
+    expected[3:7, 2:7] = 6
+    assert layer.sparse
+    assert (np.asarray(layer.data) == expected).all()
+
+    # Filling most of the layer moves it to a dense array
+    layer.set_tiles((0, 0), np.full((48, 64), 1, dtype=np.int32), autotile=False)
+    expected[0:48] = 1
+    assert not layer.sparse
+    assert (layer.data == expected).all()
+
+    cells = np.array([[60, 60], [0, 0], [63, 50]])
+    layer.set_cells(cells, np.array([2, 3, 4]), autotile=False)
+    expected[[60, 0, 50], [60, 0, 63]] = [2, 3, 4]
+    assert (layer.data == expected).all()
+
+    # Erasing back down to a few chunks makes it sparse again, with the same cells
+    layer.set_tiles((0, 0), np.full((48, 64), EMPTY, dtype=np.int32), autotile=False)
+    expected[0:48] = EMPTY
+    assert layer.sparse
+    assert (np.asarray(layer.data) == expected).all()
+    assert (layer.data[50:64, 50:64] == expected[50:64, 50:64]).all()
+    assert (layer.histogram == np.bincount(expected.ravel() + 1, minlength=len(layer.histogram))).all()
+
+    layer.replace_all(2, 9)
+    expected[expected == 2] = 9
+    assert (np.asarray(layer.data) == expected).all()
+    layer.fill_region(pygame.Rect(0, 0, 64, 64), 8)
+    expected[:] = 8
+    assert not layer.sparse
+    assert (layer.data == expected).all()
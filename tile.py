@@ -1,12 +1,51 @@
 import pygame
 from pygame.math import Vector2 as Vec2
-from functools import lru_cache
+from collections import OrderedDict
 
 from tileset import TilesetProperties,get_tile_top_left
+from sprite_cache import surface_bytes
+from memory import memory
+
+
+class ScaleCache:
+    # Whole tileset images scaled to the display zoom, shared by every tile drawn from them
+    def __init__(self, limit:int=128):
+        self.limit = limit
+        self.used = 0
+        self.__entries = OrderedDict()
+        memory.register(self, "tilesets")
+
+    def get(self, surface, factor):
+        key = (surface, factor)
+        entry = self.__entries.get(key)
+        if entry is not None:
+            self.__entries.move_to_end(key)
+            self.__entries[key] = (entry[0], memory.frame)
+            return entry[0]
+        scaled = pygame.transform.scale_by(surface, factor)
+        self.__entries[key] = (scaled, memory.frame)
+        self.used += surface_bytes(scaled)
+        while len(self.__entries) > self.limit:
+            self.evict_lru()
+        return scaled
+
+    def memory_usage(self) -> dict:
+        return {"scaled": self.used}
+
+    def lru_tick(self):
+        return next(iter(self.__entries.values()))[1] if self.__entries else None
+
+    def evict_lru(self) -> int:
+        _, (scaled, _) = self.__entries.popitem(last=False)
+        self.used -= surface_bytes(scaled)
+        return surface_bytes(scaled)
+
+
+scale_cache = ScaleCache()
+
 
-@lru_cache
 def scale_with_cache(surface, factor):
-    return pygame.transform.scale_by(surface, factor)
+    return scale_cache.get(surface, factor)
 
 
 class Tile:
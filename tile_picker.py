@@ -1,6 +1,7 @@
 import math
 from typing import Callable
 
+import numpy as np
 import pygame
 from pygame.locals import *
 from pygame.math import Vector2 as Vec2
@@ -8,6 +9,10 @@ from pygame.math import Vector2 as Vec2
 from button import Button
 
 from tileset import TilesetProperties, get_tile_surface
+from shapes import normalize
+from sprite_cache import surface_bytes
+from memory import memory
+from input_state import input_state
 
 
 class TileButton(Button):
@@ -91,6 +96,9 @@ class TilePicker:
         self.surf = pygame.Surface(self.rect.size)
         self.surf.fill(self.background_color)
         self.callback = callback
+        self.selection_start = None
+        self.selection = None
+        self.selection_color = pygame.Color(8, 112, 194)
         
         for key, value in kwargs.items():
             setattr(self, key, value)
@@ -98,6 +106,23 @@ class TilePicker:
 
         self.get_max_tile_btn_scale()
         self.create_tiles()
+        memory.register(self, "ui")
+
+    def set_tileset(self, tileset: TilesetProperties):
+        self.tileset = tileset
+        self.selection = None
+        self.selection_start = None
+        self.current = 0
+        self.get_max_tile_btn_scale()
+        self.create_tiles()
+
+    def reload_tileset(self):
+        # The sheet's image was swapped, its tile count may have changed with it
+        self.current = min(self.current, self.tileset.tile_count - 1)
+        self.selection = None
+        self.selection_start = None
+        self.get_max_tile_btn_scale()
+        self.create_tiles()
 
     def create_tiles(self):
         stored_current = self.value
@@ -122,6 +147,12 @@ class TilePicker:
                 active=i == stored_current
             )
             self.tile_buttons.append(btn)
+        self.buttons_bytes = sum(
+            surface_bytes(btn.image) + surface_bytes(btn.h_image) + surface_bytes(btn.a_image) for btn in self.tile_buttons
+        )
+
+    def memory_usage(self) -> dict:
+        return {"tile picker": surface_bytes(self.surf) + self.buttons_bytes}
 
     def get_max_tile_btn_scale(self):
         if self.tileset.tilesize.x >= self.rect.width or self.tileset.tilesize.y >= self.rect.height:
@@ -167,17 +198,40 @@ class TilePicker:
     def update(self):
         for btn in self.tile_buttons:
             btn.update()
+        if self.selection_start is None:
+            return
+        if not input_state.mouse_pressed()[0]:
+            self.selection_start = None
+            return
+        for btn in self.tile_buttons:
+            if btn.hovered:
+                self.selection = normalize(self.selection_start, self.tileset.to_tileset_coords(btn.tile_index))
 
     def on_click(self):
         for i,btn in enumerate(self.tile_buttons):
             if btn.on_click():
                 self.current = i
+                self.selection_start = self.tileset.to_tileset_coords(i)
+                self.selection = normalize(self.selection_start, self.selection_start)
                 self.callback(self)
+                return True
+        return self.rect.collidepoint(input_state.mouse_pos())
+
+    @property
+    def stamp(self) -> np.ndarray:
+        if self.selection is None:
+            return np.array([[self.current]], dtype=np.int32)
+        ys, xs = np.mgrid[self.selection.top:self.selection.bottom, self.selection.left:self.selection.right]
+        return (ys * self.tileset.tile_by_line + xs).astype(np.int32)
 
     def draw(self, surface):
         surface.blit(self.surf, self.rect)
         for btn in self.tile_buttons:
             btn.draw(surface)
+        if self.selection is not None and self.selection.width * self.selection.height > 1:
+            for index in self.stamp.ravel().tolist():
+                if index < len(self.tile_buttons):
+                    pygame.draw.rect(surface, self.selection_color, self.tile_buttons[index].rect, 1)
 
     @property
     def tile_by_line(self):
@@ -1,8 +1,20 @@
+import hashlib
+import weakref
+from collections import OrderedDict
 from dataclasses import dataclass
 
+import numpy as np
 import pygame
 from pygame.math import Vector2 as Vec2
 
+from sprite_cache import surface_bytes
+from memory import memory
+
+EMPTY = -1
+# A cell holds (tileset id << TILE_BITS) | tile index, the tileset id being its position in the map's tilesets
+TILE_BITS = 12
+TILE_MASK = (1 << TILE_BITS) - 1
+
 @dataclass
 class TilesetProperties:
     name: str
@@ -11,6 +23,15 @@ class TilesetProperties:
     tilespacing: Vec2
     tileset: pygame.Surface
     color: pygame.Color
+    path: str = ""
+    # Tile indices that block movement wherever they are painted
+    solid: frozenset = frozenset()
+
+    def __post_init__(self):
+        memory.register(self, "tilesets")
+
+    def memory_usage(self) -> dict:
+        return {self.name: surface_bytes(self.tileset)}
     
     @property
     def offset_by_tile(self):
@@ -51,4 +72,245 @@ def get_tile_rect(tileset: TilesetProperties, tile_index: int) -> pygame.Rect:
 
 
 def get_tile_surface(tileset: TilesetProperties, tile_index: int) -> pygame.Surface:
-    return tileset.tileset.subsurface(get_tile_rect(tileset, tile_index))
\ No newline at end of file
+    return tileset.tileset.subsurface(get_tile_rect(tileset, tile_index))
+
+
+def pack_gid(tileset_id: int, tile_index):
+    if np.ndim(tile_index):
+        tile_index = np.asarray(tile_index)
+        return np.where(tile_index == EMPTY, EMPTY, (tileset_id << TILE_BITS) | tile_index).astype(np.int32)
+    return EMPTY if tile_index == EMPTY else (tileset_id << TILE_BITS) | int(tile_index)
+
+
+def gid_tileset(gid):
+    return gid >> TILE_BITS
+
+
+def gid_index(gid):
+    return gid & TILE_MASK
+
+
+class TileAtlas:
+    # Every distinct tile of the imported tilesets, stored once. Tiles are hashed on import: fully transparent ones
+    # are dropped and identical ones, within or across tilesets, share a slot. Each tile size gets its own sheet.
+    # A published sheet is never drawn to again, imports build a new one so chunk renders can keep reading the old.
+    # Slots count the tilesets using them; a slot no tileset uses any more, after a reload or once its tileset is
+    # gone, frees its place in the sheet for the next tile, and a sheet mostly made of free places is packed again
+    def __init__(self, columns: int = 64):
+        self.columns = columns
+        self.version = 0
+        self.sheets = {}
+        # Places in each size's sheet, free ones included
+        self.counts = {}
+        # Per slot: its tile size and its rect in that size's sheet, None once the slot is free
+        self.slot_sizes = []
+        self.rects = []
+        self.__slots = {}
+        self.__keys = []
+        self.__users = []
+        self.__free_slots = []
+        self.__free_places = {}
+        # id(tileset) -> (weak reference to it, image imported, slot of each tile index, -1 for blank tiles)
+        self.__remaps = {}
+        # Slots of tilesets collected since the last import, released by the next one
+        self.__orphaned = []
+        memory.register(self, "tilesets")
+
+    def memory_usage(self) -> dict:
+        return {"atlas": sum(surface_bytes(sheet) for sheet in self.sheets.values())}
+
+    @property
+    def free_places(self) -> int:
+        return sum(len(places) for places in self.__free_places.values())
+
+    def remap(self, tileset: TilesetProperties) -> np.ndarray:
+        entry = self.__remaps.get(id(tileset))
+        if entry is None or entry[1] is not tileset.tileset:
+            self.import_tilesets([tileset])
+            entry = self.__remaps[id(tileset)]
+        return entry[2]
+
+    def forget(self, key: int):
+        # Weak reference callback: may run on any thread, so the slots are only released by the next import
+        entry = self.__remaps.pop(key, None)
+        if entry is not None:
+            self.__orphaned.append(entry[2])
+
+    def import_tilesets(self, tilesets: list):
+        # Tilesets already imported with their current image are skipped. A reloaded image is imported again and
+        # releases the slots of its old tiles
+        added = {}
+        removed = {}
+        while self.__orphaned:
+            self.release(self.__orphaned.pop(), removed)
+        for tileset in tilesets:
+            key = id(tileset)
+            entry = self.__remaps.get(key)
+            if entry is not None and entry[1] is tileset.tileset:
+                continue
+            slots = self.hash_tiles(tileset, added)
+            for slot in np.unique(slots[slots >= 0]).tolist():
+                self.__users[slot] += 1
+            ref = entry[0] if entry is not None else weakref.ref(tileset, lambda _, key=key: self.forget(key))
+            self.__remaps[key] = (ref, tileset.tileset, slots)
+            if entry is not None:
+                self.release(entry[2], removed)
+        for size in added.keys() | removed.keys():
+            self.pack(size, added.get(size, []), removed.get(size, []))
+        if added or removed:
+            self.version += 1
+
+    def release(self, slots: np.ndarray, removed: dict):
+        for slot in np.unique(slots[slots >= 0]).tolist():
+            self.__users[slot] -= 1
+            if self.__users[slot]:
+                continue
+            size, rect = self.slot_sizes[slot], self.rects[slot]
+            del self.__slots[self.__keys[slot]]
+            self.__keys[slot] = self.rects[slot] = None
+            self.__free_slots.append(slot)
+            self.__free_places.setdefault(size, []).append(rect.y // size[1] * self.columns + rect.x // size[0])
+            removed.setdefault(size, []).append(rect)
+
+    def new_slot(self, key: tuple, size: tuple) -> int:
+        places = self.__free_places.get(size)
+        if places:
+            place = places.pop()
+        else:
+            place = self.counts.get(size, 0)
+            self.counts[size] = place + 1
+        row, column = divmod(place, self.columns)
+        rect = pygame.Rect(column * size[0], row * size[1], size[0], size[1])
+        if self.__free_slots:
+            slot = self.__free_slots.pop()
+            self.slot_sizes[slot], self.rects[slot], self.__keys[slot], self.__users[slot] = size, rect, key, 0
+        else:
+            slot = len(self.rects)
+            self.slot_sizes.append(size)
+            self.rects.append(rect)
+            self.__keys.append(key)
+            self.__users.append(0)
+        self.__slots[key] = slot
+        return slot
+
+    def hash_tiles(self, tileset: TilesetProperties, added: dict) -> np.ndarray:
+        size = (int(tileset.tilesize.x), int(tileset.tilesize.y))
+        pixels = np.dstack((pygame.surfarray.array3d(tileset.tileset), pygame.surfarray.array_alpha(tileset.tileset)))
+        # Transparent pixels compare equal whatever colour they hold
+        pixels[pixels[..., 3] == 0] = 0
+        slots = np.full(tileset.tile_count, -1, dtype=np.int32)
+        for i in range(tileset.tile_count):
+            rect = get_tile_rect(tileset, i)
+            block = pixels[rect.left:rect.right, rect.top:rect.bottom]
+            if not block[..., 3].any():
+                continue
+            key = (size, hashlib.sha1(block.tobytes()).digest())
+            slot = self.__slots.get(key)
+            if slot is None:
+                slot = self.new_slot(key, size)
+                added.setdefault(size, []).append((tileset.tileset, rect, slot))
+            slots[i] = slot
+        return slots
+
+    def pack(self, size: tuple, tiles: list, removed: list = ()):
+        old = self.sheets.get(size)
+        free = self.__free_places.get(size, [])
+        if len(free) * 2 > self.counts[size]:
+            # Mostly free: every live tile moves to the front of a smaller sheet. Slots get new rects rather than
+            # moved ones, tables made before still pair the old rects with the old sheet
+            sources = {slot: (source, rect) for source, rect, slot in tiles}
+            tiles = []
+            for slot, (slot_size, rect) in enumerate(zip(self.slot_sizes, self.rects)):
+                if rect is None or slot_size != size:
+                    continue
+                row, column = divmod(len(tiles), self.columns)
+                self.rects[slot] = pygame.Rect(column * size[0], row * size[1], size[0], size[1])
+                tiles.append((*sources.get(slot, (old, rect)), slot))
+            self.counts[size] = len(tiles)
+            self.__free_places[size] = []
+            old = removed = None
+        count = self.counts[size]
+        sheet = pygame.Surface((max(min(count, self.columns), 1) * size[0], max(-(-count // self.columns), 1) * size[1]), pygame.SRCALPHA)
+        # Blitting from a display-format sheet is several times faster than from the loaded images
+        if pygame.display.get_surface():
+            sheet = sheet.convert_alpha()
+            sheet.fill((0, 0, 0, 0))
+        # On a cleared sheet BLEND_RGBA_MAX copies pixels as they are, where a plain blit would blend their alpha
+        if old is not None:
+            sheet.blit(old, (0, 0), special_flags=pygame.BLEND_RGBA_MAX)
+        for rect in removed or ():
+            sheet.fill((0, 0, 0, 0), rect)
+        sheet.blits([
+            (source, self.rects[slot], rect, pygame.BLEND_RGBA_MAX) for source, rect, slot in tiles
+        ], doreturn=False)
+        self.sheets[size] = sheet
+
+
+tile_atlas = TileAtlas()
+
+
+class GidTable:
+    # Flattens every tile of a list of tilesets into one lookup, indexed through dense(). The tiles are drawn from
+    # the atlas; visible() also sends blank tiles to EMPTY's index so renders skip them
+    def __init__(self, tilesets: list):
+        self.counts = tuple(tileset.tile_count for tileset in tilesets)
+        for tileset, count in zip(tilesets, self.counts):
+            if count > TILE_MASK + 1:
+                raise ValueError(f"Tileset {tileset.name} has {count} tiles, at most {TILE_MASK + 1} fit in a global id")
+        # One entry past the last tileset, whose 0 tiles leave every id of a tileset missing from the list out of range
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts, dtype=np.int64))).astype(np.int64)
+        self.limits = np.array(self.counts + (0,), dtype=np.int64)
+        self.count = sum(self.counts)
+        self.reload(tilesets)
+
+    def reload(self, tilesets: list):
+        # Points every tile at its atlas slot again, after an image was reloaded or the atlas grew
+        tile_atlas.import_tilesets(tilesets)
+        slots = np.concatenate([tile_atlas.remap(tileset) for tileset in tilesets] + [np.zeros(0, dtype=np.int32)])
+        # Replaced whole rather than edited, so a chunk render on a worker reads one consistent set of sheets,
+        # rects and drawn indices however many reloads happen meanwhile
+        self.tiles = (
+            [None if slot < 0 else tile_atlas.sheets[tile_atlas.slot_sizes[slot]] for slot in slots.tolist()],
+            [None if slot < 0 else tile_atlas.rects[slot] for slot in slots.tolist()],
+            np.append(np.where(slots < 0, self.count, np.arange(self.count)), self.count),
+        )
+        self.sources = tuple(tileset.tileset for tileset in tilesets)
+        self.atlas_version = tile_atlas.version
+
+    def is_current(self, tilesets: list) -> bool:
+        return self.atlas_version == tile_atlas.version and len(tilesets) == len(self.sources) and all(
+            tileset.tileset is source for tileset, source in zip(tilesets, self.sources)
+        )
+
+    def can_reload(self, tilesets: list) -> bool:
+        return tuple(tileset.tile_count for tileset in tilesets) == self.counts
+
+    def dense(self, gids: np.ndarray) -> np.ndarray:
+        # EMPTY maps to self.count, one past the last tile. So do ids past the end of their tileset, left in the
+        # map when its image was reloaded with fewer tiles: they draw nothing until the tiles come back
+        gids = np.asarray(gids)
+        tileset_ids = np.clip(gid_tileset(gids), 0, len(self.counts))
+        indices = gid_index(gids)
+        valid = (gids != EMPTY) & (indices < self.limits[tileset_ids])
+        return np.where(valid, self.offsets[tileset_ids] + indices, self.count)
+
+    def visible(self, gids: np.ndarray, tiles: tuple = None) -> np.ndarray:
+        # tiles, when given, is a self.tiles read earlier, to match the surfaces and rects the caller holds
+        return (tiles or self.tiles)[2][self.dense(gids)]
+
+
+_gid_tables = OrderedDict()
+
+
+def gid_table(tilesets: list, limit: int = 16) -> GidTable:
+    # Layers of one map share their tilesets list, and with it the table
+    table = _gid_tables.get(id(tilesets))
+    if table is not None and table[0] is tilesets and not table[1].is_current(tilesets) and table[1].can_reload(tilesets):
+        table[1].reload(tilesets)
+    elif table is None or table[0] is not tilesets or not table[1].is_current(tilesets):
+        table = (tilesets, GidTable(tilesets))
+        _gid_tables[id(tilesets)] = table
+    _gid_tables.move_to_end(id(tilesets))
+    while len(_gid_tables) > limit:
+        _gid_tables.popitem(last=False)
+    return table[1]
@@ -0,0 +1,72 @@
+import os
+import threading
+
+import pygame
+
+TILESET_CHANGED = pygame.event.custom_type()
+
+
+def file_stamp(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class TilesetWatcher:
+    # Polls the tileset images on a background thread and loads the changed ones there too. The new surface is
+    # handed to the main thread in a TILESET_CHANGED event, where it is swapped in between two frames
+    def __init__(self, tilesets: list, interval: float = 1.0):
+        self.tilesets = tilesets
+        self.interval = interval
+        self.stamps = {}
+        self.pending = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        for tileset in list(self.tilesets):
+            if tileset.path:
+                self.stamps[tileset.path] = file_stamp(tileset.path)
+        self.thread = threading.Thread(target=self.run, name="tileset-watcher", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.poll()
+
+    def poll(self) -> list:
+        # Returns the paths that were reloaded
+        by_path = {}
+        for tileset in list(self.tilesets):
+            if tileset.path:
+                by_path.setdefault(tileset.path, []).append(tileset)
+        reloaded = []
+        for path, tilesets in by_path.items():
+            stamp = file_stamp(path)
+            if path not in self.stamps:
+                self.stamps[path] = stamp
+                continue
+            if stamp is None or stamp == self.stamps[path]:
+                self.pending.pop(path, None)
+                continue
+            # Image editors write in several steps, so a file is only read once it stayed the same for one interval
+            if self.pending.get(path) != stamp:
+                self.pending[path] = stamp
+                continue
+            del self.pending[path]
+            self.stamps[path] = stamp
+            try:
+                surface = pygame.image.load(path)
+            except (pygame.error, OSError):
+                continue
+            for tileset in tilesets:
+                pygame.event.post(pygame.event.Event(TILESET_CHANGED, tileset=tileset, surface=surface, path=path))
+            reloaded.append(path)
+        return reloaded
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,80 @@
+import pygame
+from pygame.locals import *
+
+from sprite_cache import surface_bytes
+from memory import memory
+
+
+class UiLayer:
+    # Widgets that rarely change look, such as the toolbars, composed into one cached surface. A widget sets its
+    # dirty flag when its look changed (hover, text, colours...) and only those are drawn again, into the cache.
+    # draw() blits the cache in one go; dirty_rects holds the screen rects redrawn by the last call
+    def __init__(self):
+        self.widgets = []
+        self.bounds = pygame.Rect(0, 0, 0, 0)
+        self.surf = None
+        self.dirty_rects = []
+        self.__drawn = {}
+        memory.register(self, "ui")
+
+    def memory_usage(self) -> dict:
+        return {"toolbar": surface_bytes(self.surf) if self.surf is not None else 0}
+
+    def add(self, widget):
+        self.widgets.append(widget)
+        widget.dirty = True
+
+    def remove(self, widget):
+        self.widgets.remove(widget)
+        rect = self.__drawn.pop(id(widget), None)
+        if rect is not None and self.surf is not None:
+            self.clear(rect)
+
+    def update(self):
+        for widget in self.widgets:
+            widget.update()
+
+    def on_click(self) -> bool:
+        for widget in self.widgets:
+            if widget.on_click():
+                return True
+        return False
+
+    def rebuild(self):
+        # Everything is drawn again when a widget moved outside the cached area
+        self.bounds = self.widgets[0].rect.unionall([widget.rect for widget in self.widgets[1:]]) if self.widgets else pygame.Rect(0, 0, 0, 0)
+        self.surf = pygame.Surface(self.bounds.size, SRCALPHA)
+        self.__drawn = {}
+        for widget in self.widgets:
+            widget.dirty = True
+
+    def clear(self, rect: pygame.Rect):
+        self.surf.fill((0, 0, 0, 0), rect.move(-self.bounds.x, -self.bounds.y))
+
+    def render(self) -> list:
+        if self.surf is None or any(not self.bounds.contains(widget.rect) for widget in self.widgets if widget.dirty):
+            self.rebuild()
+        dirty = [widget for widget in self.widgets if widget.dirty]
+        if not dirty:
+            return []
+        rects = []
+        for widget in dirty:
+            # A widget that moved or shrank leaves its old area behind, cleared along with the new one
+            old = self.__drawn.get(id(widget))
+            if old is not None and old != widget.rect:
+                self.clear(old)
+                rects.append(old)
+            self.clear(widget.rect)
+            rects.append(widget.rect.copy())
+        # Neighbours overlapping a cleared area are drawn again too, in their original order
+        for widget in self.widgets:
+            if widget.dirty or widget.rect.collidelist(rects) != -1:
+                widget.draw(self.surf, self.bounds.topleft)
+                widget.dirty = False
+                self.__drawn[id(widget)] = widget.rect.copy()
+        return rects
+
+    def draw(self, surface: pygame.Surface):
+        self.dirty_rects = self.render()
+        if self.surf is not None:
+            surface.blit(self.surf, self.bounds)